@@ -1,19 +1,47 @@
-from absplice.cat_dataloader import CatInference
-from absplice.dataloader import SpliceOutlierDataloader
-from absplice.model import SpliceOutlier
+import importlib
 
 from absplice.result import SplicingOutlierResult, \
-    GENE_MAP, GENE_TPM, ABSPLICE_DNA, ABSPLICE_RNA
+    GENE_MAP, GENE_TPM, ABSPLICE_DNA, ABSPLICE_RNA, \
+    ABSPLICE_DNA_SCORER, ABSPLICE_RNA_SCORER
+from absplice.streaming import StreamingSplicingOutlierResult
+from absplice.index import VariantIndex, SpliceAIVcfIndex
+from absplice.cache import PredictionCache
+
+# imported on first access, so `import absplice` does not import
+# mmsplice/tensorflow, splicemap and kipoi
+_lazy_attrs = {
+    'CatInference': 'absplice.cat_dataloader',
+    'SpliceOutlierDataloader': 'absplice.dataloader',
+    'SpliceOutlier': 'absplice.model',
+}
+
+
+def __getattr__(name):
+    if name in _lazy_attrs:
+        value = getattr(importlib.import_module(_lazy_attrs[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(
+        "module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attrs))
+
 
 __all__ = [
-    'SplicingRefTable',
     'SpliceOutlierDataloader',
     'CatInference',
     'SpliceOutlier',
     'SplicingOutlierResult',
-    'CatInference',
-    GENE_MAP,
-    GENE_TPM,
-    ABSPLICE_DNA,
-    ABSPLICE_RNA
-]
\ No newline at end of file
+    'StreamingSplicingOutlierResult',
+    'VariantIndex',
+    'SpliceAIVcfIndex',
+    'PredictionCache',
+    'GENE_MAP',
+    'GENE_TPM',
+    'ABSPLICE_DNA',
+    'ABSPLICE_RNA',
+    'ABSPLICE_DNA_SCORER',
+    'ABSPLICE_RNA_SCORER'
+]
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+import uuid
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+def prediction_keys(df):
+    """
+    Content addresses of the MMSplice predictions of the rows of `df` with
+    variant, junction and event_type columns: np.array of stable 64 bit
+    hashes of variant, junction and event type.
+    """
+    return pd.util.hash_pandas_object(
+        df[['variant', 'junction', 'event_type']], index=False
+    ).to_numpy(dtype=np.uint64)
+
+
+def prediction_key(variant, junction, event_type):
+    """
+    Content address of the MMSplice prediction of `variant` on `junction`
+    (see `prediction_keys`).
+    """
+    return int(prediction_keys(pd.DataFrame({
+        'variant': [variant],
+        'junction': [junction],
+        'event_type': [event_type]
+    }))[0])
+
+
+class PredictionCache:
+    """
+    Content-addressed cache of MMSplice predictions (`delta_logit_psi` and
+    module scores of `SpliceOutlier.predict_on_batch` before the SpliceMap
+    join) keyed by variant, junction and event type.
+
+    Predictions only depend on the variant and the coordinates of the
+    junction. SpliceMap statistics (e.g. ref_psi) are joined after
+    prediction, so cached predictions are reused by new versions of the
+    SpliceMaps and by other tissues with the same junctions. Use one cache
+    per fasta file.
+
+    Predictions are stored as `part-xxxxx.parquet` files named by the hash
+    of their keys, which are renamed into place once written, so several
+    processes can add predictions to the same cache. Methods are thread
+    safe, e.g. keys are looked up by the producer thread of
+    `BatchPrefetcher` while predictions are added by the main thread.
+
+    Args:
+      path: directory of the cache.
+      flush_rows: number of added rows buffered before they are written.
+    """
+    _key = '_key'
+
+    def __init__(self, path, flush_rows=100000):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.flush_rows = flush_rows
+        self._keys = None
+        self._pending = list()
+        self._pending_keys = set()
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # worker processes read the keys from disk
+        return {'path': self.path, 'flush_rows': self.flush_rows}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _parts(self):
+        return sorted(self.path.glob('part-*.parquet'))
+
+    @property
+    def keys(self):
+        """
+        Sorted np.array of the keys of the written predictions.
+        """
+        with self._lock:
+            if self._keys is None:
+                import pyarrow.parquet as pq
+                keys = [
+                    pq.read_table(part, columns=[self._key])
+                    .column(0).to_numpy()
+                    for part in self._parts()
+                ]
+                self._keys = np.unique(np.concatenate(
+                    [np.array([], dtype=np.uint64), *keys]))
+            return self._keys
+
+    def __len__(self):
+        with self._lock:
+            return len(self.keys) + len(self._pending_keys)
+
+    def __contains__(self, key):
+        with self._lock:
+            keys = self.keys
+            i = np.searchsorted(keys, np.uint64(key))
+            return (i < len(keys) and keys[i] == key) \
+                or key in self._pending_keys
+
+    def contains(self, keys):
+        """
+        Returns: np.array of bool whether predictions of `keys` are cached.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        with self._lock:
+            contains = np.isin(keys, self.keys)
+            if self._pending_keys:
+                contains |= np.isin(keys, np.fromiter(
+                    self._pending_keys, dtype=np.uint64))
+        return contains
+
+    @staticmethod
+    def row_keys(df):
+        """
+        Returns: np.array of keys of the rows of `df` with variant,
+          junction and event_type columns.
+        """
+        return prediction_keys(df)
+
+    def add(self, df):
+        """
+        Adds predictions (pd.DataFrame with variant, junction and
+        event_type columns). Predictions of cached keys are ignored.
+        """
+        keys = self.row_keys(df)
+        with self._lock:
+            new = ~self.contains(keys)
+            new[new] = ~pd.Series(keys[new]).duplicated().values
+            if not new.any():
+                return
+            df = df[new].assign(**{self._key: keys[new]})
+            # categoricals are stored as values, so parts have the same schema
+            df = df.astype({col: df[col].cat.categories.dtype
+                            for col in df.select_dtypes('category')})
+            self._pending.append(df)
+            self._pending_keys.update(keys[new].tolist())
+            if sum(df.shape[0] for df in self._pending) >= self.flush_rows:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered predictions.
+        """
+        with self._lock:
+            if len(self._pending) == 0:
+                return
+            df = pd.concat(self._pending, ignore_index=True)
+            keys = df[self._key].to_numpy(dtype=np.uint64)
+            name = 'part-%s.parquet' % hashlib.blake2b(
+                np.sort(keys).tobytes(), digest_size=8).hexdigest()
+            tmp_path = self.path / ('.%s.tmp' % uuid.uuid4().hex)
+            df.to_parquet(tmp_path, index=False, engine='pyarrow')
+            os.replace(tmp_path, self.path / name)
+
+            if self._keys is not None:
+                self._keys = np.union1d(self._keys, keys)
+            self._pending = list()
+            self._pending_keys = set()
+
+    def query(self, keys):
+        """
+        Returns: pd.DataFrame of the cached predictions of `keys`.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        self.flush()
+        keys = np.unique(np.asarray(keys, dtype=np.uint64))
+        dataset = ds.dataset([str(p) for p in self._parts()], format='parquet')
+        df = dataset.to_table(
+            filter=ds.field(self._key).isin(pa.array(keys, pa.uint64()))
+        ).to_pandas()
+        return df.drop_duplicates(self._key).drop(columns=self._key) \
+            .reset_index(drop=True)
@@ -1,11 +1,143 @@
 from splicemap import SpliceCountTable as CountTable
 from absplice.dataloader import SpliceMapMixin
 from absplice.utils import delta_logit_PSI_to_delta_PSI, logit
+import numpy as np
 import pandas as pd
 import re
 from typing import List
 from splicemap.splice_map import SpliceMap
 
+dtype_infer = {
+    'junction': pd.StringDtype(),
+    'gene_id': pd.StringDtype(),
+    'sample': pd.StringDtype(),
+    'tissue': pd.StringDtype(),
+    'count_cat': 'Int64',
+    'psi_cat': 'float64',
+    'ref_psi_cat': 'float64',
+    'k_cat': 'Int64',
+    'n_cat': 'Int64',
+    'median_n_cat': 'float64',
+    'delta_logit_psi_cat': 'float64',
+    'delta_psi_cat': 'float64',
+    'tissue_cat': pd.StringDtype(),
+}
+
+
+class CatEventIndex:
+    """
+    Integer-coded lookup tables of a CAT count table for one event type.
+
+    Junctions and samples of the count table are mapped to row and column
+    positions of NumPy arrays once, (junction, gene_id) pairs of the
+    SpliceMap of CAT and (tissue, junction, gene_id) triples of the target
+    SpliceMaps are mapped to positions of their value arrays, so that
+    lookups are hash lookups followed by array indexing.
+    """
+
+    def __init__(self, ct_cat, psi_cat_df, ref_psi_cat_df,
+                 splicemap_target, splicemap_cat=None):
+        self.tissue_cat = ct_cat.name
+
+        self.junctions = pd.Index(psi_cat_df.index)
+        self.samples = pd.Index(psi_cat_df.columns)
+        self.psi = psi_cat_df.to_numpy(dtype='float64')
+        self.count = ct_cat.df.reindex(
+            index=self.junctions, columns=self.samples).to_numpy()
+
+        ref_cat = ref_psi_cat_df.reindex(self.junctions)
+        self.ref_psi = ref_cat['ref_psi'].to_numpy(dtype='float64')
+        self.k = ref_cat['k'].to_numpy()
+        self.n = ref_cat['n'].to_numpy()
+        self.median_n = ref_cat['median_n'].to_numpy(dtype='float64')
+
+        if splicemap_cat is not None:
+            df_splicemap_cat = splicemap_cat.df.drop_duplicates(
+                subset=['junctions', 'gene_id'])
+            self.splicemap_cat = pd.MultiIndex.from_frame(
+                df_splicemap_cat[['junctions', 'gene_id']])
+            self.ref_psi_splicemap_cat = df_splicemap_cat['ref_psi'] \
+                .to_numpy(dtype='float64')
+            self.n_splicemap_cat = df_splicemap_cat['n'] \
+                .to_numpy(dtype='float64')
+            self.median_n_splicemap_cat = df_splicemap_cat['median_n'] \
+                .to_numpy(dtype='float64')
+        else:
+            self.splicemap_cat = None
+
+        df_target = pd.concat({
+            tissue: df_splicemap[~df_splicemap.index.duplicated()]['ref_psi']
+            for tissue, df_splicemap in splicemap_target.items()
+        }, names=['tissue'])
+        self.target = df_target.index
+        self.ref_psi_target = df_target.to_numpy(dtype='float64')
+
+    def lookup(self, junctions, gene_ids, tissues, samples):
+        """
+        Gathers CAT values for arrays of junctions, gene_ids, tissues and samples.
+
+        Returns: dict of arrays aligned with the input arrays.
+        """
+        rows = self.junctions.get_indexer(junctions)
+        cols = self.samples.get_indexer(samples)
+        if (rows == -1).any() or (cols == -1).any():
+            raise KeyError('junctions or samples are missing in CAT count table')
+
+        ref_psi_cat = self.ref_psi[rows]
+        median_n_cat = self.median_n[rows]
+
+        # If junction is in SpliceMap of CAT and there is more statistical power, use SpliceMap
+        if self.splicemap_cat is not None:
+            idx = self.splicemap_cat.get_indexer(
+                pd.MultiIndex.from_arrays([junctions, gene_ids]))
+            # -1 codes of missing pairs are never used to index the
+            # (possibly empty) value arrays
+            found = idx != -1
+            use_splicemap_cat = np.zeros(len(rows), dtype=bool)
+            use_splicemap_cat[found] = \
+                self.n_splicemap_cat[idx[found]] > self.n[rows[found]]
+            ref_psi_cat[use_splicemap_cat] = \
+                self.ref_psi_splicemap_cat[idx[use_splicemap_cat]]
+            median_n_cat[use_splicemap_cat] = \
+                self.median_n_splicemap_cat[idx[use_splicemap_cat]]
+
+        idx = self.target.get_indexer(
+            pd.MultiIndex.from_arrays([tissues, junctions, gene_ids]))
+        found = idx != -1
+        ref_psi_target = np.full(len(rows), np.nan)
+        ref_psi_target[found] = self.ref_psi_target[idx[found]]
+
+        return {
+            'count_cat': self.count[rows, cols],
+            'psi_cat': self.psi[rows, cols],
+            'ref_psi_cat': ref_psi_cat,
+            'k_cat': self.k[rows],
+            'n_cat': self.n[rows],
+            'median_n_cat': median_n_cat,
+            'ref_psi_target': ref_psi_target
+        }
+
+    def memory_usage(self):
+        """
+        Returns: pd.Series with the size of each lookup table in bytes.
+        """
+        usage = {
+            'junctions': self.junctions.memory_usage(deep=True),
+            'samples': self.samples.memory_usage(deep=True),
+            'psi': self.psi.nbytes,
+            'count': self.count.nbytes,
+            'ref_psi': self.ref_psi.nbytes + self.k.nbytes
+            + self.n.nbytes + self.median_n.nbytes,
+            'target': self.target.memory_usage(deep=True)
+            + self.ref_psi_target.nbytes,
+        }
+        if self.splicemap_cat is not None:
+            usage['splicemap_cat'] = self.splicemap_cat.memory_usage(deep=True) \
+                + self.ref_psi_splicemap_cat.nbytes \
+                + self.n_splicemap_cat.nbytes \
+                + self.median_n_splicemap_cat.nbytes
+        return pd.Series(usage)
+
 
 class CatInference(SpliceMapMixin):
 
@@ -49,6 +181,11 @@ class CatInference(SpliceMapMixin):
                 self.splicemap5_cat = SpliceMapMixin._read_splicemap(
                     splicemap_cat5)[0]
 
+            self.index5 = CatEventIndex(
+                self.ct_cat5, self.ct_cat5.psi5, self.ref_psi5_cat.df,
+                self.splicemap5_dict,
+                self.splicemap5_cat if self.splicemap_cat5_provided else None)
+
         if self.combined_splicemap3 is not None:
             self.tissues3 = [sm.name for sm in self.splicemaps3]
             self.splicemap3_dict = self._splicemap3_list_to_dict()
@@ -67,6 +204,11 @@ class CatInference(SpliceMapMixin):
                 self.splicemap3_cat = SpliceMapMixin._read_splicemap(
                     splicemap_cat3)[0]
 
+            self.index3 = CatEventIndex(
+                self.ct_cat3, self.ct_cat3.psi3, self.ref_psi3_cat.df,
+                self.splicemap3_dict,
+                self.splicemap3_cat if self.splicemap_cat3_provided else None)
+
     @staticmethod
     def _read_cat_count_table(path, name):
         if type(path) is str:
@@ -127,108 +269,84 @@ class CatInference(SpliceMapMixin):
     def contains(self, sample):
         return sample in self.samples
 
+    def index_memory_usage(self):
+        """
+        Returns: pd.Series with the size in bytes of the lookup tables
+          built for each event type.
+        """
+        usage = dict()
+        if self.combined_splicemap5 is not None:
+            usage['psi5'] = self.index5.memory_usage()
+        if self.combined_splicemap3 is not None:
+            usage['psi3'] = self.index3.memory_usage()
+        return pd.concat(usage, names=['event_type', 'table'])
+
     def infer(self, junction_id, gene_id, tissue, sample, event_type, clip_threshold=0.01):
-        splicemap_cat_provided = False
+        return self.infer_all(
+            [junction_id], [gene_id], [tissue], [sample], [event_type],
+            clip_threshold=clip_threshold).to_dict('records')[0]
 
+    def _infer_event(self, df, event_type, clip_threshold=0.01):
         if event_type == 'psi5':
-            ct_cat = self.ct_cat5
-            psi_cat_df = ct_cat.psi5
-            ref_psi_cat_df = self.ref_psi5_cat.df
-
-            if self.splicemap_cat5_provided:
-                splicemap_cat_provided = True
-                splicemap_cat_df = self.splicemap5_cat.df.set_index(
-                    ['junctions', 'gene_id'])
-
-            tissue_cat = ct_cat.name
-            splicemap_target_df = self.splicemap5_dict[tissue]
-
+            index = self.index5
         elif event_type == 'psi3':
-            ct_cat = self.ct_cat3
-            psi_cat_df = ct_cat.psi3
-            ref_psi_cat_df = self.ref_psi3_cat.df
-
-            if self.splicemap_cat3_provided:
-                splicemap_cat_provided = True
-                splicemap_cat_df = self.splicemap3_cat.df.set_index(
-                    ['junctions', 'gene_id'])
-
-            tissue_cat = ct_cat.name
-            splicemap_target_df = self.splicemap3_dict[tissue]
+            index = self.index3
         else:
             raise ValueError('Site should be "psi5" or "psi3"')
 
-        ref_psi_target = splicemap_target_df.loc[
-            (junction_id, gene_id)]['ref_psi']
-        psi_cat = psi_cat_df.loc[junction_id, sample]
-        ref_psi_cat = ref_psi_cat_df.loc[junction_id]['ref_psi']
-        median_n_cat = ref_psi_cat_df.loc[junction_id]['median_n']
+        values = index.lookup(
+            df['junction'].values, df['gene_id'].values,
+            df['tissue'].values, df['sample'].values)
+        ref_psi_target = values.pop('ref_psi_target')
 
-        # If junction is in SpliceMap of CAT and there is more statistical power, use SpliceMap
-        if splicemap_cat_provided:
-            if junction_id in splicemap_cat_df.index:
-                if splicemap_cat_df.loc[(junction_id, gene_id)]['n'] > ref_psi_cat_df.loc[junction_id]['n']:
-                    ref_psi_cat = splicemap_cat_df.loc[(
-                        junction_id, gene_id)]['ref_psi']
-                    median_n_cat = splicemap_cat_df.loc[(
-                        junction_id, gene_id)]['median_n']
-
-        delta_logit_psi_cat = logit(psi_cat, clip_threshold) - \
-            logit(ref_psi_cat, clip_threshold)
-
-        result_infer = {
-            'junction': junction_id,
-            'gene_id': gene_id,
-            'sample': sample,
-            'tissue': tissue,
-            'count_cat': ct_cat.df.loc[junction_id, sample],
-            'psi_cat': psi_cat,
-            'ref_psi_cat': ref_psi_cat,
-            'k_cat': ref_psi_cat_df.loc[junction_id]['k'],
-            'n_cat': ref_psi_cat_df.loc[junction_id]['n'],
-            'median_n_cat': median_n_cat,
+        delta_logit_psi_cat = logit(values['psi_cat'], clip_threshold) - \
+            logit(values['ref_psi_cat'], clip_threshold)
+
+        return pd.DataFrame({
+            'junction': df['junction'].values,
+            'gene_id': df['gene_id'].values,
+            'sample': df['sample'].values,
+            'tissue': df['tissue'].values,
+            **values,
             'delta_logit_psi_cat': delta_logit_psi_cat,
             'delta_psi_cat': delta_logit_PSI_to_delta_PSI(
                 delta_logit_psi_cat, ref_psi_target, clip_threshold=clip_threshold),
-            'tissue_cat': tissue_cat
-        }
-        # assert pd.DataFrame(result_infer, index=[0]).shape[0] == 1
-
-        result_infer = pd.DataFrame(result_infer, index=[0]).astype({
-            'junction': pd.StringDtype(),
-            'gene_id': pd.StringDtype(),
-            'sample': pd.StringDtype(),
-            'tissue': pd.StringDtype(),
-            'count_cat': 'Int64',
-            'psi_cat': 'float64',
-            'ref_psi_cat': 'float64',
-            'k_cat': 'Int64',
-            'n_cat': 'Int64',
-            'median_n_cat': 'float64',
-            'delta_logit_psi_cat': 'float64',
-            'delta_psi_cat': 'float64',
-            'tissue_cat': pd.StringDtype(),
-        }).to_dict('records')[0]
-
-        return result_infer
-
-    # def infer_all(self, event_type):
-
-    #     if event_type == 'psi5':
-    #         common_junctions = self.common_junctions5
-    #         tissues = self.tissues5
-    #     elif event_type == 'psi3':
-    #         common_junctions = self.common_junctions3
-    #         tissues = self.tissues3
-
-    #     infer_rows = list()
-    #     for tissue in tissues:
-    #         for sample in self.samples:
-    #             for junction in common_junctions[tissues.index(tissue)]:
-    #                 if self.contains(junction, tissue, sample, event_type):
-    #                     infer_rows.append(
-    #                         self.infer(junction, tissue, sample, event_type))
-    #     df = pd.DataFrame(infer_rows)
-    #     df = df.drop_duplicates().set_index(['junction', 'tissue', 'sample'])
-
-    #     return df
+            'tissue_cat': index.tissue_cat
+        }, index=df.index)
+
+    def infer_all(self, junctions, gene_ids, tissues, samples, event_types, clip_threshold=0.01):
+        """
+        Vectorized version of `infer` for many (junction, gene_id, tissue, sample, event_type) rows.
+
+        Values of the CAT count table, the reference tables and the SpliceMaps
+        are gathered with index joins for all rows at once.
+
+        Returns: pd.DataFrame with one row per input row (in the same order)
+          and the same columns and dtypes as the dict returned by `infer`.
+        """
+        df = pd.DataFrame({
+            'junction': np.asarray(junctions, dtype=object),
+            'gene_id': np.asarray(gene_ids, dtype=object),
+            'tissue': np.asarray(tissues, dtype=object),
+            'sample': np.asarray(samples, dtype=object),
+            'event_type': np.asarray(event_types, dtype=object),
+        })
+
+        if not df['event_type'].isin(['psi5', 'psi3']).all():
+            raise ValueError('Site should be "psi5" or "psi3"')
+
+        results = [
+            self._infer_event(df[df['event_type'] == event_type],
+                              event_type, clip_threshold)
+            for event_type in ['psi5', 'psi3']
+            if (df['event_type'] == event_type).any()
+        ]
+        if len(results) == 0:
+            return self._empty_infer_result()
+
+        return pd.concat(results).sort_index() \
+            .reset_index(drop=True).astype(dtype_infer)
+
+    @staticmethod
+    def _empty_infer_result():
+        return pd.DataFrame(columns=dtype_infer.keys()).astype(dtype_infer)
@@ -1,16 +1,157 @@
+import copy
 import itertools
+import os
+import pathlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+import numpy as np
 import pandas as pd
 from kipoi.data import SampleIterator
 from splicemap.splice_map import SpliceMap
+from absplice.cache import prediction_keys
 
 try:
     from mmsplice.junction_dataloader import JunctionPSI5VCFDataloader, \
         JunctionPSI3VCFDataloader
-    from mmsplice.utils import encodeDNA
 except ImportError:
     pass
 
+# one-hot rows of ASCII codes, `N`, `*` and padding are encoded as zeros
+_DNA_LUT = np.zeros((256, 4))
+_DNA_LUT[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.eye(4)
+# ASCII codes accepted by `mmsplice.utils.encodeDNA` and padding
+_DNA_VALID = np.zeros(256, dtype=bool)
+_DNA_VALID[np.frombuffer(b'ACGTN*\0', dtype=np.uint8)] = True
+
+
+def encode_dna(seqs):
+    """
+    One-hot encodes sequences padded with `N` at the end to the longest
+    sequence. Same output as `mmsplice.utils.encodeDNA` but uses a lookup
+    table over the bytes of the sequences.
+
+    Args:
+      seqs: list or array of upper case DNA sequences.
+    Returns:
+      np.array of shape (len(seqs), max_len, 4)
+    Raises:
+      KeyError: if a sequence contains other characters than `ACGTN*`
+        (e.g. lower case or other IUPAC codes) like `encodeDNA`.
+    """
+    seqs = np.asarray(seqs, dtype=bytes)
+    if seqs.size == 0:
+        return np.zeros((0, 0, 4))
+    max_len = max(map(len, seqs))
+    codes = seqs.astype('S%d' % max(max_len, 1)).view(np.uint8) \
+        .reshape(len(seqs), -1)[:, :max_len]
+    invalid = ~_DNA_VALID[codes]
+    if invalid.any():
+        raise KeyError(chr(codes[invalid][0]))
+    return _DNA_LUT[codes]
+
+
+class EncodedSeqCache:
+    """
+    Thread-safe LRU cache of one-hot encoded sequences keyed by genomic
+    interval.
+
+    Args:
+      maxsize: maximum number of cached intervals.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+
+_SPLICEMAP_NAME_KEY = b'absplice:splicemap_name'
+
+
+def write_splicemap_arrow(splicemap, path):
+    """
+    Writes SpliceMap to an uncompressed Arrow IPC file which can be
+    memory-mapped by `read_splicemap_arrow`. String columns are
+    dictionary encoded.
+
+    Args:
+      splicemap: SpliceMap object or path to SpliceMap csv.
+      path: path of the output `.arrow` file.
+    """
+    import pyarrow as pa
+
+    if not isinstance(splicemap, SpliceMap):
+        splicemap = SpliceMap.read_csv(str(splicemap))
+
+    df = splicemap.df.copy()
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].astype('category')
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **table.schema.metadata,
+        _SPLICEMAP_NAME_KEY: str(splicemap.name).encode()
+    })
+
+    # write to temporary file first so concurrent jobs never read partial files
+    path = str(path)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def read_splicemap_arrow(path, categorical=False):
+    """
+    Reads SpliceMap written by `write_splicemap_arrow`. The file is
+    memory-mapped so numeric columns are not copied and pages are shared
+    by processes reading the same file.
+
+    Args:
+      path: path to `.arrow` file.
+      categorical: keep string columns as `pd.Categorical` instead of
+        converting them to object columns.
+    """
+    import pyarrow as pa
+
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    df = table.to_pandas(split_blocks=True)
+    if not categorical:
+        for col in df.columns[df.dtypes == 'category']:
+            df[col] = df[col].astype(object)
+
+    name = table.schema.metadata[_SPLICEMAP_NAME_KEY].decode()
+    return SpliceMap(df, name)
+
 
 class SpliceMapMixin:
 
@@ -41,9 +182,50 @@ class SpliceMapMixin:
         ).drop_duplicates(subset='junctions').set_index('junctions')
         return df
 
+    @staticmethod
+    def _subset_splicemaps(splicemaps: List[SpliceMap], chromosome):
+        subsets = list()
+        for splicemap in splicemaps:
+            df = splicemap.df[
+                splicemap.df['Chromosome'].astype(str) == chromosome]
+            if df.shape[0] > 0:
+                splicemap = copy.copy(splicemap)
+                splicemap.df = df
+                subsets.append(splicemap)
+        return subsets or None
+
+    def partition_by_chromosome(self):
+        """
+        Splits the SpliceMaps by chromosome of the junctions.
+
+        Returns: list of (chromosome, splicemaps5, splicemaps3) tuples
+          in order of first occurrence of the chromosome in the SpliceMaps.
+          `splicemaps5` and `splicemaps3` are lists of `SpliceMap` restricted
+          to the chromosome or None if there is no junction on the chromosome.
+        """
+        splicemaps5 = self.splicemaps5 \
+            if self.combined_splicemap5 is not None else list()
+        splicemaps3 = self.splicemaps3 \
+            if self.combined_splicemap3 is not None else list()
+
+        chromosomes = dict.fromkeys(itertools.chain.from_iterable(
+            splicemap.df['Chromosome'].astype(str).unique()
+            for splicemap in [*splicemaps5, *splicemaps3]
+        ))
+        return [
+            (chromosome,
+             self._subset_splicemaps(splicemaps5, chromosome),
+             self._subset_splicemaps(splicemaps3, chromosome))
+            for chromosome in chromosomes
+        ]
+
     @staticmethod
     def _read_splicemap(path):
+        if isinstance(path, pathlib.PurePath):
+            path = str(path)
         if type(path) is str:
+            if path.endswith('.arrow'):
+                return [read_splicemap_arrow(path)]
             return [SpliceMap.read_csv(path)]
         elif type(path) is SpliceMap:
             return [path]
@@ -58,13 +240,37 @@ class SpliceMapMixin:
 
 
 class SpliceOutlierDataloader(SpliceMapMixin, SampleIterator):
+    """
+    Args:
+      fasta_file: path to fasta file.
+      vcf_file: path to vcf file.
+      splicemap5: list of SpliceMaps for psi5 events. SpliceMaps can be
+        given as `SpliceMap` objects, csv files or `.arrow` files written
+        by `write_splicemap_arrow`.
+      splicemap3: list of SpliceMaps for psi3 events.
+      cache_size: number of encoded reference sequences cached by genomic
+        interval. Reference sequences are shared by all variants of a
+        junction so they are encoded once per junction. Disabled if 0.
+      prediction_cache: `PredictionCache`. Rows of variants and junctions
+        with cached predictions are skipped and their keys are collected
+        in `cached_keys` (see `SpliceOutlier.predict_on_dataloader`).
+    """
 
-    def __init__(self, fasta_file, vcf_file, splicemap5=None, splicemap3=None):
+    def __init__(self, fasta_file, vcf_file, splicemap5=None, splicemap3=None,
+                 cache_size=4096, prediction_cache=None):
         SpliceMapMixin.__init__(self, splicemap5, splicemap3)
+        # settings of the dataloaders of partitions (see `partition_by_chromosome`)
+        self._init_kwargs = {
+            'cache_size': cache_size,
+            'prediction_cache': prediction_cache
+        }
+        self.prediction_cache = prediction_cache
+        self.cached_keys = list()
 
         import mmsplice
         self.fasta_file = fasta_file
         self.vcf_file = vcf_file
+        self.seq_cache = EncodedSeqCache(cache_size) if cache_size else None
         self._generator = iter([])
 
         if self.combined_splicemap5 is not None:
@@ -72,24 +278,61 @@ class SpliceOutlierDataloader(SpliceMapMixin, SampleIterator):
                 self.combined_splicemap5, fasta_file, vcf_file, encode=False)
             self._generator = itertools.chain(
                 self._generator,
-                self._iter_dl(self.dl5, self.combined_splicemap5, event_type='psi5'))
+                self._iter_dl(self.dl5, event_type='psi5'))
 
         if self.combined_splicemap3 is not None:
             self.dl3 = JunctionPSI3VCFDataloader(
                 self.combined_splicemap3, fasta_file, vcf_file, encode=False)
             self._generator = itertools.chain(
                 self._generator,
-                self._iter_dl(self.dl3, self.combined_splicemap3, event_type='psi3'))
-
-    def _iter_dl(self, dl, intron_annotations, event_type):
-        for row in dl:
-            junction_id = row['metadata']['exon']['junction']
-            ref_row = intron_annotations.loc[junction_id]
-            row['metadata']['junction'] = dict()
-            row['metadata']['junction']['junction'] = ref_row.name
-            row['metadata']['junction']['event_type'] = event_type
-            row['metadata']['junction'].update(ref_row.to_dict())
-            yield row
+                self._iter_dl(self.dl3, event_type='psi3'))
+
+        self._junction_index, self._junction_coords = \
+            self._junction_arrays()
+
+    def _junction_arrays(self):
+        df = pd.concat([
+            df for df in [self.combined_splicemap5, self.combined_splicemap3]
+            if df is not None
+        ])
+        df = df[~df.index.duplicated()]
+        return df.index, {col: df[col].values for col in df.columns}
+
+    def _iter_dl(self, dl, event_type, chunksize=1024):
+        # coordinates of junctions are added per batch in `batch_iter`
+        # and keys of cached predictions are hashed per chunk of rows
+        rows = iter(dl)
+        while True:
+            chunk = list(itertools.islice(rows, chunksize))
+            if len(chunk) == 0:
+                return
+            if self.prediction_cache is not None:
+                keys = prediction_keys(pd.DataFrame({
+                    'variant': [row['metadata']['variant']['annotation']
+                                for row in chunk],
+                    'junction': [row['metadata']['exon']['junction']
+                                 for row in chunk],
+                    'event_type': event_type
+                }))
+                cached = self.prediction_cache.contains(keys)
+                self.cached_keys.extend(keys[cached].tolist())
+                chunk = [row for row, c in zip(chunk, cached) if not c]
+            for row in chunk:
+                row['metadata']['junction'] = {
+                    'junction': row['metadata']['exon']['junction'],
+                    'event_type': event_type
+                }
+                yield row
+
+    def _add_junction_coords(self, batch):
+        junction = batch['metadata']['junction']
+        idx = self._junction_index.get_indexer(junction['junction'])
+        if (idx == -1).any():
+            raise KeyError('Junctions are not in SpliceMaps: %s' % list(
+                junction['junction'][idx == -1]))
+        for col, values in self._junction_coords.items():
+            junction[col] = values[idx]
+        return batch
 
     def __next__(self):
         return next(self._generator)
@@ -97,13 +340,153 @@ class SpliceOutlierDataloader(SpliceMapMixin, SampleIterator):
     def __iter__(self):
         return self
 
-    def batch_iter(self, batch_size=32, **kwargs):
+    def batch_iter(self, batch_size=32, encode=True, **kwargs):
         for batch in super().batch_iter(batch_size, **kwargs):
-            batch['inputs']['seq'] = self._encode_batch_seq(
-                batch['inputs']['seq'])
-            batch['inputs']['mut_seq'] = self._encode_batch_seq(
-                batch['inputs']['mut_seq'])
+            batch = self._add_junction_coords(batch)
+            if encode:
+                batch = self.encode_batch(batch)
             yield batch
 
+    def encode_batch(self, batch):
+        batch['inputs']['seq'] = self._encode_batch_ref_seq(
+            batch['inputs']['seq'], batch['metadata'])
+        batch['inputs']['mut_seq'] = self._encode_batch_seq(
+            batch['inputs']['mut_seq'])
+        return batch
+
     def _encode_batch_seq(self, batch):
-        return {k: encodeDNA(v.tolist()) for k, v in batch.items()}
+        return {k: encode_dna(v) for k, v in batch.items()}
+
+    @staticmethod
+    def _interval_keys(metadata):
+        exon = metadata['exon']
+        return list(zip(
+            exon['chrom'], exon['start'], exon['end'], exon['strand'],
+            exon['left_overhang'], exon['right_overhang'],
+            metadata['junction']['event_type']))
+
+    def _encode_batch_ref_seq(self, batch, metadata):
+        if self.seq_cache is None:
+            return self._encode_batch_seq(batch)
+
+        keys = self._interval_keys(metadata)
+        encoded = [self.seq_cache.get(key) for key in keys]
+        missing = {
+            key: i for i, (key, value) in enumerate(zip(keys, encoded))
+            if value is None
+        }
+
+        if missing:
+            new = {k: encode_dna(v[list(missing.values())])
+                   for k, v in batch.items()}
+            for j, (key, i) in enumerate(missing.items()):
+                missing[key] = {
+                    k: v[j, :len(batch[k][i])].copy() for k, v in new.items()
+                }
+                self.seq_cache.put(key, missing[key])
+            encoded = [
+                missing[key] if value is None else value
+                for key, value in zip(keys, encoded)
+            ]
+
+        return {k: self._stack_seq([e[k] for e in encoded]) for k in batch}
+
+    @staticmethod
+    def _stack_seq(arrays):
+        max_len = max(len(a) for a in arrays)
+        stacked = np.zeros((len(arrays), max_len, 4))
+        for i, a in enumerate(arrays):
+            stacked[i, :len(a)] = a
+        return stacked
+
+
+class BatchPrefetcher:
+    """
+    Iterates encoded batches of `SpliceOutlierDataloader` while the batches
+    are produced in background threads.
+
+    A producer thread extracts sequences of batches and submits them to
+    `num_workers` encoding threads. At most `queue_size` batches are
+    prefetched. Batches are yielded in the order of `batch_iter`.
+
+    Args:
+      dataloader: SpliceOutlierDataloader
+      batch_size: batch size passed to `dataloader.batch_iter`
+      queue_size: maximum number of prefetched batches.
+      num_workers: number of threads encoding the batches.
+
+    Attributes:
+      timings: dict of seconds spent in each stage: `load` (sequence
+        extraction by producer), `encode` (summed over workers) and `wait`
+        (consumer waiting for the next batch).
+    """
+    _done = object()
+
+    def __init__(self, dataloader, batch_size=32, queue_size=4,
+                 num_workers=1, **kwargs):
+        if queue_size < 1:
+            raise ValueError('`queue_size` should be at least 1')
+        self.dataloader = dataloader
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.num_workers = num_workers
+        self.kwargs = kwargs
+        self.timings = {'load': 0., 'encode': 0., 'wait': 0.}
+        self.num_batches = 0
+        self._lock = threading.Lock()
+
+    def _encode(self, batch):
+        start = time.perf_counter()
+        batch = self.dataloader.encode_batch(batch)
+        with self._lock:
+            self.timings['encode'] += time.perf_counter() - start
+        return batch
+
+    def _put(self, item, stop):
+        while not stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, executor, stop):
+        try:
+            batches = self.dataloader.batch_iter(
+                self.batch_size, encode=False, **self.kwargs)
+            while not stop.is_set():
+                start = time.perf_counter()
+                batch = next(batches, self._done)
+                self.timings['load'] += time.perf_counter() - start
+                if batch is self._done:
+                    break
+                if not self._put(executor.submit(self._encode, batch), stop):
+                    return
+        except Exception as e:
+            self._put(e, stop)
+        self._put(self._done, stop)
+
+    def __iter__(self):
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            producer = threading.Thread(
+                target=self._produce, args=(executor, stop), daemon=True)
+            producer.start()
+            try:
+                while True:
+                    start = time.perf_counter()
+                    item = self._queue.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    if item is self._done:
+                        break
+                    batch = item.result()
+                    self.timings['wait'] += time.perf_counter() - start
+                    self.num_batches += 1
+                    yield batch
+            finally:
+                stop.set()
+                producer.join()
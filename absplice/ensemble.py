@@ -1,75 +1,131 @@
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.base import clone
 from sklearn.model_selection import GroupKFold
 from interpret.glassbox import ExplainableBoostingClassifier
 from pathlib import Path
+import json
 import pickle
 import os
+from absplice.utils import read_csv, read_chunks
 
 
 def train_model_ebm(df_ensemble,
                     features, features_train=None, features_test=None,
-                    chosen_model=ExplainableBoostingClassifier(),
+                    chosen_model=None,
                     feature_to_filter_na='delta_psi',
                     index_GroupKFold='sample', nsplits=5,
-                    save_dir=None, write_to_pickle=False, save_results=False):
+                    save_dir=None, write_to_pickle=False, save_results=False,
+                    n_jobs=1, random_state=None, results_format='csv'):
+    """
+    Trains and evaluates `chosen_model` in `GroupKFold` cross-validation.
+    Rows with missing `feature_to_filter_na` are predicted by the mean of
+    the models of all folds.
 
-    results_all = list()
-    models_all = list()
+    Args:
+      df_ensemble: pd.DataFrame with features, `outlier` column and
+        gene_name, sample, tissue index levels or `TrainingData`
+        (e.g. memory-mapped with `write_training_data`).
+      chosen_model: unfitted estimator, which is cloned for each fold.
+        Defaults to `ExplainableBoostingClassifier()`.
+      n_jobs: number of folds trained in parallel worker processes.
+        Inner parallelism of the model (e.g. `n_jobs` of
+        `ExplainableBoostingClassifier`) should be set accordingly.
+      random_state: if given, the model of fold `i` is trained with
+        random_state `random_state + i`, otherwise with the random_state
+        of `chosen_model`. Results do not depend on `n_jobs`.
+      results_format: format of `results_all` written if `save_results`
+        (`csv` or `parquet`).
+
+    Returns: tuple of pd.DataFrame of predictions and list of models.
+    """
+    if chosen_model is None:
+        chosen_model = ExplainableBoostingClassifier()
 
     if features_train is None:
         features_train = features
         features_test = features
 
-    if feature_to_filter_na is not None:
-        df = df_ensemble[
-            ~df_ensemble[feature_to_filter_na].isna()
-            ][[*features, 'outlier']]
-        df_missing = df_ensemble[
-            df_ensemble[feature_to_filter_na].isna()
-            ][[*features, 'outlier']]
-        X_missing = df_missing[features].fillna(0)
-        y_missing = df_missing[['outlier']]
-        y_pred_missing_iterm = np.zeros([df_missing.shape[0],nsplits])
+    if isinstance(df_ensemble, TrainingData):
+        data = df_ensemble
     else:
-        df = df_ensemble
-        df_missing = None
+        columns = list(dict.fromkeys([
+            *features, *features_train, *features_test,
+            *([feature_to_filter_na] if feature_to_filter_na else [])]))
+        data = TrainingData.from_df(df_ensemble, columns)
+
+    rows = np.arange(len(data))
+    rows_missing = None
+    if feature_to_filter_na is not None:
+        missing = data.isna(feature_to_filter_na)
+        rows = rows[~missing]
+        rows_missing = np.flatnonzero(missing)
 
-    X = df[features]
-    y = df[['outlier']]
-    
-    groups = df.index.get_level_values(index_GroupKFold)
+    # rows predicted by the model of each fold
+    folds = list()
+    groups = data.groups(index_GroupKFold)[rows]
     gkf = GroupKFold(n_splits=nsplits)
-    for fold, (train, test) in enumerate(gkf.split(X, y, groups=groups)):
-        # train, test
-        X_train = X[features_train].iloc[train].fillna(0)
-        X_test = X[features_test].iloc[test].fillna(0)
-        y_train = y.iloc[train]
-        y_test = y.iloc[test]
-        # fit model
-        model = ExplainableBoostingClassifier() #TODO: model=chosen_model
-        model.fit(X_train, y_train)
-        models_all.append(model)
-        y_pred = model.predict_proba(X_test)[:, 1]  
-        if write_to_pickle == True:
+    for fold, (train, test) in enumerate(gkf.split(rows, groups=groups)):
+        train, test = rows[train], rows[test]
+        predict = {'test': (test, features_test)}
+        if features_train != features_test:
+            predict['test_on_train_features'] = (test, features_train)
+        if rows_missing is not None:
+            predict['missing'] = (rows_missing, features_test)
+            if features_train != features_test:
+                predict['missing_on_train_features'] = \
+                    (rows_missing, features_train)
+        folds.append((
+            _fold_model(chosen_model, random_state, fold),
+            data, train, features_train, predict))
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            fitted = list(executor.map(_fit_fold, *zip(*folds)))
+    else:
+        fitted = [_fit_fold(*fold) for fold in folds]
+
+    models_all = [model for model, _ in fitted]
+    if write_to_pickle == True:
+        for fold, model in enumerate(models_all):
             _write_to_pickle(model, save_dir, fold)
-        # store predictions of fold
-        results = _update_fold_results(X, y, y_test, y_pred, test, fold, \
-            features, features_train, features_test, model)    
-        results_all.append(results)
-    results_all_df = pd.concat(results_all) 
-    
-    # Join with outliers that we do not have predictions for (based on feature_to_filter_na)
-    if df_missing is not None: 
-        results_all_df = _update_results_with_missing(X_missing, y_missing, y_pred_missing_iterm,\
-            features, features_train, features_test, models_all, results_all_df)
-    
+
+    # predictions of all folds and of rows with missing feature_to_filter_na
+    results_all_df = _fold_results(
+        data, [fold[4]['test'][0] for fold in folds],
+        [y_pred for _, y_pred in fitted], rows_missing,
+        features, features_train, features_test)
+
     if save_results == True:
-        _save_results(results_all_df, save_dir)
-    
+        _save_results(results_all_df, save_dir, results_format)
+
     return results_all_df, models_all
 
 
+def _fold_model(chosen_model, random_state, fold):
+    model = clone(chosen_model)
+    if random_state is not None and 'random_state' in model.get_params():
+        model.set_params(random_state=random_state + fold)
+    return model
+
+
+def _fit_fold(model, data, train, features_train, predict):
+    """
+    Fits `model` on the `train` rows of `data` and predicts the
+    probability of the positive class of the rows and features of each
+    item of `predict`. Runs in worker processes.
+
+    Returns: tuple of fitted model and dict of predictions.
+    """
+    model.fit(data.take(train, features_train), data.y[train])
+    y_pred = {
+        name: model.predict_proba(data.take(rows, features))[:, 1]
+        for name, (rows, features) in predict.items()
+    }
+    return model, y_pred
+
+
 def _write_to_pickle(model, save_dir, fold):
     path = Path(save_dir)
     path.mkdir(parents=True, exist_ok=True)
@@ -78,58 +134,248 @@ def _write_to_pickle(model, save_dir, fold):
         pickle.dump(model, file)
 
 
-def _save_results(results_all_df, save_dir):
+def _save_results(results_all_df, save_dir, results_format='csv'):
     path = Path(save_dir)
     path.mkdir(parents=True, exist_ok=True)
-    results_filename = os.path.join(save_dir, 'results_all.csv')
-    results_all_df.to_csv(results_filename, index=False)
+    if results_format == 'parquet':
+        # fold of rows predicted by all folds is missing
+        results_all_df.assign(fold=pd.to_numeric(
+            results_all_df['fold'].replace('', np.nan)).astype('Int64')) \
+            .to_parquet(path / 'results_all.parquet', index=False)
+    elif results_format == 'csv':
+        results_filename = os.path.join(save_dir, 'results_all.csv')
+        results_all_df.to_csv(results_filename, index=False)
+    else:
+        raise ValueError('results_format `%s` is not supported'
+                         % results_format)
 
 
-def _update_fold_results(X, y, y_test, y_pred, test, fold, features, features_train, features_test, model):
-    results = pd.DataFrame({'gene_name': y.iloc[test].index.get_level_values('gene_name').values,
-                            'sample': y.iloc[test].index.get_level_values('sample').values,
-                            'tissue': y.iloc[test].index.get_level_values('tissue').values,
-                            'y_pred': y_pred,
-                            'y_test': np.array([i for l in y_test.values.tolist() for i in l]),
-                            'fold': fold})
+def _fold_results(data, tests, y_pred_folds, rows_missing, features, features_train, features_test):
+    """
+    Assembles predictions of the `tests` rows of each fold followed by the
+    mean prediction of all folds for `rows_missing`.
 
-    X_test_all = X[features].iloc[test].fillna(0)
-    for feature in features:
-        results[feature] = X_test_all.iloc[:, features.index(feature)].values
+    Returns: pd.DataFrame of index columns, predictions, labels, fold
+      and features of the rows.
+    """
+    parts = list(tests)
+    if rows_missing is not None:
+        parts.append(rows_missing)
+    rows = np.concatenate(parts)
+    sizes = [len(part) for part in parts]
+    offsets = np.cumsum([0, *sizes])
 
-    if features_train != features_test:
-        X_test_on_train_features = X[features_train].iloc[test].fillna(0)
-        y_pred_on_train_features = model.predict_proba(X_test_on_train_features)[:, 1]
-        results['y_pred_on_train_features'] = y_pred_on_train_features  
-    
-    return results
+    y_pred = np.empty(len(rows))
+    y_pred_on_train_features = np.empty(len(rows))
+    for fold, y_pred_fold in enumerate(y_pred_folds):
+        y_pred[offsets[fold]:offsets[fold + 1]] = y_pred_fold['test']
+        if features_train != features_test:
+            y_pred_on_train_features[offsets[fold]:offsets[fold + 1]] = \
+                y_pred_fold['test_on_train_features']
 
-def _update_results_with_missing(X_missing, y_missing, y_pred_missing_iterm, features, features_train, features_test, models_all, results_all_df):
-    y_pred_missing_iterm_on_train_features = y_pred_missing_iterm
-    for i,m in enumerate(models_all):
-        y_pred_missing_iterm[:,i] = m.predict_proba(X_missing[features_test])[:, 1]
+    fold = np.repeat(np.arange(len(tests)), sizes[:len(tests)])
+    if rows_missing is not None:
+        y_pred[offsets[-2]:] = np.mean(
+            [y_pred_fold['missing'] for y_pred_fold in y_pred_folds], axis=0)
         if features_train != features_test:
-            y_pred_missing_iterm_on_train_features[:,i] = m.predict_proba(X_missing[features_train])[:, 1]
+            y_pred_on_train_features[offsets[-2]:] = np.mean(
+                [y_pred_fold['missing_on_train_features']
+                 for y_pred_fold in y_pred_folds], axis=0)
+        fold = np.concatenate([fold.astype(object),
+                               np.full(len(rows_missing), '', dtype=object)])
 
-    y_pred_missing = np.mean(y_pred_missing_iterm, axis=1)
+    index = data.index.iloc[rows]
+    results = {
+        'gene_name': index['gene_name'].values,
+        'sample': index['sample'].values,
+        'tissue': index['tissue'].values,
+        'y_pred': y_pred,
+        'y_test': data.y[rows],
+        'fold': fold,
+    }
+    X = data.take(rows, features)
+    results.update((feature, X[feature].values) for feature in features)
     if features_train != features_test:
-        y_pred_missing_on_train_features = np.mean(y_pred_missing_iterm_on_train_features, axis=1)
-
-    results_missing = pd.DataFrame({
-                            'gene_name': y_missing.index.get_level_values('gene_name').values,
-                            'sample': y_missing.index.get_level_values('sample').values,
-                            'tissue': y_missing.index.get_level_values('tissue').values,
-                            'y_pred': y_pred_missing,
-                            'y_test': np.array([i for l in y_missing.values.tolist() for i in l]),
-                            'fold': '',
-    })
-    for feature in features:
-        results_missing[feature] = X_missing.values[:, features.index(feature)]
+        results['y_pred_on_train_features'] = y_pred_on_train_features
 
-    if features_train != features_test:
-        results_missing['y_pred_on_train_features'] = y_pred_missing_on_train_features
+    # positions of the rows in their fold
+    position = np.arange(len(rows)) - np.repeat(offsets[:-1], sizes)
+    results = pd.DataFrame(results, index=position)
+    if rows_missing is not None:
+        results = results.reset_index()
+    return results
+
+
+class TrainingData:
+    """
+    Features, labels and index (e.g. gene_name, sample, tissue) of the
+    rows of a training set as arrays, which are memory-mapped if written
+    with `write_training_data`. Subsets of rows are selected by
+    row indices, e.g. the folds of `train_model_ebm`.
+
+    Args:
+      X: array of features (rows x features), missing values are NaN.
+      y: array of labels.
+      index: pd.DataFrame with the index columns of the rows.
+      features: names of the columns of `X`.
+      path: directory of the memory-mapped arrays. Only the path is
+        pickled, so worker processes map the same files.
+    """
+    _meta = 'meta.json'
+    _X = 'X.bin'
+    _y = 'y.bin'
+    _index = 'index.parquet'
+
+    def __init__(self, X, y, index, features, path=None):
+        self.X = X
+        self.y = y
+        self._index_df = index
+        self.features = list(features)
+        self.path = path
+        self._columns = {f: i for i, f in enumerate(self.features)}
+
+    @classmethod
+    def from_df(cls, df, features, label='outlier'):
+        """
+        Args:
+          df: pd.DataFrame with `features` and `label` columns and index
+            levels (e.g. gene_name, sample, tissue).
+        """
+        return cls(
+            X=df[features].to_numpy(dtype=np.float64),
+            y=df[label].to_numpy(),
+            index=df.index.to_frame(index=False),
+            features=features)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Memory-maps the training data written by `write_training_data`.
+        """
+        path = Path(path)
+        with open(path / cls._meta) as f:
+            meta = json.load(f)
+        n_rows = meta['n_rows']
+        features = meta['features']
+
+        def _memmap(name, dtype, shape):
+            if n_rows == 0:
+                return np.empty(shape, dtype=dtype)
+            return np.memmap(path / name, dtype=dtype,
+                             mode=mmap_mode, shape=shape)
+
+        return cls(
+            X=_memmap(cls._X, meta['dtype'], (n_rows, len(features))),
+            y=_memmap(cls._y, meta['label_dtype'], (n_rows,)),
+            index=None, features=features, path=path)
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __getstate__(self):
+        if self.path is not None:
+            return {'path': self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'X' not in state:
+            state = self.load(state['path']).__dict__
+        self.__dict__.update(state)
+
+    @property
+    def index(self):
+        """
+        pd.DataFrame of the index columns, read on first access.
+        """
+        if self._index_df is None:
+            import pyarrow.parquet as pq
+            path = self.path / self._index
+            self._index_df = pq.read_table(
+                path, read_dictionary=pq.read_schema(path).names).to_pandas()
+        return self._index_df
+
+    def groups(self, column):
+        """
+        Returns: np.array of group codes of the rows, ordered as the
+          sorted values of `column`.
+        """
+        values = pd.Categorical(self.index[column])
+        return values.reorder_categories(
+            np.sort(values.categories)).codes
+
+    def isna(self, feature):
+        return np.isnan(self.X[:, self._columns[feature]])
+
+    def take(self, rows, features, fillna=0):
+        """
+        Returns: pd.DataFrame of `features` of `rows`, missing values are
+          filled with `fillna`.
+        """
+        X = self.X[np.ix_(rows, [self._columns[f] for f in features])]
+        if fillna is not None:
+            X[np.isnan(X)] = fillna
+        return pd.DataFrame(X, columns=features)
+
+
+def write_training_data(df, output_path, features, label='outlier',
+                        index=('gene_name', 'sample', 'tissue'),
+                        reader=read_csv, chunksize=1000000,
+                        dtype=np.float32, label_dtype=np.int8):
+    """
+    Writes features, labels and index of the training rows to
+    `output_path`, which can be memory-mapped with `TrainingData.load`.
+    Inputs are read in chunks, so they do not need to fit in memory.
+
+    Args:
+      df: path (csv, tsv, parquet file or directory of parquet files, e.g.
+        `absplice_dna_input` or `absplice_rna_input` written by
+        `StreamingSplicingOutlierResult`), pd.DataFrame or list of them
+        with `features`, `label` and `index` columns or index levels.
+      output_path: output directory.
+      features: feature columns.
+      label: label column.
+      index: columns identifying the rows.
+      reader: reader of other file formats.
+      chunksize: number of rows read at once.
+      dtype: dtype of the feature matrix.
+      label_dtype: dtype of the labels.
+
+    Returns: TrainingData
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    (output_path / TrainingData._meta).unlink(missing_ok=True)
+
+    index = list(index)
+    features = list(features)
+    schema = pa.schema([(c, pa.string()) for c in index])
+    inputs = df if isinstance(df, (list, tuple)) else [df]
+
+    n_rows = 0
+    with open(output_path / TrainingData._X, 'wb') as f_X, \
+            open(output_path / TrainingData._y, 'wb') as f_y, \
+            pq.ParquetWriter(output_path / TrainingData._index, schema) as writer:
+        for df in inputs:
+            for df_chunk in read_chunks(df, chunksize, reader):
+                if any(c in df_chunk.index.names for c in index):
+                    df_chunk = df_chunk.reset_index()
+                df_chunk[features].to_numpy(dtype=dtype).tofile(f_X)
+                df_chunk[label].to_numpy(dtype=label_dtype).tofile(f_y)
+                writer.write_table(pa.Table.from_pandas(
+                    df_chunk[index].astype(str), schema=schema,
+                    preserve_index=False))
+                n_rows += df_chunk.shape[0]
+
+    # written last, so incomplete outputs can not be loaded
+    with open(output_path / TrainingData._meta, 'w') as f:
+        json.dump({
+            'n_rows': n_rows,
+            'features': features,
+            'dtype': np.dtype(dtype).name,
+            'label_dtype': np.dtype(label_dtype).name,
+        }, f)
 
-    results_all_df = pd.concat([results_all_df,
-                                results_missing]).reset_index()
-    
-    return results_all_df
\ No newline at end of file
+    return TrainingData.load(output_path)
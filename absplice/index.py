@@ -0,0 +1,220 @@
+import abc
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from absplice.utils import read_csv, read_chunks, parse_spliceai_info, \
+    empty_spliceai
+
+
+def split_variants(variants):
+    """
+    Splits variants (`chrom:pos:ref>alt`) to chromosomes and positions.
+
+    Returns: tuple of np.array of chromosomes and np.array of positions.
+    """
+    variants = pd.Series(np.asarray(variants, dtype=object), dtype=object)
+    fields = variants.str.split(':', n=2, expand=True)
+    if fields.shape[1] < 2:
+        return np.array([], dtype=object), np.array([], dtype=np.int64)
+    return fields[0].values, fields[1].astype(np.int64).values
+
+
+def read_vcf_variants(vcf_file, chunksize=1000000):
+    """
+    Reads variants (`chrom:pos:ref>alt`) of VCF file.
+    Multiallelic records are split into one variant per ALT.
+    """
+    reader = pd.read_csv(
+        vcf_file, sep='\t', comment='#', header=None, usecols=[0, 1, 3, 4],
+        names=['chrom', 'pos', 'ref', 'alt'], dtype=str, chunksize=chunksize)
+    variants = list()
+    for df in reader:
+        df = df.assign(alt=df['alt'].str.split(',')).explode('alt')
+        variants.append(
+            df['chrom'] + ':' + df['pos'] + ':' + df['ref'] + '>' + df['alt'])
+    if len(variants) == 0:
+        return np.array([], dtype=object)
+    return pd.concat(variants).unique()
+
+
+class VariantTable(abc.ABC):
+    """
+    Table of precomputed predictions which can be queried by variants.
+    """
+
+    @abc.abstractmethod
+    def query(self, variants):
+        """
+        Returns: pd.DataFrame of predictions of `variants`.
+        """
+
+
+class VariantIndex(VariantTable):
+    """
+    Precomputed predictions (e.g. SpliceAI or MMSplice-SpliceMap) stored
+    as one parquet file per chromosome sorted by position (see
+    `write_variant_index`). `query` only reads the row groups whose
+    positions overlap the queried variants.
+
+    Args:
+      path: directory written by `write_variant_index`.
+    """
+    _pos = '_pos'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if not self.path.is_dir():
+            raise FileNotFoundError('%s is not a directory' % self.path)
+        self._files = dict()
+
+    @property
+    def chromosomes(self):
+        return sorted(p.stem for p in self.path.glob('*.parquet'))
+
+    def _file(self, chrom):
+        if chrom not in self._files:
+            import pyarrow.parquet as pq
+            path = self.path / ('%s.parquet' % chrom)
+            if not path.exists():
+                self._files[chrom] = None
+            else:
+                pf = pq.ParquetFile(path)
+                i = pf.schema_arrow.get_field_index(self._pos)
+                stats = [pf.metadata.row_group(j).column(i).statistics
+                         for j in range(pf.num_row_groups)]
+                self._files[chrom] = (
+                    pf,
+                    np.array([s.min for s in stats], dtype=np.int64),
+                    np.array([s.max for s in stats], dtype=np.int64))
+        return self._files[chrom]
+
+    def _empty(self):
+        import pyarrow.parquet as pq
+        path = next(self.path.glob('*.parquet'), None)
+        if path is None:
+            # index of no predictions
+            return pd.DataFrame({'variant': pd.Series(dtype=object)})
+        return pq.read_schema(path).empty_table().to_pandas() \
+            .drop(columns=self._pos)
+
+    def query(self, variants):
+        """
+        Returns: pd.DataFrame of predictions of `variants`.
+        """
+        variants = pd.unique(np.asarray(variants, dtype=object))
+        chroms, positions = split_variants(variants)
+
+        dfs = list()
+        for chrom in pd.unique(chroms):
+            index = self._file(chrom)
+            if index is None:
+                continue
+            pf, pos_min, pos_max = index
+            pos = np.sort(positions[chroms == chrom])
+            # row groups containing at least one of the positions
+            i = np.searchsorted(pos, pos_min)
+            row_groups = np.flatnonzero(
+                (i < len(pos)) & (pos[np.minimum(i, len(pos) - 1)] <= pos_max))
+            if len(row_groups) == 0:
+                continue
+            df = pf.read_row_groups(row_groups.tolist()).to_pandas()
+            dfs.append(df[df['variant'].isin(variants)])
+
+        if len(dfs) == 0:
+            return self._empty()
+        return pd.concat(dfs, ignore_index=True).drop(columns=self._pos)
+
+
+def write_variant_index(df, output_path, reader=read_csv, chunksize=1000000,
+                        row_group_size=10000):
+    """
+    Writes predictions to `output_path` as one parquet file per chromosome,
+    sorted by position of the variant, which can be queried with
+    `VariantIndex`.
+
+    Args:
+      df: path (csv, tsv, SpliceAI vcf, parquet file or directory of
+        parquet files) or pd.DataFrame of predictions with variant column.
+      output_path: output directory.
+      reader: reader of other file formats (e.g. `read_spliceai`).
+      chunksize: number of rows read at once.
+      row_group_size: number of rows of the parquet row groups. Queries
+        read complete row groups.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    spill_dir = Path(tempfile.mkdtemp(dir=output_path))
+
+    try:
+        chromosomes = dict()
+        for i, df_chunk in enumerate(read_chunks(df, chunksize, reader)):
+            chroms, positions = split_variants(df_chunk['variant'])
+            df_chunk = df_chunk.assign(**{VariantIndex._pos: positions})
+            for chrom, df_chrom in df_chunk.groupby(chroms, sort=False):
+                path = spill_dir / str(chrom)
+                path.mkdir(exist_ok=True)
+                chromosomes[chrom] = path
+                df_chrom.to_parquet(
+                    path / ('chunk-%05d.parquet' % i), index=False)
+
+        for chrom, path in chromosomes.items():
+            table = pa.concat_tables([
+                pq.read_table(p) for p in sorted(path.glob('*.parquet'))])
+            table = table.sort_by([(VariantIndex._pos, 'ascending'),
+                                   ('variant', 'ascending')])
+            pq.write_table(table, output_path / ('%s.parquet' % chrom),
+                           row_group_size=row_group_size)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    return VariantIndex(output_path)
+
+
+class SpliceAIVcfIndex(VariantTable):
+    """
+    Precomputed SpliceAI predictions in a bgzipped and tabix-indexed VCF
+    file. `query` reads the records at the positions of the variants.
+
+    Args:
+      path: path of the VCF file with tabix index (`.tbi` or `.csi`).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._vcf = None
+
+    def _fetch(self, chrom, pos):
+        if self._vcf is None:
+            try:
+                from cyvcf2 import VCF
+            except ImportError:
+                raise ImportError(
+                    '`SpliceAIVcfIndex` requires cyvcf2, install it with'
+                    ' `pip install absplice[index]` or `pip install cyvcf2`')
+            self._vcf = VCF(str(self.path), lazy=True)
+        return self._vcf('%s:%d-%d' % (chrom, pos, pos))
+
+    def query(self, variants):
+        """
+        Returns: pd.DataFrame of SpliceAI predictions of `variants`.
+        """
+        variants = pd.unique(np.asarray(variants, dtype=object))
+        chroms, positions = split_variants(variants)
+
+        records = list()
+        for chrom, pos in set(zip(chroms, positions)):
+            for record in self._fetch(chrom, pos):
+                if record.POS == pos:
+                    records.append(str(record).rstrip('\n').split('\t'))
+
+        if len(records) == 0:
+            return empty_spliceai()
+        df = pd.DataFrame([r[:8] for r in records], columns=[
+            'chrom', 'pos', 'id', 'ref', 'alt', 'qual', 'filter', 'info'])
+        df = parse_spliceai_info(df)
+        return df[df['variant'].isin(variants)].reset_index(drop=True)
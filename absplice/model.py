@@ -1,14 +1,66 @@
 from tqdm import tqdm
 import pandas as pd
+import json
+import logging
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import shutil
+import tempfile
+import time
 try:
     from mmsplice import MMSplice
     from mmsplice.utils import df_batch_writer, df_batch_writer_parquet, delta_logit_PSI_to_delta_PSI
 except ImportError:
     pass
+from absplice.dataloader import SpliceOutlierDataloader, BatchPrefetcher
 from absplice.result import SplicingOutlierResult
 from pathlib import Path
 import pathlib
 
+logger = logging.getLogger(__name__)
+
+# `SpliceOutlier` of the worker process, shared by all partitions it predicts
+_worker_model = None
+
+
+def _predict_partition(fasta_file, vcf_file, splicemaps5, splicemaps3,
+                       clip_threshold=None, batch_size=512, output_path=None,
+                       dataloader_kwargs=None, prefetch=0, num_workers=1):
+    """
+    Predicts variants of one partition of the SpliceMaps in a worker process.
+
+    Returns: pd.DataFrame of predictions (None if there is no prediction),
+      or path of the written file if `output_path` is given.
+    """
+    global _worker_model
+    if _worker_model is None or _worker_model.clip_threshold != clip_threshold:
+        _worker_model = SpliceOutlier(clip_threshold=clip_threshold)
+
+    df = _worker_model._predict_splicemaps(
+        fasta_file, vcf_file, splicemaps5, splicemaps3, batch_size=batch_size,
+        prefetch=prefetch, num_workers=num_workers,
+        dataloader_kwargs=dataloader_kwargs)
+    if df is None or output_path is None:
+        return df
+    return _write_partition(df, output_path)
+
+
+def _write_partition(df, output_path):
+    if output_path.suffix.lower() == '.csv':
+        df.to_csv(output_path, index=False)
+    else:
+        df.to_parquet(output_path, index=False, engine='pyarrow')
+    return output_path
+
+
+def _write_manifest(path, manifest):
+    # replaced atomically, so the manifest is complete if the job is killed
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
 
 class SpliceOutlier:
 
@@ -47,41 +99,303 @@ class SpliceOutlier:
         )
 
     def _add_delta_psi(self, df, dl):
-        return pd.concat([
-            self._add_delta_event(df, dl.splicemaps5, 'psi5'),
-            self._add_delta_event(df, dl.splicemaps3, 'psi3')
-        ])
+        dfs = list()
+        if dl.combined_splicemap5 is not None:
+            dfs.append(self._add_delta_event(df, dl.splicemaps5, 'psi5'))
+        if dl.combined_splicemap3 is not None:
+            dfs.append(self._add_delta_event(df, dl.splicemaps3, 'psi3'))
+        return pd.concat(dfs)
+
+    def _predict_splicemaps(self, fasta_file, vcf_file, splicemaps5, splicemaps3,
+                            batch_size=512, prefetch=0, num_workers=1,
+                            dataloader_kwargs=None):
+        """
+        Predicts variants of `vcf_file` on the given SpliceMaps
+        (e.g. one partition of `partition_by_chromosome`).
+        `dataloader_kwargs` are the other arguments of `SpliceOutlierDataloader`.
+
+        Returns: pd.DataFrame of predictions or None if there is no prediction.
+        """
+        dataloader = SpliceOutlierDataloader(
+            fasta_file, vcf_file, splicemap5=splicemaps5, splicemap3=splicemaps3,
+            **(dataloader_kwargs or dict()))
+        dfs = list(self._predict_on_dataloader(
+            dataloader, batch_size=batch_size, progress=False,
+            prefetch=prefetch, num_workers=num_workers))
+        if len(dfs) == 0:
+            return None
+        return pd.concat(dfs)
 
     def predict_on_batch(self, batch, dataloader):
         columns = batch['metadata']['junction'].keys()
         df = self.mmsplice._predict_batch(batch, columns)
         del df['exons']
         df = df.rename(columns={'ID': 'variant'})
+        if dataloader.prediction_cache is not None:
+            dataloader.prediction_cache.add(df)
         df_with_delta_psi = self._add_delta_psi(df, dataloader)
         return df_with_delta_psi
 
     def _predict_on_dataloader(self, dataloader,
-                               batch_size=512, progress=True):
-        dt_iter = dataloader.batch_iter(batch_size=batch_size)
-        if progress:
-            dt_iter = tqdm(dt_iter)
+                               batch_size=512, progress=True,
+                               prefetch=0, num_workers=1):
+        if prefetch > 0:
+            yield from self._predict_prefetch(
+                dataloader, batch_size, progress, prefetch, num_workers)
+        else:
+            dt_iter = dataloader.batch_iter(batch_size=batch_size)
+            if progress:
+                dt_iter = tqdm(dt_iter)
+
+            for batch in dt_iter:
+                yield self.predict_on_batch(batch, dataloader)
+
+        if dataloader.prediction_cache is not None:
+            yield from self._predict_cached(dataloader)
+
+    def _predict_cached(self, dataloader):
+        """
+        Predictions of the rows skipped by `dataloader` because they are in
+        its `prediction_cache`, joined with the SpliceMaps of the dataloader.
+        """
+        cache = dataloader.prediction_cache
+        cache.flush()
+        if len(dataloader.cached_keys) == 0:
+            return
+        df = cache.query(dataloader.cached_keys)
+        yield self._add_delta_psi(df, dataloader)
+
+    def _predict_prefetch(self, dataloader, batch_size=512, progress=True,
+                          prefetch=4, num_workers=1):
+        """
+        Predicts batches while the next `prefetch` batches are extracted
+        and encoded in background threads (see `BatchPrefetcher`).
+        Seconds spent in each stage are stored in `self.timings` and
+        logged at INFO level.
+        """
+        prefetcher = BatchPrefetcher(
+            dataloader, batch_size=batch_size,
+            queue_size=prefetch, num_workers=num_workers)
+        dt_iter = tqdm(prefetcher) if progress else prefetcher
 
+        self.timings = {'predict': 0.}
+        start = time.perf_counter()
         for batch in dt_iter:
-            yield self.predict_on_batch(batch, dataloader)
+            start_predict = time.perf_counter()
+            df = self.predict_on_batch(batch, dataloader)
+            self.timings['predict'] += time.perf_counter() - start_predict
+            yield df
 
-    def predict_on_dataloader(self, dataloader, batch_size=512, progress=True):
-        return SplicingOutlierResult(pd.concat(
-            self._predict_on_dataloader(
-                dataloader,
-                batch_size=batch_size,
-                progress=progress)
-        ))
+        self.timings.update(prefetcher.timings)
+        self.timings['total'] = time.perf_counter() - start
+        logger.info('Batches: %d, %s', prefetcher.num_batches, ', '.join(
+            '%s: %.2fs' % (k, v) for k, v in self.timings.items()))
+
+    def _predict_parallel(self, dataloader, batch_size=512, progress=True,
+                          n_jobs=2, output_dir=None, suffix='.parquet',
+                          prefetch=0, num_workers=1):
+        """
+        Predicts partitions of the dataloader (one per chromosome) in
+        `n_jobs` worker processes. Each worker has its own `MMSplice`
+        and fasta/vcf handles.
+
+        Yields results of `_predict_partition` in order of the partitions.
+        """
+        partitions = dataloader.partition_by_chromosome()
+        # spawn: tensorflow is not fork-safe once initialized in the parent
+        context = multiprocessing.get_context('spawn')
+
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as executor:
+            futures = [
+                executor.submit(
+                    _predict_partition,
+                    dataloader.fasta_file, dataloader.vcf_file,
+                    splicemaps5, splicemaps3,
+                    clip_threshold=self.clip_threshold,
+                    batch_size=batch_size,
+                    dataloader_kwargs=dataloader._init_kwargs,
+                    prefetch=prefetch, num_workers=num_workers,
+                    output_path=None if output_dir is None
+                    else output_dir / f'part-{i:05d}{suffix}')
+                for i, (_, splicemaps5, splicemaps3) in enumerate(partitions)
+            ]
+            if progress:
+                futures = tqdm(futures)
+
+            for future in futures:
+                result = future.result()
+                if result is not None:
+                    yield result
+
+    def predict_on_dataloader(self, dataloader, batch_size=512, progress=True,
+                              n_jobs=1, prefetch=0, num_workers=1):
+        """
+        n_jobs: number of worker processes (see `predict_save`).
+        prefetch: number of batches extracted and encoded in background
+          threads while the model predicts the current batch. Disabled if 0.
+        num_workers: number of threads encoding the prefetched batches.
+          If `n_jobs` is larger than 1, each worker process prefetches the
+          batches of its partitions.
+
+        If the dataloader has a `prediction_cache`, only rows which are
+        not cached are predicted and added to the cache. Cached rows are
+        joined with the SpliceMaps and follow the predicted rows.
+        """
+        if n_jobs > 1:
+            df_iter = self._predict_parallel(
+                dataloader, batch_size=batch_size, progress=progress,
+                n_jobs=n_jobs, prefetch=prefetch, num_workers=num_workers)
+        else:
+            df_iter = self._predict_on_dataloader(
+                dataloader, batch_size=batch_size, progress=progress,
+                prefetch=prefetch, num_workers=num_workers)
+        return SplicingOutlierResult(pd.concat(df_iter))
 
     def predict_save(self, dataloader, output_path,
-                     batch_size=512, progress=True):
+                     batch_size=512, progress=True, n_jobs=1,
+                     prefetch=0, num_workers=1, resume=False):
+        """
+        Writes predictions to `output_path`. If the suffix is `.csv`, a single
+        csv file is written. If the suffix is `.parquet`, `output_path` is a
+        directory of parquet files.
+
+        n_jobs: number of worker processes. If larger than 1, the SpliceMaps
+          are partitioned by chromosome and predicted in parallel. The csv
+          output is merged in order of the partitions, the parquet output
+          contains one `part-xxxxx.parquet` file per non-empty partition.
+        prefetch, num_workers: see `predict_on_dataloader`.
+        resume: checkpoints the prediction of each chromosome partition
+          (only parquet output). Predictions of a partition are written to
+          `part-xxxxx.parquet` which is renamed into place once complete
+          and recorded in `_manifest.json`. Rerunning with `resume=True`
+          skips the partitions already recorded, so killed jobs continue
+          where they stopped.
+        """
         if not isinstance(output_path, pathlib.PosixPath):
             output_path = Path(output_path)
-        if output_path.suffix.lower() == '.csv':
-            df_batch_writer(self._predict_on_dataloader(dataloader), output_path)
-        elif output_path.suffix.lower() == '.parquet':
-            df_batch_writer_parquet(self._predict_on_dataloader(dataloader), output_path)
+
+        if resume:
+            if output_path.suffix.lower() != '.parquet':
+                raise ValueError('`resume` is only supported for parquet output')
+            self._predict_save_checkpoint(
+                dataloader, output_path, batch_size, progress, n_jobs,
+                prefetch, num_workers)
+            return
+
+        if n_jobs > 1:
+            if output_path.suffix.lower() == '.csv':
+                self._predict_save_csv_parallel(
+                    dataloader, output_path, batch_size, progress, n_jobs,
+                    prefetch, num_workers)
+            elif output_path.suffix.lower() == '.parquet':
+                output_path.mkdir(parents=True, exist_ok=True)
+                for _ in self._predict_parallel(
+                        dataloader, batch_size=batch_size, progress=progress,
+                        n_jobs=n_jobs, output_dir=output_path, suffix='.parquet',
+                        prefetch=prefetch, num_workers=num_workers):
+                    pass
+        else:
+            df_iter = self._predict_on_dataloader(
+                dataloader, batch_size=batch_size, progress=progress,
+                prefetch=prefetch, num_workers=num_workers)
+            if output_path.suffix.lower() == '.csv':
+                df_batch_writer(df_iter, output_path)
+            elif output_path.suffix.lower() == '.parquet':
+                df_batch_writer_parquet(df_iter, output_path)
+
+    def _predict_save_csv_parallel(self, dataloader, output_path,
+                                   batch_size=512, progress=True, n_jobs=2,
+                                   prefetch=0, num_workers=1):
+        shard_dir = Path(tempfile.mkdtemp(dir=output_path.parent))
+        try:
+            with open(output_path, 'w') as f_out:
+                header = True
+                for shard in self._predict_parallel(
+                        dataloader, batch_size=batch_size, progress=progress,
+                        n_jobs=n_jobs, output_dir=shard_dir, suffix='.csv',
+                        prefetch=prefetch, num_workers=num_workers):
+                    with open(shard) as f_in:
+                        if not header:
+                            f_in.readline()
+                        shutil.copyfileobj(f_in, f_out)
+                    header = False
+                    shard.unlink()
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    def _predict_save_checkpoint(self, dataloader, output_path, batch_size=512,
+                                 progress=True, n_jobs=1, prefetch=0,
+                                 num_workers=1):
+        output_path.mkdir(parents=True, exist_ok=True)
+        manifest_path = output_path / '_manifest.json'
+
+        partitions = dataloader.partition_by_chromosome()
+        manifest = {
+            'fasta_file': str(dataloader.fasta_file),
+            'vcf_file': str(dataloader.vcf_file),
+            'chromosomes': [chromosome for chromosome, _, _ in partitions],
+            # chromosome -> written part (None if there is no prediction)
+            'completed': dict(),
+        }
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                previous = json.load(f)
+            if any(previous.get(key) != manifest[key]
+                   for key in ['fasta_file', 'vcf_file', 'chromosomes']):
+                raise ValueError(
+                    '%s was written for other inputs' % manifest_path)
+            manifest['completed'] = previous['completed']
+
+        pending = [
+            (i, chromosome, splicemaps5, splicemaps3)
+            for i, (chromosome, splicemaps5, splicemaps3) in enumerate(partitions)
+            if chromosome not in manifest['completed']
+        ]
+        pbar = tqdm(total=len(pending)) if progress else None
+
+        def _commit(i, chromosome, tmp_path):
+            part = None
+            if tmp_path is not None:
+                part = f'part-{i:05d}.parquet'
+                os.replace(tmp_path, output_path / part)
+            manifest['completed'][chromosome] = part
+            _write_manifest(manifest_path, manifest)
+            if pbar is not None:
+                pbar.update()
+
+        def _tmp_path(i):
+            # hidden from parquet readers until renamed
+            return output_path / f'.part-{i:05d}.parquet.tmp'
+
+        _write_manifest(manifest_path, manifest)
+        try:
+            if n_jobs > 1:
+                context = multiprocessing.get_context('spawn')
+                with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as executor:
+                    futures = {
+                        executor.submit(
+                            _predict_partition,
+                            dataloader.fasta_file, dataloader.vcf_file,
+                            splicemaps5, splicemaps3,
+                            clip_threshold=self.clip_threshold,
+                            batch_size=batch_size,
+                            dataloader_kwargs=dataloader._init_kwargs,
+                            prefetch=prefetch, num_workers=num_workers,
+                            output_path=_tmp_path(i)): (i, chromosome)
+                        for i, chromosome, splicemaps5, splicemaps3 in pending
+                    }
+                    # partitions are committed as soon as they are completed
+                    for future in as_completed(futures):
+                        _commit(*futures[future], future.result())
+            else:
+                for i, chromosome, splicemaps5, splicemaps3 in pending:
+                    df = self._predict_splicemaps(
+                        dataloader.fasta_file, dataloader.vcf_file,
+                        splicemaps5, splicemaps3, batch_size=batch_size,
+                        prefetch=prefetch, num_workers=num_workers,
+                        dataloader_kwargs=dataloader._init_kwargs)
+                    _commit(i, chromosome, None if df is None
+                            else _write_partition(df, _tmp_path(i)))
+        finally:
+            if pbar is not None:
+                pbar.close()
@@ -1,23 +1,68 @@
-import resource
-from pkg_resources import resource_filename
+import os
+import threading
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
 import pickle
 from pathlib import Path
 import pathlib
-from absplice.utils import get_abs_max_rows, normalize_gene_annotation, \
-    read_csv, read_spliceai
-from absplice.cat_dataloader import CatInference
-
-GENE_MAP = resource_filename(
-    'absplice', 'precomputed/GENE_MAP.tsv.gz')
-GENE_TPM = resource_filename(
-    'absplice', 'precomputed/GENE_TPM.csv.gz')
-ABSPLICE_DNA = resource_filename(
-    'absplice', 'precomputed/AbSplice_DNA.pkl')
-ABSPLICE_RNA = resource_filename(
-    'absplice', 'precomputed/AbSplice_RNA.pkl')
+from absplice.utils import GroupKeyCache, VariantSamples, \
+    normalize_gene_annotation, read_csv, read_spliceai, group_abs_argmax, \
+    group_nunique
+from absplice.scorer import EBMScorer
+from absplice.index import VariantTable, read_vcf_variants
+
+PRECOMPUTED_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'precomputed')
+
+GENE_MAP = os.path.join(PRECOMPUTED_DIR, 'GENE_MAP.tsv.gz')
+GENE_TPM = os.path.join(PRECOMPUTED_DIR, 'GENE_TPM.csv.gz')
+ABSPLICE_DNA = os.path.join(PRECOMPUTED_DIR, 'AbSplice_DNA.pkl')
+ABSPLICE_RNA = os.path.join(PRECOMPUTED_DIR, 'AbSplice_RNA.pkl')
+ABSPLICE_DNA_SCORER = os.path.join(PRECOMPUTED_DIR, 'AbSplice_DNA.npz')
+ABSPLICE_RNA_SCORER = os.path.join(PRECOMPUTED_DIR, 'AbSplice_RNA.npz')
+
+_models = dict()
+_models_lock = threading.Lock()
+
+
+def load_model(pickle_file):
+    """
+    Loads pickled model, or `EBMScorer` if the file is `.npz` (see
+    `absplice.scorer.export_ebm`). Models are cached process-wide by path
+    and modification time of the file, so the file is loaded once and again
+    only if the file changes. Thread-safe.
+    """
+    path = os.path.abspath(pickle_file)
+    key = (path, os.path.getmtime(path))
+
+    with _models_lock:
+        if key not in _models:
+            if path.endswith('.npz'):
+                model = EBMScorer.load(path)
+            else:
+                with open(path, 'rb') as f:
+                    model = pickle.load(f)
+            for k in [k for k in _models if k[0] == path]:
+                del _models[k]
+            _models[key] = model
+        return _models[key]
+
+
+def preload_models(pickle_files=None):
+    """
+    Loads models into the cache of `load_model`, e.g. at startup of a
+    service. Defaults to AbSplice-DNA and AbSplice-RNA scorers.
+    """
+    if pickle_files is None:
+        pickle_files = [ABSPLICE_DNA_SCORER, ABSPLICE_RNA_SCORER]
+    return [load_model(pickle_file) for pickle_file in pickle_files]
+
+
+def clear_model_cache():
+    with _models_lock:
+        _models.clear()
+
 
 dtype_columns = {
     'variant': pd.StringDtype(),
@@ -57,6 +102,55 @@ dtype_columns = {
     'AbSplice_RNA': 'float64',
 }
 
+# `compact=True`: low cardinality string columns are categoricals with
+# categories shared across tables, scores are float32, counts Int32
+dtype_columns_compact = {
+    **dtype_columns,
+    **{col: 'category' for col in [
+        'variant', 'gene_id', 'tissue', 'sample', 'Chromosome', 'Strand',
+        'junction', 'event_type', 'splice_site', 'gene_name',
+        'gene_name_spliceai', 'tissue_cat']},
+    **{col: 'float32' for col in [
+        'delta_logit_psi', 'delta_psi', 'ref_psi', 'median_n', 'delta_score',
+        'gene_tpm', 'median_n_cat', 'psi_cat', 'ref_psi_cat',
+        'delta_logit_psi_cat', 'delta_psi_cat', 'AbSplice_DNA',
+        'AbSplice_RNA']},
+    **{col: 'Int32' for col in ['Start', 'End', 'k', 'n', 'k_cat', 'n_cat']},
+}
+
+# columns sharing the categories of another column
+_shared_categories = {
+    'gene_name_spliceai': 'gene_name',
+    'tissue_cat': 'tissue',
+}
+
+# columns of the predictions used by AbSplice, which are the only columns
+# read if `all_columns=False`
+required_columns = {
+    'df_mmsplice': [
+        'variant', 'gene_id', 'tissue', 'gene_tpm',
+        'Chromosome', 'Start', 'End', 'Strand', 'junction', 'event_type',
+        'splice_site', 'gene_name', 'delta_logit_psi', 'delta_psi', 'ref_psi',
+        'k', 'n', 'median_n', 'novel_junction', 'weak_site_donor',
+        'weak_site_acceptor'],
+    'df_mmsplice_cat': [
+        'variant', 'gene_id', 'tissue', 'sample', 'gene_tpm', 'junction',
+        'delta_psi', 'ref_psi', 'median_n', 'tissue_cat', 'count_cat',
+        'k_cat', 'n_cat', 'median_n_cat', 'psi_cat', 'ref_psi_cat',
+        'delta_logit_psi_cat', 'delta_psi_cat'],
+    'df_spliceai': [
+        'variant', 'gene_name', 'delta_score'],
+}
+
+# columns which are also read if the predictions have them: samples of
+# predictions already joined with samples and gene_id of SpliceAI
+# predictions already annotated with genes
+optional_columns = {
+    'df_mmsplice': ['sample'],
+    'df_mmsplice_cat': [],
+    'df_spliceai': ['gene_id', 'sample'],
+}
+
 
 class SplicingOutlierResult:
 
@@ -71,8 +165,43 @@ class SplicingOutlierResult:
                  df_absplice_rna_input=None,
                  df_absplice_dna=None,
                  df_absplice_rna=None,
+                 tissues=None,
+                 variants=None,
+                 compact=False,
+                 all_columns=True,
+                 sparse_samples=False,
                  ):
+        """
+        tissues: tissues to which tissue independent SpliceAI predictions
+          are copied. Defaults to tissues of `df_mmsplice`.
+        variants: list of variants or path of VCF file. Only predictions
+          of these variants are read if `df_mmsplice` or `df_spliceai` is
+          a `VariantTable` (e.g. `VariantIndex`, `SpliceAIVcfIndex`).
+          Defaults to variants of `df_var_samples`.
+        compact: if True, stores low cardinality string columns as
+          categoricals with categories shared across all tables, scores
+          as float32 and counts as Int32 (see `dtype_columns_compact`).
+          Scores are rounded to float32 precision. See `memory_usage`.
+        all_columns: if False, only the columns used by AbSplice (see
+          `required_columns` and `optional_columns`) of `df_mmsplice`,
+          `df_mmsplice_cat` and `df_spliceai` are read from files.
+        sparse_samples: if True, predictions are not joined with
+          `df_var_samples` but stay per variant and samples are stored as
+          sparse variant x sample mapping (`var_samples`). Aggregations by
+          sample are computed on the mapping and only their results are
+          materialized per sample. AbSplice-DNA is predicted per variant,
+          use `expand_samples` to get per sample rows of the results.
+        """
+        self.tissues = tissues
+        self.variants = variants
+        self.compact = compact
+        self.all_columns = all_columns
+        self.sparse_samples = sparse_samples
+        self._categories = dict()
+        if compact and tissues is not None:
+            self._add_categories('tissue', pd.Series(tissues))
         self.df_var_samples = self.validate_df_var_samples(df_var_samples)
+        self.var_samples = self._variant_samples()
         self.df_mmsplice = self.validate_df_mmsplice(df_mmsplice)
         self.df_mmsplice_cat = self.validate_df_mmsplice_cat(df_mmsplice_cat)
         self.gene_map = self.validate_df_gene_map(gene_map)
@@ -85,7 +214,6 @@ class SplicingOutlierResult:
         self._absplice_dna = self.validate_absplice_dna(df_absplice_dna)
         self._absplice_rna = self.validate_absplice_rna(df_absplice_rna)
         self.contains_chr = self._contains_chr()
-        self._df_spliceai_tissue = None
         self._junction = None
         self._splice_site = None
         self._gene_mmsplice = None
@@ -98,28 +226,145 @@ class SplicingOutlierResult:
         self._variant_spliceai = None
         self._variant_absplice_dna = None
         self._variant_absplice_rna = None
+        self._group_key_caches = dict()
+        self._absplice_dna_kwargs = dict()
+        self._absplice_rna_kwargs = dict()
+        if compact:
+            self._share_categories()
 
-    def _validate_df(self, df, columns):
+    @property
+    def _dtype_columns(self):
+        return dtype_columns_compact if self.compact else dtype_columns
+
+    def _usecols(self, name):
+        if self.all_columns:
+            return None
+        return [*required_columns[name], *optional_columns[name]]
+
+    def _validate_df(self, df, columns, usecols=None, reader=read_csv):
+        """
+        Reads `df` if it is a path with the dtypes of `dtype_columns`
+        (and only `usecols` if given), and checks required `columns`.
+        """
         if not isinstance(df, pd.DataFrame):
-            df = read_csv(df)
-        df = df.reset_index()
+            # categories are shared across tables, see `_validate_dtype`
+            dtype = {col: t for col, t in self._dtype_columns.items()
+                     if t != 'category'}
+            df = reader(df, columns=usecols, dtype=dtype)
+        else:
+            # columns are added to `df` (e.g. `normalize_gene_annotation`)
+            df = df.copy(deep=False)
+        if not df.index.equals(pd.RangeIndex(df.shape[0])):
+            df = df.reset_index()
         if 'index' in df.columns:
             df = df.drop(columns='index')
         assert pd.Series(columns).isin(df.columns).all()
         return df
 
-    def _validate_dtype(self, df):
+    def _validate_dtype(self, df, shared=True):
+        """
+        Casts columns of `df` to the dtypes of `dtype_columns` in a single
+        pass. Categoricals of lookup tables (gene_map, gene_tpm) do not
+        share categories (`shared=False`), so all genes of the tables are
+        not added to the categories of the predictions.
+        """
+        dtypes = dict()
+        for col in df.columns:
+            dtype = self._dtype_columns.get(col)
+            if dtype == 'category' and shared:
+                if not pd.api.types.is_string_dtype(df[col]) \
+                        and not pd.api.types.is_categorical_dtype(df[col]):
+                    df = df.astype({col: pd.StringDtype()})
+                dtype = self._add_categories(col, df[col])
+            if dtype is not None and df[col].dtype != dtype:
+                dtypes[col] = dtype
+        # columns read with their dtypes are not copied
+        if len(dtypes) == 0:
+            return df
+        return df.astype(dtypes)
+
+    def _add_categories(self, col, values):
+        """
+        Adds values to the sorted categories shared by columns `col`.
+        Returns: categorical dtype with the categories.
+        """
+        key = _shared_categories.get(col, col)
+        if pd.api.types.is_categorical_dtype(values):
+            values = values.cat.categories
+        else:
+            values = pd.Index(pd.unique(values.dropna()), dtype=object)
+        if key in self._categories:
+            values = self._categories[key].union(values)
+        else:
+            values = values.sort_values()
+        self._categories[key] = values
+        return pd.CategoricalDtype(values)
+
+    def _share_categories(self, df=None):
+        """
+        Sets the shared categories of categorical columns of `df`, or of
+        all tables if `df` is None, so that joins keep categoricals.
+        """
+        if df is None:
+            for name in ['df_var_samples', 'df_mmsplice', 'df_mmsplice_cat',
+                         'df_spliceai', '_absplice_dna_input',
+                         '_absplice_rna_input', '_absplice_dna',
+                         '_absplice_rna']:
+                if getattr(self, name) is not None:
+                    setattr(self, name, self._share_categories(getattr(self, name)))
+            return
+
         for col in df.columns:
-            if col in dtype_columns.keys():
-                df = df.astype({col: dtype_columns[col]})
+            key = _shared_categories.get(col, col)
+            if key in self._categories \
+                    and pd.api.types.is_categorical_dtype(df[col]) \
+                    and not df[col].cat.categories.equals(self._categories[key]):
+                df = df.assign(**{col: df[col].cat.set_categories(
+                    self._categories[key])})
         return df
 
+    def memory_usage(self):
+        """
+        Memory usage (MB) of the tables of the result.
+
+        Returns: pd.Series of memory usage by table.
+        """
+        tables = {
+            'df_mmsplice': self.df_mmsplice,
+            'df_mmsplice_cat': self.df_mmsplice_cat,
+            'df_spliceai': self.df_spliceai,
+            'df_var_samples': self.df_var_samples,
+            'gene_map': self.gene_map,
+            'gene_tpm': self.gene_tpm,
+            'absplice_dna_input': self._absplice_dna_input,
+            'absplice_rna_input': self._absplice_rna_input,
+            'absplice_dna': self._absplice_dna,
+            'absplice_rna': self._absplice_rna,
+        }
+        return pd.Series({
+            name: df.memory_usage(index=True, deep=True).sum() / 1e6
+            for name, df in tables.items() if df is not None
+        }, name='MB', dtype='float64')
+
+    def _query_variants(self):
+        if self.variants is not None:
+            if isinstance(self.variants, (str, pathlib.PurePath)):
+                self.variants = read_vcf_variants(self.variants)
+            return self.variants
+        if self.df_var_samples is not None:
+            return self.df_var_samples['variant'].unique()
+        raise ValueError('`variants` or `df_var_samples` are required '
+                         'to query predictions of a `VariantTable`')
+
     def validate_df_mmsplice(self, df_mmsplice):
+        if isinstance(df_mmsplice, VariantTable):
+            df_mmsplice = df_mmsplice.query(self._query_variants())
         if df_mmsplice is not None:
             df_mmsplice = self._validate_df(
                 df_mmsplice,
                 columns=['variant', 'gene_id', 'tissue',
-                         'delta_psi', 'ref_psi', 'median_n', 'gene_tpm'])
+                         'delta_psi', 'ref_psi', 'median_n', 'gene_tpm'],
+                usecols=self._usecols('df_mmsplice'))
             df_mmsplice = self._validate_dtype(df_mmsplice)
             if self.df_var_samples is not None:
                 df_mmsplice = self._add_samples(df_mmsplice)
@@ -131,7 +376,8 @@ class SplicingOutlierResult:
                 df_mmsplice_cat,
                 columns=['variant', 'gene_id', 'tissue',
                          'delta_psi', 'ref_psi', 'median_n', 'gene_tpm',
-                         'tissue_cat', 'delta_psi_cat'])
+                         'tissue_cat', 'delta_psi_cat'],
+                usecols=self._usecols('df_mmsplice_cat'))
             df_mmsplice_cat = self._validate_dtype(df_mmsplice_cat)
             df_mmsplice_cat = df_mmsplice_cat[
                 ~df_mmsplice_cat['delta_psi_cat'].isna()
@@ -139,11 +385,14 @@ class SplicingOutlierResult:
         return df_mmsplice_cat
 
     def validate_df_spliceai(self, df_spliceai):
+        if isinstance(df_spliceai, VariantTable):
+            df_spliceai = df_spliceai.query(self._query_variants())
         if df_spliceai is not None:
-            df_spliceai = read_spliceai(df_spliceai)
             df_spliceai = self._validate_df(
                 df_spliceai,
-                columns=['variant', 'gene_name', 'delta_score'])
+                columns=['variant', 'gene_name', 'delta_score'],
+                usecols=self._usecols('df_spliceai'),
+                reader=read_spliceai)
             if self.gene_map is not None:
                 df_spliceai = normalize_gene_annotation(
                     df_spliceai, self.gene_map, key='gene_name', value='gene_id')
@@ -156,24 +405,22 @@ class SplicingOutlierResult:
         if df_var_samples is not None:
             df_var_samples = self._validate_df(
                 df_var_samples,
-                columns=['variant', 'sample'])
+                columns=['variant', 'sample'],
+                usecols=['variant', 'sample'])
             df_var_samples = self._validate_dtype(df_var_samples)
             df_var_samples = df_var_samples[[
                 'variant', 'sample']].drop_duplicates()
         return df_var_samples
 
     def validate_df_gene_tpm(self, gene_tpm):
-        if gene_tpm is not None:
-            gene_tpm = self._validate_df(
-                gene_tpm,
-                columns=['gene_id', 'tissue', 'gene_tpm'])
-            gene_tpm = gene_tpm[['gene_id', 'tissue', 'gene_tpm']]
-            gene_tpm = self._validate_dtype(gene_tpm)
-        else:
-            gene_tpm = self._validate_df(
-                GENE_TPM,
-                columns=['gene_id', 'tissue', 'gene_tpm'])
-        if gene_tpm is not None and self.df_mmsplice is not None:
+        columns = ['gene_id', 'tissue', 'gene_tpm']
+        if gene_tpm is None:
+            gene_tpm = GENE_TPM
+        gene_tpm = self._validate_df(gene_tpm, columns=columns, usecols=columns)
+        if list(gene_tpm.columns) != columns:
+            gene_tpm = gene_tpm[columns]
+        gene_tpm = self._validate_dtype(gene_tpm, shared=False)
+        if self.df_mmsplice is not None:
             missing_tissues = set(self.df_mmsplice['tissue']).difference(
                 set(gene_tpm['tissue']))
             if len(missing_tissues) > 0:
@@ -181,15 +428,11 @@ class SplicingOutlierResult:
         return gene_tpm
 
     def validate_df_gene_map(self, gene_map):
-        if gene_map is not None:
-            gene_map = self._validate_df(
-                gene_map,
-                columns=['gene_id', 'gene_name'])
-            gene_map = self._validate_dtype(gene_map)
-        else:
-            gene_map = self._validate_df(
-                GENE_MAP,
-                columns=['gene_id', 'gene_name'])
+        columns = ['gene_id', 'gene_name']
+        if gene_map is None:
+            gene_map = GENE_MAP
+        gene_map = self._validate_df(gene_map, columns=columns, usecols=columns)
+        gene_map = self._validate_dtype(gene_map, shared=False)
         return gene_map
 
     def validate_absplice_dna_input(self, df_absplice_dna_input):
@@ -247,29 +490,106 @@ class SplicingOutlierResult:
         return df_absplice_rna
 
     def _contains_chr(self):
-        if self.df_mmsplice is not None:
+        if self.df_mmsplice is not None and self.df_mmsplice.shape[0] > 0:
             return 'chr' in self.df_mmsplice.junction[0]
         else:
             return None
 
-    def _add_tissue_info_to_spliceai(self):
+    def _join_tissue_independent(self, df, df_tissue_independent, groupby,
+                                 rsuffix='_spliceai'):
         """
-        checks if self.df_spliceai has 'tissue' column.
-        If self.df_mmsplice has 'tissue' column and self.df_spliceai does not have 'tissue' column,
-        tissue independent spliceai predictions are copied for each tissue in self.df_mmsplice
+        Outer joins `df` indexed by `groupby` and `df_tissue_independent`
+        indexed by `groupby` without tissue, where rows of
+        `df_tissue_independent` apply to each tissue of `self.tissues`
+        (defaults to tissues of `self.df_mmsplice`), and adds gene_tpm.
+        Overlapping columns of `df_tissue_independent` get `rsuffix`.
+
+        Rows are sorted by gene_id (missing last) and tissue, rows of `df`
+        first, and the other index levels.
         """
-        df_spliceai = self.df_spliceai
-        l = list()
-        for tissue in self.df_mmsplice['tissue'].unique():
-            _df = df_spliceai.copy()
-            _df['tissue'] = tissue
-            l.append(_df)
-        self._df_spliceai_tissue = pd.concat(l)
-        return self._df_spliceai_tissue
+        keys = [name for name in groupby if name != 'tissue']
+        df_tissue_independent = df_tissue_independent.rename(columns={
+            col: col + rsuffix for col in df_tissue_independent.columns
+            if col in df.columns
+        })
+        df_joined = pd.concat([
+            df.join(df_tissue_independent, on=keys).reset_index(),
+            self._broadcast_tissues(
+                df_tissue_independent, groupby, exclude=df.index).reset_index()
+        ], keys=[False, True], names=['tissue_independent', None])
+        df_joined = df_joined.sort_values([
+            'gene_id', 'tissue', 'tissue_independent',
+            *[name for name in groupby if name not in {'gene_id', 'tissue'}]
+        ])
+        # keys of broadcast rows are object, so they are cast back to the
+        # dtypes of `dtype_columns` (shared categories if compact)
+        df_joined[groupby] = self._validate_dtype(df_joined[groupby])
+        return self._add_gene_tpm(df_joined.set_index(groupby))
+
+    def _broadcast_tissues(self, df_tissue_independent, groupby, exclude=None):
+        """
+        Rows of `df_tissue_independent` indexed by `groupby` without tissue
+        for each tissue of `self.tissues` (defaults to tissues of
+        `self.df_mmsplice`), indexed by `groupby`. Rows with keys in the
+        `exclude` index (with `groupby` levels) are dropped.
+
+        The index is built from the codes of the index of
+        `df_tissue_independent`, which must be unique.
+        """
+        tissues = self.tissues
+        if tissues is None:
+            tissues = self.df_mmsplice['tissue'].unique()
+        tissues = pd.Index(np.asarray(tissues, dtype=object), name='tissue')
+        index = df_tissue_independent.index
+        n = index.shape[0]
+
+        pos = np.tile(np.arange(n), len(tissues))
+        tissue_codes = np.repeat(np.arange(len(tissues)), n)
+        if exclude is not None:
+            # broadcast rows are at `tissue_code * n + pos`
+            rows = index.get_indexer(exclude.droplevel('tissue'))
+            # values missing in a level would match missing values
+            for name, level in zip(index.names, index.levels):
+                rows[level.get_indexer(exclude.get_level_values(name)) == -1] = -1
+            rows_tissue = tissues.get_indexer(exclude.get_level_values('tissue'))
+            found = (rows != -1) & (rows_tissue != -1)
+            keep = np.ones(len(pos), dtype=bool)
+            keep[rows_tissue[found] * n + rows[found]] = False
+            pos, tissue_codes = pos[keep], tissue_codes[keep]
+
+        levels = dict(zip(index.names, index.levels))
+        codes = {name: c[pos] for name, c in zip(index.names, index.codes)}
+        levels['tissue'], codes['tissue'] = tissues, tissue_codes
+        index = pd.MultiIndex(
+            levels=[levels[name] for name in groupby],
+            codes=[codes[name] for name in groupby],
+            names=groupby, verify_integrity=False)
+        return df_tissue_independent.take(pos).set_axis(index)
+
+    def _add_gene_tpm(self, df):
+        """
+        Left joins gene_tpm of (gene_id, tissue) to `df` indexed by gene_id
+        and tissue (among others).
+        """
+        gene_tpm = self.gene_tpm.drop_duplicates(['gene_id', 'tissue']) \
+            .set_index(['gene_id', 'tissue'])['gene_tpm']
+        return df.join(gene_tpm, on=['gene_id', 'tissue'])
+
+    def _variant_samples(self):
+        if self.sparse_samples and self.df_var_samples is not None:
+            return VariantSamples.from_df(self.df_var_samples)
 
     def _add_samples(self, df):
+        if self.var_samples is not None:
+            # samples are not joined, but variants without samples dropped
+            return df[df['variant'].isin(self.var_samples.variants)] \
+                .reset_index(drop=True)
+        df_var_samples = self.df_var_samples
+        if self.compact:
+            df = self._share_categories(df)
+            df_var_samples = self._share_categories(df_var_samples)
         df = df.set_index('variant') \
-            .join(self.df_var_samples.set_index('variant'),
+            .join(df_var_samples.set_index('variant'),
                   how='inner') \
             .reset_index()
         return df
@@ -280,6 +600,7 @@ class SplicingOutlierResult:
         (e.g. output of 'to_sample_csv' from kipoiseq.extractors.vcf_query)
         '''
         self.df_var_samples = self.validate_df_var_samples(df_var_samples)
+        self.var_samples = self._variant_samples()
         if self.df_mmsplice is not None:
             if 'sample' not in self.df_mmsplice.columns:
                 self.df_mmsplice = self._add_samples(self.df_mmsplice)
@@ -287,6 +608,157 @@ class SplicingOutlierResult:
             if 'sample' not in self.df_spliceai.columns:
                 self.df_spliceai = self._add_samples(self.df_spliceai)
 
+    # cached aggregations by sample and the properties computing them
+    _sample_aggregations = {
+        '_junction': 'junction',
+        '_splice_site': 'splice_site',
+        '_gene_mmsplice': 'gene_mmsplice',
+        '_gene_spliceai': 'gene_spliceai',
+        '_gene_absplice_dna': 'gene_absplice_dna',
+        '_variant_mmsplice': 'variant_mmsplice',
+        '_variant_spliceai': 'variant_spliceai',
+        '_variant_absplice_dna': 'variant_absplice_dna',
+    }
+
+    # cached results of AbSplice-RNA, recomputed by `update_samples`
+    _rna_caches = [
+        '_absplice_rna_input', '_absplice_rna', '_gene_mmsplice_cat',
+        '_variant_mmsplice_cat', '_gene_absplice_rna', '_variant_absplice_rna'
+    ]
+
+    def update_samples(self, df_var_samples, df_mmsplice=None, df_spliceai=None,
+                       df_mmsplice_cat=None):
+        """
+        Adds new samples to a result with `sparse_samples=True` without
+        recomputing the results of the existing samples.
+
+        Predictions are per variant, so only the variants of the new
+        samples which are not in the result are added to the predictions
+        and to the computed AbSplice-DNA inputs and predictions. Computed
+        aggregations by sample (e.g. `gene_absplice_dna`) are extended by
+        the aggregations of the new samples.
+
+        Args:
+          df_var_samples: variant and sample pairs of the new samples.
+          df_mmsplice: predictions of the variants of the new samples
+            (e.g. predicted with a `PredictionCache`). Predictions of
+            variants in the result are ignored.
+          df_spliceai: SpliceAI predictions of the variants of the new
+            samples.
+          df_mmsplice_cat: CAT predictions of the new samples. Computed
+            AbSplice-RNA inputs, predictions and aggregations are
+            recomputed with the new samples.
+        """
+        if self.var_samples is None:
+            raise ValueError('`update_samples` requires `sparse_samples=True`')
+        rna_caches = [attr for attr in self._rna_caches
+                      if getattr(self, attr) is not None]
+        if rna_caches and self.df_mmsplice_cat is None:
+            raise ValueError(
+                '%s can not be updated without `df_mmsplice_cat`' % rna_caches)
+        df_var_samples = self.validate_df_var_samples(df_var_samples)
+        if df_var_samples['sample'].isin(self.var_samples.samples).any():
+            raise ValueError('Samples are already in the result: %s' % list(
+                df_var_samples.loc[df_var_samples['sample'].isin(
+                    self.var_samples.samples), 'sample'].unique()))
+
+        new_variants = ~df_var_samples['variant'].isin(self.var_samples.variants)
+        if new_variants.any():
+            tissues = self.tissues
+            if tissues is None and self.df_mmsplice is not None:
+                tissues = self.df_mmsplice['tissue'].unique()
+            delta = SplicingOutlierResult(
+                df_mmsplice=df_mmsplice if self.df_mmsplice is not None else None,
+                df_spliceai=df_spliceai if self.df_spliceai is not None else None,
+                gene_map=self.gene_map, gene_tpm=self.gene_tpm,
+                df_var_samples=df_var_samples[new_variants],
+                tissues=tissues, compact=self.compact,
+                all_columns=self.all_columns, sparse_samples=True)
+            if self._absplice_dna is not None:
+                self._absplice_dna = self._concat(
+                    self._absplice_dna,
+                    delta.predict_absplice_dna(**self._absplice_dna_kwargs))
+            if self._absplice_dna_input is not None:
+                self._absplice_dna_input = self._concat(
+                    self._absplice_dna_input, delta.absplice_dna_input)
+            for name in ['df_mmsplice', 'df_spliceai']:
+                if getattr(self, name) is not None:
+                    setattr(self, name, self._concat(
+                        getattr(self, name), getattr(delta, name)))
+
+        # aggregations of the new samples only
+        self.var_samples = VariantSamples.from_df(df_var_samples)
+        try:
+            for attr, prop in self._sample_aggregations.items():
+                df = getattr(self, attr)
+                if df is None or 'sample' not in df.index.names:
+                    continue
+                setattr(self, attr, None)
+                setattr(self, attr, self._concat(df, getattr(self, prop)))
+        finally:
+            self.df_var_samples = self._concat(
+                self.df_var_samples, df_var_samples)
+            self.var_samples = self._variant_samples()
+
+        if self.df_mmsplice_cat is not None and df_mmsplice_cat is not None:
+            df_mmsplice_cat = self.validate_df_mmsplice_cat(df_mmsplice_cat)
+            self.df_mmsplice_cat = self._concat(
+                self.df_mmsplice_cat, df_mmsplice_cat[
+                    df_mmsplice_cat['sample'].isin(df_var_samples['sample'])])
+        # AbSplice-RNA is predicted per sample, so it is recomputed
+        for attr in self._rna_caches:
+            setattr(self, attr, None)
+        if self.compact:
+            self._share_categories()
+        if '_absplice_rna' in rna_caches:
+            self.predict_absplice_rna(**self._absplice_rna_kwargs)
+
+    def _concat(self, df, df_new):
+        """
+        Rows of `df_new` appended to `df` keeping the index levels and
+        the shared categories of `df`.
+        """
+        index = [name for name in df.index.names if name is not None]
+        if len(index) > 0:
+            df, df_new = df.reset_index(), df_new.reset_index()
+        dtypes = dict()
+        for col in df.columns:
+            if pd.api.types.is_categorical_dtype(df[col]):
+                self._add_categories(col, df[col])
+                dtypes[col] = self._add_categories(col, df_new[col])
+        df = pd.concat([df.astype(dtypes), df_new[df.columns].astype(dtypes)],
+                       ignore_index=True)
+        if len(index) > 0:
+            df = df.set_index(index)
+        return df
+
+    def expand_samples(self, df):
+        """
+        Rows of `df` repeated for each sample of their variant (column or
+        index level), e.g. to materialize per sample rows of (filtered)
+        results if `sparse_samples=True`. Sample is appended to the index
+        if variant is an index level.
+        """
+        if 'variant' in df.columns:
+            variants = df['variant']
+        else:
+            variants = df.index.get_level_values('variant')
+        positions, samples = self.var_samples.expand(variants)
+        df = df.iloc[positions]
+        samples = self.var_samples.samples.take(samples).rename('sample')
+        if 'variant' in df.columns:
+            df = df.assign(sample=samples.array)
+        else:
+            df = df.set_index(samples, append=True)
+        if self.compact:
+            df = self._share_categories(df)
+        return df
+
+    def _per_sample(self, df):
+        # rows of `df` are per sample, or can be expanded to samples
+        return 'sample' in df.columns or 'sample' in df.index.names \
+            or self.var_samples is not None
+
     def infer_cat(self, cat_inference, progress=False):
         """
         cat_inference: List[CatInference] or CatInference
@@ -294,37 +766,36 @@ class SplicingOutlierResult:
         infers delta_score_cat for each cat tissue in each target tissue, 
         based on ref_psi_target and measured delta_logit_psi in cat
         """
-        if 'sample' not in self.df_mmsplice.columns:
+        if not self._per_sample(self.df_mmsplice):
             raise ValueError(
                 '"sample" column is missing. Call add.samples() first')
 
+        from absplice.cat_dataloader import CatInference
         if type(cat_inference) == CatInference:
             cat_inference = [cat_inference]
 
+        if progress:
+            cat_inference = tqdm(cat_inference)
+
         infer_rows = list()
         for cat in cat_inference:
             assert self.contains_chr == cat.contains_chr
 
-            cols_shared = ['junction', 'gene_id', 'tissue', 'event_type']
-            common_cat_idx = set(pd.concat([cat.common5, cat.common3])
-                                 .set_index(['junctions', 'gene_id', 'tissue', 'event_type']).index)
-
-            df_common = self.junction.reset_index().set_index(['junction', 'gene_id', 'tissue', 'event_type'])
+            common_cat_idx = pd.concat([cat.common5, cat.common3]) \
+                .set_index(['junctions', 'gene_id', 'tissue', 'event_type']).index
 
-            common_idx = set(df_common.index).intersection(common_cat_idx)
-            df_common = df_common.loc[common_idx] \
-                                 .set_index('sample', append=True)
+            df_common = self.junction.reset_index().set_index(
+                ['junction', 'gene_id', 'tissue', 'event_type'])
+            df_common = df_common[df_common.index.isin(common_cat_idx)] \
+                .reset_index()
+            df_common = df_common[df_common['sample'].isin(cat.samples)]
 
-            rows = df_common.index
-            if progress:
-                rows = tqdm(rows, total=df_common.shape[0])
+            infer_rows.append(cat.infer_all(
+                df_common['junction'], df_common['gene_id'],
+                df_common['tissue'], df_common['sample'],
+                df_common['event_type']))
 
-            for junction, gene_id, tissue, event_type, sample in rows:
-                if cat.contains(sample):
-                    infer_rows.append(cat.infer(
-                        junction, gene_id, tissue, sample, event_type))
-
-        df = pd.DataFrame(infer_rows)
+        df = pd.concat(infer_rows)
         assert df.shape[0] > 0
         df = df.set_index(['junction', 'gene_id', 'tissue', 'sample'])
 
@@ -334,14 +805,64 @@ class SplicingOutlierResult:
             & (~self.df_mmsplice_cat['delta_psi_cat'].isna())
         ]
 
+    def _group_key_cache(self, df):
+        # group keys are factorized once per DataFrame and shared by all
+        # aggregations on it
+        cache = self._group_key_caches.get(id(df))
+        if cache is None or cache.df is not df:
+            self._group_key_caches = {
+                k: v for k, v in self._group_key_caches.items()
+                if v.df is not None
+            }
+            cache = GroupKeyCache(df)
+            self._group_key_caches[id(df)] = cache
+        return cache
+
     def _get_maximum_effect(self, df, groupby, score, dropna=True):
-        df = df.reset_index()
+        if 'sample' in groupby and self.var_samples is not None \
+                and 'sample' not in df.columns \
+                and 'sample' not in df.index.names:
+            return self._get_maximum_effect_samples(
+                df, groupby, score, dropna)
+        missing = set(groupby).difference(df.columns) \
+            .difference(df.index.names)
+        if len(missing) != 0:
+            raise KeyError(" %s are not in columns" % missing)
+        positions = self._group_key_cache(df).abs_max_positions(
+            groupby, score, dropna)
+        df = df.iloc[positions].reset_index()
+        if 'index' in df.columns:
+            df = df.drop(columns='index')
+        return df.set_index(groupby)
+
+    def _get_maximum_effect_samples(self, df, groupby, score, dropna=True):
+        """
+        Maximum effect by `groupby` (with sample) of predictions per variant.
+        The maximum of a group in a sample is the maximum over the variants
+        of the sample, so rows are reduced by group and variant first, and
+        only positions of the reduced rows are expanded to samples.
+        """
+        keys = [col for col in groupby if col != 'sample']
+        cache = self._group_key_cache(df)
+        positions = cache.abs_max_positions(
+            keys if 'variant' in keys else [*keys, 'variant'], score, dropna)
+
+        variants = cache._values('variant').take(positions)
+        rows, samples = self.var_samples.expand(variants)
+        positions = positions[rows]
+        codes = samples
+        if len(keys) > 0:
+            codes = cache.group_codes(keys, dropna)[positions] \
+                * self.var_samples.n_samples + samples
+        rows = group_abs_argmax(codes, cache._score_values(score)[positions])
+
+        df = df.iloc[positions[rows]].reset_index()
         if 'index' in df.columns:
             df = df.drop(columns='index')
-        if len(set(groupby).difference(df.columns)) != 0:
-            raise KeyError(" %s are not in columns" %
-                           set(groupby).difference(df.columns))
-        return get_abs_max_rows(df.set_index(groupby), groupby, score, dropna)
+        df['sample'] = self.var_samples.samples.take(samples[rows]).array
+        if self.compact:
+            df = self._share_categories(df)
+        return df.set_index(groupby)
 
     @property
     def psi5(self):
@@ -354,7 +875,7 @@ class SplicingOutlierResult:
     @property
     def junction(self):  # NOTE: max aggregate over all variants
         groupby = ['junction', 'gene_id', 'event_type', 'tissue']
-        if 'sample' in self.df_mmsplice:
+        if self._per_sample(self.df_mmsplice):
             groupby.append('sample')
         if self._junction is None:
             self._junction = self._get_maximum_effect(
@@ -365,7 +886,7 @@ class SplicingOutlierResult:
     @property
     def splice_site(self):  # NOTE: max aggregate over all variants
         groupby = ['splice_site', 'gene_id', 'event_type', 'tissue']
-        if 'sample' in self.df_mmsplice:
+        if self._per_sample(self.df_mmsplice):
             groupby.append('sample')
         if self._splice_site is None:
             self._splice_site = self._get_maximum_effect(
@@ -376,7 +897,7 @@ class SplicingOutlierResult:
     @property
     def gene_mmsplice(self):  # NOTE: max aggregate over all variants
         groupby = ['gene_id', 'tissue']
-        if 'sample' in self.df_mmsplice:
+        if self._per_sample(self.df_mmsplice):
             groupby.append('sample')
         if self._gene_mmsplice is None:
             self._gene_mmsplice = self._get_maximum_effect(
@@ -396,7 +917,7 @@ class SplicingOutlierResult:
     @property
     def gene_spliceai(self):  # NOTE: max aggregate over all variants
         groupby = ['gene_id']
-        if 'sample' in self.df_spliceai:
+        if self._per_sample(self.df_spliceai):
             groupby.append('sample')
         if self._gene_spliceai is None:
             self._gene_spliceai = self._get_maximum_effect(
@@ -406,7 +927,7 @@ class SplicingOutlierResult:
     @property
     def variant_mmsplice(self):  # NOTE: max aggregate for variant on each gene
         groupby = ['variant', 'gene_id', 'tissue']
-        if 'sample' in self.df_mmsplice:
+        if self._per_sample(self.df_mmsplice):
             groupby.append('sample')
         if self._variant_mmsplice is None:
             self._variant_mmsplice = self._get_maximum_effect(
@@ -426,7 +947,7 @@ class SplicingOutlierResult:
     @property
     def variant_spliceai(self):  # NOTE: max aggregate for variant on each gene
         groupby = ['variant', 'gene_id']
-        if 'sample' in self.df_spliceai:
+        if self._per_sample(self.df_spliceai):
             groupby.append('sample')
         if self._variant_spliceai is None:
             self._variant_spliceai = self._get_maximum_effect(
@@ -439,45 +960,48 @@ class SplicingOutlierResult:
             groupby = ['variant', 'gene_id', 'tissue']
             if 'sample' in self.df_mmsplice and 'sample' in self.df_spliceai:
                 groupby.append('sample')
-            df_spliceai = self._add_tissue_info_to_spliceai()  # add tissue info to spliceai
             # this is the same as 'variant_mmsplice'
             df_mmsplice = self._get_maximum_effect(
                 self.df_mmsplice, groupby, score='delta_psi')
             # dropna=False assures that also missing gene_id and genes that do not have tpm values in tissues are predicted
+            # spliceai is tissue independent, so it is aggregated once and joined to each tissue
             df_spliceai = self._get_maximum_effect(
-                df_spliceai, groupby, score='delta_score', dropna=False)
+                self.df_spliceai, [i for i in groupby if i != 'tissue'],
+                score='delta_score', dropna=False)
             cols_spliceai = ['delta_score', 'gene_name']
             cols_mmsplice = [
                 'Chromosome', 'Start', 'End', 'Strand', 'junction', 'event_type', 'splice_site', 'gene_name',
                 'delta_logit_psi', 'delta_psi', 'ref_psi', 'k', 'n', 'median_n',
                 'novel_junction', 'weak_site_donor', 'weak_site_acceptor']
-            self._absplice_dna_input = df_mmsplice[cols_mmsplice].join(
-                df_spliceai[cols_spliceai], how='outer', rsuffix='_spliceai')
-
-            self._absplice_dna_input = self._absplice_dna_input.reset_index()
-            self._absplice_dna_input = self._absplice_dna_input.set_index(['gene_id', 'tissue'])\
-                .join(self.gene_tpm.set_index(['gene_id', 'tissue'])[['gene_tpm']])\
-                .reset_index().set_index(groupby)
+            self._absplice_dna_input = self._join_tissue_independent(
+                df_mmsplice[cols_mmsplice], df_spliceai[cols_spliceai], groupby)
         return self._absplice_dna_input
 
     @property
     def absplice_rna_input(self):
         if self._absplice_rna_input is None:
             groupby = ['variant', 'gene_id', 'tissue', 'sample']
-            if not pd.Series(groupby).isin(self.absplice_dna_input.index.names).all():
-                self._absplice_dna_input = self.absplice_dna_input.set_index(
+            df_absplice_dna_input = self.absplice_dna_input
+            if self.var_samples is not None \
+                    and 'sample' not in df_absplice_dna_input.index.names:
+                # AbSplice-RNA is predicted per sample
+                df_absplice_dna_input = self.expand_samples(
+                    df_absplice_dna_input)
+            elif not pd.Series(groupby).isin(df_absplice_dna_input.index.names).all():
+                self._absplice_dna_input = df_absplice_dna_input.set_index(
                     groupby)
+                df_absplice_dna_input = self._absplice_dna_input
             df_mmsplice_cat = self._get_maximum_effect(
                 self.df_mmsplice_cat, groupby, score='delta_psi_cat')
             cols_mmsplice_cat = [
                 'junction', 'delta_psi', 'ref_psi', 'median_n',
                 *[col for col in df_mmsplice_cat.columns if 'cat' in col]]
-            self._absplice_rna_input = self.absplice_dna_input.join(
+            self._absplice_rna_input = df_absplice_dna_input.join(
                 df_mmsplice_cat[cols_mmsplice_cat], how='outer', rsuffix='_from_cat_infer')
         return self._absplice_rna_input
 
     def _predict_absplice(self, df, absplice_score, pickle_file, features, abs_features, median_n_cutoff, tpm_cutoff):
-        model = pickle.load(open(pickle_file, 'rb'))
+        model = load_model(pickle_file)
         df['splice_site_is_expressed'] = (
             df['median_n'] > median_n_cutoff).astype(int)
         df['gene_is_expressed'] = (df['gene_tpm'] > tpm_cutoff).astype(int)
@@ -495,7 +1019,12 @@ class SplicingOutlierResult:
                 'delta_score',
                 'splice_site_is_expressed']
         if pickle_file is None:
-            pickle_file = ABSPLICE_DNA
+            pickle_file = ABSPLICE_DNA_SCORER
+        # used to predict variants added by `update_samples`
+        self._absplice_dna_kwargs = dict(
+            pickle_file=pickle_file, features=features,
+            abs_features=abs_features, median_n_cutoff=median_n_cutoff,
+            tpm_cutoff=tpm_cutoff)
 
         self._absplice_dna = self._predict_absplice(
             df=self.absplice_dna_input,
@@ -516,7 +1045,12 @@ class SplicingOutlierResult:
                 'delta_score',
                 'splice_site_is_expressed']
         if pickle_file is None:
-            pickle_file = ABSPLICE_RNA
+            pickle_file = ABSPLICE_RNA_SCORER
+        # used to predict samples added by `update_samples`
+        self._absplice_rna_kwargs = dict(
+            pickle_file=pickle_file, features=features,
+            abs_features=abs_features, median_n_cutoff=median_n_cutoff,
+            tpm_cutoff=tpm_cutoff)
 
         self._absplice_rna = self._predict_absplice(
             df=self.absplice_rna_input,
@@ -531,7 +1065,7 @@ class SplicingOutlierResult:
     @property
     def gene_absplice_dna(self):  # NOTE: max aggregate over all variants
         groupby = ['gene_id', 'tissue']
-        if 'sample' in self._absplice_dna.reset_index():
+        if self._per_sample(self._absplice_dna):
             groupby.append('sample')
         if self._gene_absplice_dna is None:
             self._gene_absplice_dna = self._get_maximum_effect(
@@ -550,7 +1084,7 @@ class SplicingOutlierResult:
     # NOTE: max aggregate for variant on each gene
     def variant_absplice_dna(self):
         groupby = ['variant', 'gene_id', 'tissue']
-        if 'sample' in self._absplice_dna.reset_index():
+        if self._per_sample(self._absplice_dna):
             groupby.append('sample')
         if self._variant_absplice_dna is None:
             self._variant_absplice_dna = self._get_maximum_effect(
@@ -567,17 +1101,43 @@ class SplicingOutlierResult:
         return self._variant_absplice_rna
 
     @staticmethod
-    def _add_maf(df, population, default=-1):
-        df['maf'] = df['variant'].map(
-            lambda x: population.get(x, default))
-        return df
+    def _population_maf(population):
+        """
+        Population allele frequencies as pd.Series indexed by variant.
+
+        Args:
+          population: dict or pd.Series of variant to maf, or pd.DataFrame
+            or path (csv, tsv or parquet) of table with variant and maf
+            columns.
+        """
+        if isinstance(population, dict):
+            population = pd.Series(population, dtype='float64')
+        elif not isinstance(population, (pd.Series, pd.DataFrame)):
+            population = read_csv(population, columns=['variant', 'maf'])
+        if isinstance(population, pd.DataFrame):
+            population = population.set_index('variant')['maf']
+        if not population.index.is_unique:
+            population = population[~population.index.duplicated()]
+        return population
+
+    @classmethod
+    def _add_maf(cls, df, population, default=-1):
+        population = cls._population_maf(population)
+        variants = df['variant']
+        if pd.api.types.is_categorical_dtype(variants):
+            # lookup of the categories only
+            codes = variants.cat.codes.to_numpy()
+            idx = population.index.get_indexer(variants.cat.categories)
+            idx = np.where(codes >= 0, idx[codes], -1)
+        else:
+            idx = population.index.get_indexer(variants)
+        maf = population.to_numpy(dtype=np.float64, na_value=np.nan)
+        return df.assign(maf=np.where(idx >= 0, maf[idx], default))
 
     @staticmethod
     def _filter_private(df, max_num_sample=2):
-        df['samples'] = df.groupby(
-            'variant')['sample'].apply(lambda x: ';'.join(x))
-        return df[df['samples'].str.split(';').map(set, na_action='ignore').map(list, na_action='ignore')
-                  .map(len) <= max_num_sample]
+        n_samples = group_nunique(df['variant'], df['sample'])
+        return df[n_samples <= max_num_sample]
 
     def _add_filter_maf(self, df, population=None,
                         maf_cutoff=0.001, default=-1):
@@ -586,16 +1146,33 @@ class SplicingOutlierResult:
 
     def filter_maf(self, max_num_sample=2, population=None,
                    maf_cutoff=0.001, default=-1):
+        """
+        Filters predictions of private and rare variants.
+
+        Args:
+          max_num_sample: maximum number of samples with the variant.
+          population: population allele frequencies (see `_population_maf`).
+          maf_cutoff: maximum allele frequency in the population.
+          default: allele frequency of variants missing in `population`.
+        """
         df_mmsplice = self.df_mmsplice
         df_spliceai = self.df_spliceai
 
-        if max_num_sample:
+        if max_num_sample and self.var_samples is not None:
+            variants = self.var_samples.variants[
+                np.diff(self.var_samples.indptr) <= max_num_sample]
+            if df_mmsplice is not None:
+                df_mmsplice = df_mmsplice[df_mmsplice['variant'].isin(variants)]
+            if df_spliceai is not None:
+                df_spliceai = df_spliceai[df_spliceai['variant'].isin(variants)]
+        elif max_num_sample:
             if df_mmsplice is not None:
                 df_mmsplice = self._filter_private(df_mmsplice, max_num_sample)
             if df_spliceai is not None:
                 df_spliceai = self._filter_private(df_spliceai, max_num_sample)
 
-        if population:
+        if population is not None:
+            population = self._population_maf(population)
             if df_mmsplice is not None:
                 df_mmsplice = self._add_filter_maf(
                     df_mmsplice, population, maf_cutoff, default)
@@ -603,7 +1180,16 @@ class SplicingOutlierResult:
                 df_spliceai = self._add_filter_maf(
                     df_spliceai, population, maf_cutoff, default)
 
+        # samples are already joined to the predictions unless sparse
         return SplicingOutlierResult(
             df_mmsplice=df_mmsplice,
-            df_spliceai=df_spliceai
+            df_spliceai=df_spliceai,
+            gene_map=self.gene_map,
+            gene_tpm=self.gene_tpm,
+            df_var_samples=self.df_var_samples
+            if self.var_samples is not None else None,
+            tissues=self.tissues,
+            compact=self.compact,
+            all_columns=self.all_columns,
+            sparse_samples=self.sparse_samples
         )
\ No newline at end of file
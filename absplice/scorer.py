@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+
+
+class _Binning:
+    """
+    Bins of the features of one preprocessor of an EBM.
+
+    Continuous features are binned by `cuts` (bin 0 is missing),
+    categorical features by the (float) `categories` mapped to `bins`.
+    Unknown categories have bin -1.
+    """
+
+    def __init__(self, cuts, categories, bins):
+        self.cuts = cuts
+        self.categories = categories
+        self.bins = bins
+
+    @classmethod
+    def from_preprocessor(cls, preprocessor, n_features):
+        cuts, categories, bins = dict(), dict(), dict()
+        for i in range(n_features):
+            if preprocessor.col_types_[i] == 'continuous':
+                cuts[i] = np.asarray(preprocessor.col_bin_edges_[i],
+                                     dtype=np.float64)
+            elif preprocessor.col_types_[i] == 'categorical':
+                mapping = sorted(
+                    (float(k), v) for k, v in preprocessor.col_mapping_[i].items())
+                categories[i] = np.array([k for k, _ in mapping])
+                bins[i] = np.array([v for _, v in mapping], dtype=np.int64)
+            else:
+                raise ValueError('Feature type `%s` is not supported'
+                                 % preprocessor.col_types_[i])
+        return cls(cuts, categories, bins)
+
+    def transform(self, i, x):
+        missing = np.isnan(x)
+        if i in self.cuts:
+            binned = np.searchsorted(self.cuts[i], x, side='right') + 1
+        else:
+            categories = self.categories[i]
+            idx = np.searchsorted(categories, x).clip(max=len(categories) - 1)
+            binned = np.where(categories[idx] == x, self.bins[i][idx], -1)
+        return np.where(missing, 0, binned)
+
+
+class EBMScorer:
+    """
+    Scores binary `ExplainableBoostingClassifier` models with NumPy only.
+
+    The model is represented by the bin edges of the features, the
+    additive term lookup tables and the intercept, and gives the same
+    probabilities as `ExplainableBoostingClassifier.predict_proba`.
+    Use `from_ebm` to export a fitted model and `save`/`load` to store it
+    as `.npz` file.
+    """
+
+    def __init__(self, feature_names, intercept, term_features, term_scores,
+                 binning, pair_binning=None):
+        self.feature_names = list(feature_names)
+        self.intercept = float(intercept)
+        self.term_features = [tuple(int(i) for i in t) for t in term_features]
+        self.term_scores = term_scores
+        self.binning = binning
+        self.pair_binning = pair_binning
+
+    @classmethod
+    def from_ebm(cls, model):
+        n_features = len(model.preprocessor_.col_types_)
+        intercept = np.ravel(model.intercept_)
+        if len(intercept) != 1:
+            raise ValueError('Only binary classifiers are supported')
+        pair_preprocessor = getattr(model, 'pair_preprocessor_', None)
+        return cls(
+            feature_names=model.feature_names[:n_features],
+            intercept=intercept[0],
+            term_features=model.feature_groups_,
+            term_scores=[np.asarray(t, dtype=np.float64)
+                         for t in model.additive_terms_],
+            binning=_Binning.from_preprocessor(
+                model.preprocessor_, n_features),
+            pair_binning=_Binning.from_preprocessor(
+                pair_preprocessor, n_features)
+            if pair_preprocessor else None)
+
+    def save(self, path):
+        arrays = {
+            'feature_names': np.array(self.feature_names),
+            'intercept': np.array(self.intercept),
+            'term_features': np.array(
+                [';'.join(map(str, t)) for t in self.term_features]),
+        }
+        for t, scores in enumerate(self.term_scores):
+            arrays['term_scores_%d' % t] = scores
+        for prefix, binning in [('', self.binning),
+                                ('pair_', self.pair_binning)]:
+            if binning is None:
+                continue
+            for i, cuts in binning.cuts.items():
+                arrays['%scuts_%d' % (prefix, i)] = cuts
+            for i, categories in binning.categories.items():
+                arrays['%scategories_%d' % (prefix, i)] = categories
+                arrays['%sbins_%d' % (prefix, i)] = binning.bins[i]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            arrays = dict(f)
+
+        def _binning(prefix):
+            binning = {'cuts': dict(), 'categories': dict(), 'bins': dict()}
+            for key, value in arrays.items():
+                name, _, i = key.rpartition('_')
+                if name.startswith(prefix) and name[len(prefix):] in binning:
+                    binning[name[len(prefix):]][int(i)] = value
+            if not binning['cuts'] and not binning['categories']:
+                return None
+            return _Binning(**binning)
+
+        term_features = [tuple(map(int, t.split(';')))
+                         for t in arrays['term_features']]
+        return cls(
+            feature_names=arrays['feature_names'].tolist(),
+            intercept=arrays['intercept'],
+            term_features=term_features,
+            term_scores=[arrays['term_scores_%d' % t]
+                         for t in range(len(term_features))],
+            binning=_binning(''),
+            pair_binning=_binning('pair_'))
+
+    def _features(self, X):
+        if isinstance(X, pd.DataFrame) \
+                and set(self.feature_names).issubset(X.columns):
+            X = X[self.feature_names]
+        return np.asarray(X, dtype=np.float64)
+
+    def decision_function(self, X):
+        X = self._features(X)
+        binned = dict()
+        log_odds = np.full(X.shape[0], self.intercept)
+
+        for features, scores in zip(self.term_features, self.term_scores):
+            pair = len(features) > 1 and self.pair_binning is not None
+            binning = self.pair_binning if pair else self.binning
+            idx = list()
+            for i in features:
+                if (pair, i) not in binned:
+                    binned[(pair, i)] = binning.transform(i, X[:, i])
+                idx.append(binned[(pair, i)])
+            term = scores[tuple(idx)]
+            # unknown categories do not contribute to the score
+            term[np.any([i < 0 for i in idx], axis=0)] = 0
+            log_odds += term
+
+        return log_odds
+
+    def predict_proba(self, X):
+        log_odds = self.decision_function(X)
+        log_odds = np.c_[np.zeros(log_odds.shape), log_odds]
+        log_odds -= log_odds.max(axis=1, keepdims=True)
+        proba = np.exp(log_odds)
+        return proba / proba.sum(axis=1, keepdims=True)
+
+
+def export_ebm(pickle_file, npz_file):
+    """
+    Exports pickled `ExplainableBoostingClassifier` to `.npz` file
+    which can be loaded with `EBMScorer.load` without interpret.
+    """
+    import pickle
+    with open(pickle_file, 'rb') as f:
+        model = pickle.load(f)
+    scorer = EBMScorer.from_ebm(model)
+    scorer.save(npz_file)
+    return scorer
@@ -0,0 +1,229 @@
+import shutil
+import tempfile
+from pathlib import Path
+import pandas as pd
+from absplice.result import SplicingOutlierResult, GENE_MAP, GENE_TPM
+from absplice.utils import read_csv, read_spliceai, read_chunks, \
+    normalize_gene_annotation
+
+
+class StreamingSplicingOutlierResult:
+    """
+    Computes AbSplice-DNA predictions of inputs which do not fit in memory.
+
+    Inputs are read in chunks and spilled to temporary parquet partitions
+    by chromosome of the variant or by gene_id. Each partition is then
+    processed as a `SplicingOutlierResult` and its results are appended to
+    parquet outputs, so memory is bounded by the size of a partition.
+    Rows joined or aggregated in `SplicingOutlierResult` share variant and
+    gene_id, so results equal the results on the complete inputs.
+
+    Args:
+      df_mmsplice: path (csv, tsv, parquet file or directory of parquet
+        files) or pd.DataFrame of MMSplice-SpliceMap predictions.
+      df_spliceai: path or pd.DataFrame of SpliceAI predictions.
+      df_var_samples: path or pd.DataFrame with variant and sample columns.
+      gene_map: see `SplicingOutlierResult`.
+      gene_tpm: see `SplicingOutlierResult`.
+      partition_by: 'chromosome' or 'gene_id'.
+      n_partitions: number of gene_id hash buckets if `partition_by='gene_id'`.
+      chunksize: number of rows read at once from the inputs.
+      tmp_dir: directory of the temporary partitions.
+
+    Use as context manager or call `close` to delete the temporary partitions.
+    """
+
+    def __init__(self,
+                 df_mmsplice=None,
+                 df_spliceai=None,
+                 df_var_samples=None,
+                 gene_map=None,
+                 gene_tpm=None,
+                 partition_by='chromosome',
+                 n_partitions=64,
+                 chunksize=1000000,
+                 tmp_dir=None):
+        if partition_by not in {'chromosome', 'gene_id'}:
+            raise ValueError(
+                '`partition_by` should be "chromosome" or "gene_id"')
+        self.df_mmsplice = df_mmsplice
+        self.df_spliceai = df_spliceai
+        self.df_var_samples = df_var_samples
+        self.gene_map = read_csv(
+            gene_map if gene_map is not None else GENE_MAP,
+            columns=['gene_id', 'gene_name'])
+        self.gene_tpm = read_csv(
+            gene_tpm if gene_tpm is not None else GENE_TPM,
+            columns=['gene_id', 'tissue', 'gene_tpm'])
+        self.partition_by = partition_by
+        self.n_partitions = n_partitions
+        self.chunksize = chunksize
+        self.tmp_dir = tmp_dir
+        self.tissues = None
+        self._spill_dir = None
+        self._partitions = None
+        self._empty = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+            self._partitions = None
+
+    def _partition_keys(self, df):
+        if self.partition_by == 'chromosome':
+            return df['variant'].astype(str).str.split(':', n=1).str[0]
+        else:
+            return pd.util.hash_pandas_object(
+                df['gene_id'].astype(str), index=False) % self.n_partitions
+
+    def _spill(self, name, chunks, partition_keys):
+        for i, df in enumerate(chunks):
+            self._empty.setdefault(name, df.iloc[:0])
+            for key, df_key in df.groupby(partition_keys(df), sort=False):
+                idx = self._partitions.setdefault(key, len(self._partitions))
+                path = self._spill_dir / name / ('%05d' % idx)
+                path.mkdir(parents=True, exist_ok=True)
+                df_key.to_parquet(path / ('chunk-%05d.parquet' % i), index=False)
+
+    def _spill_all(self, name, chunks):
+        path = self._spill_dir / name
+        path.mkdir(parents=True, exist_ok=True)
+        for i, df in enumerate(chunks):
+            self._empty.setdefault(name, df.iloc[:0])
+            df.to_parquet(path / ('chunk-%05d.parquet' % i), index=False)
+
+    def _read_partition(self, name, idx):
+        path = self._spill_dir / name / ('%05d' % idx)
+        if not path.exists():
+            return self._empty[name]
+        return pd.concat([
+            pd.read_parquet(file) for file in sorted(path.glob('*.parquet'))
+        ], ignore_index=True)
+
+    def _mmsplice_chunks(self):
+        tissues = dict()
+        for df in read_chunks(self.df_mmsplice, self.chunksize):
+            tissues.update(dict.fromkeys(df['tissue'].unique()))
+            yield df
+        self.tissues = list(tissues)
+
+    def _spliceai_chunks(self):
+        for df in read_chunks(self.df_spliceai, self.chunksize, read_spliceai):
+            if self.partition_by == 'gene_id':
+                df = normalize_gene_annotation(
+                    df.copy(), self.gene_map, key='gene_name', value='gene_id')
+            yield df
+
+    def partition(self):
+        """
+        Reads inputs chunk by chunk and writes them to temporary partitions.
+        Called by `iter_results` if inputs are not partitioned yet.
+        """
+        self.close()
+        self._spill_dir = Path(tempfile.mkdtemp(dir=self.tmp_dir))
+        self._partitions = dict()
+
+        if self.df_mmsplice is not None:
+            self._spill('mmsplice', self._mmsplice_chunks(),
+                        self._partition_keys)
+        if self.df_spliceai is not None:
+            self._spill('spliceai', self._spliceai_chunks(),
+                        self._partition_keys)
+        if self.df_var_samples is not None:
+            chunks = read_chunks(self.df_var_samples, self.chunksize)
+            if self.partition_by == 'chromosome':
+                self._spill('var_samples', chunks, self._partition_keys)
+            else:
+                # variants of a gene_id partition can be on any chromosome,
+                # so samples are converted to parquet once and filtered by
+                # variant (see `_var_samples`)
+                self._spill_all('var_samples', chunks)
+
+    def _var_samples(self, idx, variants):
+        if self.df_var_samples is None:
+            return None
+        if self.partition_by == 'chromosome':
+            return self._read_partition('var_samples', idx)
+
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(
+            str(self._spill_dir / 'var_samples'), format='parquet')
+        df = dataset.to_table(
+            filter=ds.field('variant').isin(list(variants))).to_pandas()
+        if df.shape[0] == 0:
+            return self._empty['var_samples']
+        return df
+
+    def iter_results(self):
+        """
+        Yields `SplicingOutlierResult` of each partition.
+        """
+        if self._partitions is None:
+            self.partition()
+
+        for key, idx in self._partitions.items():
+            df_mmsplice = self._read_partition('mmsplice', idx) \
+                if self.df_mmsplice is not None else None
+            df_spliceai = self._read_partition('spliceai', idx) \
+                if self.df_spliceai is not None else None
+
+            variants = pd.concat([
+                df['variant'] for df in [df_mmsplice, df_spliceai]
+                if df is not None
+            ]).unique()
+            if len(variants) == 0:
+                continue
+
+            yield SplicingOutlierResult(
+                df_mmsplice=df_mmsplice,
+                df_spliceai=df_spliceai,
+                df_var_samples=self._var_samples(idx, variants),
+                gene_map=self.gene_map,
+                gene_tpm=self.gene_tpm,
+                tissues=self.tissues)
+
+    @staticmethod
+    def _write_part(df, output_path, i):
+        if output_path is None or df.shape[0] == 0:
+            return
+        output_path = Path(output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+        df.reset_index().to_parquet(
+            output_path / ('part-%05d.parquet' % i), index=False)
+
+    def write_absplice_dna_input(self, output_path):
+        """
+        Writes `absplice_dna_input` of each partition to `output_path`,
+        a directory of `part-xxxxx.parquet` files.
+        """
+        for i, result in enumerate(self.iter_results()):
+            self._write_part(result.absplice_dna_input, output_path, i)
+
+    def predict_absplice_dna(self, output_path, gene_output_path=None,
+                             variant_output_path=None, **kwargs):
+        """
+        Predicts AbSplice-DNA partition by partition and writes predictions
+        to `output_path` and, if given, gene and variant level aggregations
+        (`gene_absplice_dna`, `variant_absplice_dna`) to `gene_output_path`
+        and `variant_output_path`. Outputs are directories of
+        `part-xxxxx.parquet` files.
+
+        kwargs: passed to `SplicingOutlierResult.predict_absplice_dna`.
+        """
+        for i, result in enumerate(self.iter_results()):
+            if result.absplice_dna_input.shape[0] == 0:
+                continue
+            df = result.predict_absplice_dna(**kwargs)
+            self._write_part(df, output_path, i)
+            if gene_output_path is not None:
+                self._write_part(result.gene_absplice_dna, gene_output_path, i)
+            if variant_output_path is not None:
+                self._write_part(
+                    result.variant_absplice_dna, variant_output_path, i)
@@ -1,16 +1,246 @@
+import io
+import weakref
 import pandas as pd
 import numpy as np
 import pathlib
-from kipoiseq.extractors.vcf import MultiSampleVCF
 from collections import namedtuple
 
 
+def group_codes(df, groupby, dropna=True):
+    """
+    Group number of each row in sorted order of the groups
+    (as `df.groupby(groupby).ngroup()`). Rows with missing keys are -1
+    if `dropna` otherwise missing keys are sorted last.
+    """
+    codes = df.groupby(groupby, sort=True, dropna=dropna).ngroup()
+    return codes.fillna(-1).to_numpy(dtype=np.int64)
+
+
+def group_abs_argmax(codes, scores):
+    """
+    Position of the row with maximum absolute score in each group,
+    ordered by group number. Ties are broken by the first row; missing
+    scores are ignored unless all scores of the group are missing, then
+    the first row of the group is returned. Rows with code -1 are skipped.
+    """
+    scores = np.abs(np.asarray(scores, dtype=np.float64))
+    scores[np.isnan(scores)] = -np.inf
+
+    positions = np.flatnonzero(codes >= 0)
+    # lexsort is stable, so the first row wins ties
+    positions = positions[np.lexsort((-scores[positions], codes[positions]))]
+    codes = codes[positions]
+
+    first = np.ones(codes.shape[0], dtype=bool)
+    first[1:] = codes[1:] != codes[:-1]
+    return positions[first]
+
+
+def group_nunique(keys, values):
+    """
+    Number of unique values in the group of each row, as
+    `groupby(keys)[values].transform('nunique')`. Missing values are not
+    counted, rows with missing keys are 0.
+    """
+    key_codes, key_uniques = pd.factorize(keys)
+    value_codes, value_uniques = pd.factorize(values)
+    valid = (key_codes >= 0) & (value_codes >= 0)
+    pairs = pd.unique(key_codes[valid].astype(np.int64) * len(value_uniques)
+                      + value_codes[valid])
+    counts = np.bincount(pairs // max(len(value_uniques), 1),
+                         minlength=len(key_uniques))
+    return np.where(key_codes >= 0, counts[key_codes], 0)
+
+
+class GroupKeyCache:
+    """
+    Caches integer codes of the key columns of a DataFrame and the rows
+    with maximum absolute score of its groups, so that aggregations on
+    overlapping keys share the factorization. Maxima of coarser groups are
+    derived from cached maxima of finer groups.
+
+    Key columns can be columns or index levels. The cache holds a weak
+    reference to the DataFrame and assumes its key and score columns
+    are not modified in place.
+    """
+
+    def __init__(self, df):
+        self._df = weakref.ref(df)
+        self._columns = dict()
+        self._groups = dict()
+        self._scores = dict()
+        self._maxima = dict()
+
+    @property
+    def df(self):
+        return self._df()
+
+    def _values(self, column):
+        df = self.df
+        if column in df.columns:
+            return df[column]
+        return df.index.get_level_values(column)
+
+    def column_codes(self, column):
+        """
+        Codes of the sorted unique values of the column (-1 for missing values)
+        and the number of unique values.
+        """
+        if column not in self._columns:
+            codes, uniques = pd.factorize(self._values(column), sort=True)
+            self._columns[column] = (codes.astype(np.int64), len(uniques))
+        return self._columns[column]
+
+    def _has_missing(self, columns):
+        return any((self.column_codes(col)[0] < 0).any() for col in columns)
+
+    def group_codes(self, groupby, dropna=True):
+        """
+        Group number of each row in sorted order of the groups, same as
+        `group_codes(df, groupby, dropna)`.
+        """
+        key = (tuple(groupby), dropna)
+        if key not in self._groups:
+            codes = np.zeros(self.df.shape[0], dtype=np.int64)
+            missing = np.zeros(self.df.shape[0], dtype=bool)
+            for col in groupby:
+                col_codes, n = self.column_codes(col)
+                missing |= col_codes < 0
+                # missing values are sorted last
+                col_codes = np.where(col_codes < 0, n, col_codes)
+                codes = codes * (n + 1) + col_codes
+                codes = pd.factorize(codes, sort=True)[0].astype(np.int64)
+            if dropna and missing.any():
+                codes = np.where(missing, -1, codes)
+                codes[~missing] = pd.factorize(codes[~missing], sort=True)[0]
+            self._groups[key] = codes
+        return self._groups[key]
+
+    def _score_values(self, score):
+        if score not in self._scores:
+            self._scores[score] = self._values(score) \
+                .to_numpy(dtype=np.float64, na_value=np.nan)
+        return self._scores[score]
+
+    def _finer_maxima(self, groupby, score, dropna):
+        candidates = list()
+        for (_groupby, _score, _dropna), positions in self._maxima.items():
+            extra = set(_groupby).difference(groupby)
+            if _score != score or not extra \
+                    or not set(groupby).issubset(_groupby) \
+                    or self._has_missing(extra):
+                continue
+            if _dropna != dropna and self._has_missing(groupby):
+                continue
+            candidates.append(positions)
+        if candidates:
+            return min(candidates, key=len)
+
+    def abs_max_positions(self, groupby, score, dropna=True):
+        """
+        Positions of rows with maximum absolute `score` in each group,
+        ordered by group number (see `group_abs_argmax`).
+        """
+        key = (tuple(groupby), score, dropna)
+        if key not in self._maxima:
+            codes = self.group_codes(groupby, dropna)
+            scores = self._score_values(score)
+            finer = self._finer_maxima(groupby, score, dropna)
+            if finer is None:
+                positions = group_abs_argmax(codes, scores)
+            else:
+                # maximum of a group is the maximum of its finer groups
+                finer = np.sort(finer)
+                positions = finer[group_abs_argmax(
+                    codes[finer], scores[finer])]
+            self._maxima[key] = positions
+        return self._maxima[key]
+
+
+class VariantSamples:
+    """
+    Sparse variant x sample mapping in CSR format: the samples of
+    `variants[i]` are `samples[indices[indptr[i]:indptr[i + 1]]]`.
+    Variants and samples are sorted, so samples of a variant are sorted.
+
+    Args:
+      variants: pd.Index of unique variants.
+      samples: pd.Index of unique samples.
+      indptr: np.array of offsets of the samples of each variant.
+      indices: np.array of sample codes.
+    """
+
+    def __init__(self, variants, samples, indptr, indices):
+        self.variants = variants
+        self.samples = samples
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_df(cls, df):
+        """
+        Mapping of pd.DataFrame with variant and sample columns.
+        """
+        variant_codes, variants = pd.factorize(df['variant'], sort=True)
+        sample_codes, samples = pd.factorize(df['sample'], sort=True)
+        keep = (variant_codes >= 0) & (sample_codes >= 0)
+        variant_codes = variant_codes[keep].astype(np.int64)
+        sample_codes = sample_codes[keep].astype(np.int64)
+
+        order = np.lexsort((sample_codes, variant_codes))
+        variant_codes = variant_codes[order]
+        sample_codes = sample_codes[order]
+        unique = np.ones(variant_codes.shape[0], dtype=bool)
+        unique[1:] = (variant_codes[1:] != variant_codes[:-1]) \
+            | (sample_codes[1:] != sample_codes[:-1])
+
+        indptr = np.zeros(len(variants) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(variant_codes[unique], minlength=len(variants)),
+                  out=indptr[1:])
+        return cls(variants, samples, indptr, sample_codes[unique])
+
+    @property
+    def n_samples(self):
+        return len(self.samples)
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def counts(self, variants):
+        """
+        Number of samples of each of `variants` (0 for unknown variants).
+        """
+        codes = self.variants.get_indexer(variants)
+        return np.where(codes >= 0,
+                        self.indptr[codes + 1] - self.indptr[codes], 0)
+
+    def expand(self, variants):
+        """
+        Pairs of positions in `variants` and sample codes of the samples
+        of the variants, ordered by position and sample.
+
+        Returns: tuple of np.array of positions and np.array of sample codes.
+        """
+        codes = self.variants.get_indexer(variants)
+        starts = self.indptr[codes]
+        counts = np.where(codes >= 0, self.indptr[codes + 1] - starts, 0)
+        positions = np.repeat(np.arange(codes.shape[0]), counts)
+        offsets = np.arange(positions.shape[0]) \
+            - np.repeat(np.cumsum(counts) - counts, counts)
+        return positions, self.indices[np.repeat(starts, counts) + offsets]
+
+    def to_df(self):
+        return pd.DataFrame({
+            'variant': self.variants.repeat(np.diff(self.indptr)),
+            'sample': self.samples.take(self.indices),
+        })
+
+
 def get_abs_max_rows(df, groupby, max_col, dropna=True):
-    df = df.reset_index()
-    _df = df.copy()
-    _df[max_col] = _df[max_col].abs()
-    max_scores = _df.groupby(groupby, dropna=dropna)[max_col].idxmax()
-    return df.iloc[max_scores.values].set_index(groupby)
+    codes = group_codes(df, groupby, dropna)
+    scores = df[max_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    positions = group_abs_argmax(codes, scores)
+    return df.iloc[positions].reset_index().set_index(groupby)
 
 
 def expit(x):
@@ -53,22 +283,86 @@ def normalize_gene_annotation(df, gene_map, key='gene_name', value='gene_id'):
     return df
 
 
-def read_csv(path, **kwargs):
+def read_csv(path, columns=None, dtype=None, **kwargs):
+    """
+    Reads csv, tsv or parquet file. The schema is pushed into the read, so
+    only `columns` are parsed and the columns are read as `dtype`.
+
+    Args:
+      path: path of the file or pd.DataFrame (returned as it is).
+      columns: columns to read (columns missing in the file are ignored).
+        Defaults to all columns.
+      dtype: dict of dtypes of the columns (columns missing in the file
+        are ignored). NumPy dtypes are parsed directly, other dtypes
+        (e.g. 'Int64', 'string', 'category') are cast after the read,
+        which is faster than parsing them.
+    """
     if isinstance(path, pd.DataFrame):
         return path
     else:
         if not isinstance(path, pathlib.PosixPath):
             path = pathlib.Path(path)
+        if path.suffix.lower() == '.parquet':
+            if len(kwargs) > 0:
+                raise TypeError('Arguments %s are not supported for parquet '
+                                'files' % sorted(kwargs))
+            df = _read_parquet(path, columns, dtype)
+            return _astype(df, dtype)
+        if columns is not None:
+            columns = set(columns)
+            kwargs['usecols'] = lambda col: col in columns
+        if dtype is not None:
+            kwargs['dtype'] = {
+                col: t for col, t in dtype.items()
+                if isinstance(pd.api.types.pandas_dtype(t), np.dtype)}
         if path.suffix.lower() == '.csv' or str(path).endswith('.csv.gz'):
-            return pd.read_csv(path, **kwargs)
+            df = pd.read_csv(path, **kwargs)
         elif path.suffix.lower() == '.tsv' or str(path).endswith('.tsv.gz'):
-            return pd.read_csv(path, sep='\t', **kwargs)
-        elif path.suffix.lower() == '.parquet':
-            return pd.read_parquet(path, **kwargs)
+            df = pd.read_csv(path, sep='\t', **kwargs)
         else:
             raise ValueError("unknown file ending.")
-    
-    
+        return _astype(df, dtype)
+
+
+def _read_parquet(path, columns=None, dtype=None):
+    """
+    Reads `columns` of parquet file (or directory of parquet files).
+    Columns with NumPy dtypes in `dtype` are cast by Arrow before the
+    conversion to pandas.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format='parquet')
+    names = dataset.schema.names
+    if columns is not None:
+        names = [col for col in names if col in set(columns)]
+    table = dataset.to_table(columns=names)
+
+    if dtype is not None:
+        fields = list()
+        for field in table.schema:
+            t = pd.api.types.pandas_dtype(dtype.get(field.name, object))
+            if isinstance(t, np.dtype) and t != object:
+                field = field.with_type(pa.from_numpy_dtype(t))
+            fields.append(field)
+        table = table.cast(pa.schema(fields, metadata=table.schema.metadata))
+    return table.to_pandas()
+
+
+def _astype(df, dtype):
+    """
+    Casts the columns of `df` which do not have the dtypes of `dtype` in
+    a single pass.
+    """
+    if dtype is None:
+        return df
+    dtype = {col: t for col, t in dtype.items()
+             if col in df.columns and df[col].dtype != t}
+    if len(dtype) == 0:
+        return df
+    return df.astype(dtype)
+
+
 def filter_samples_with_RNA_seq(df, samples_for_tissue):
     """
         samples_for_tissue: Dict, keys: tissue, values: samples with RNA-seq for respective tissue
@@ -93,16 +387,10 @@ def read_spliceai(path, **kwargs):
     else:
         if not isinstance(path, pathlib.PosixPath):
             path = pathlib.Path(path)
-        if path.suffix.lower() == '.csv' or str(path).endswith('.csv.gz'):
-            return pd.read_csv(path, **kwargs)
-        elif path.suffix.lower() == '.tsv' or str(path).endswith('.tsv.gz'):
-            return pd.read_csv(path, sep='\t', **kwargs)
-        elif path.suffix.lower() == '.parquet':
-            return pd.read_parquet(path, **kwargs)
-        elif path.suffix.lower() == '.vcf' or str(path).endswith('.vcf.gz'):
+        if path.suffix.lower() == '.vcf' or str(path).endswith('.vcf.gz'):
             return read_spliceai_vcf(path)
         else:
-            raise ValueError("unknown file ending.")
+            return read_csv(path, **kwargs)
 
 
 dtype_columns_spliceai = {
@@ -119,28 +407,220 @@ dtype_columns_spliceai = {
     'donor_loss_position': 'Int64',
 }
 
-def read_spliceai_vcf(path):
-    columns = ['gene_name', 'delta_score',
-                'acceptor_gain', 'acceptor_loss',
-                'donor_gain', 'donor_loss',
-                'acceptor_gain_position',
-                'acceptor_loss_positiin',
-                'donor_gain_position',
-                'donor_loss_position']
-    rows = list()
-    for variant in MultiSampleVCF(path):
-        row_all = variant.source.INFO.get('SpliceAI')
-        for row in row_all.split(','):
-            results = row.split('|')[1:]
-            scores = np.array(list(map(float, results[1:])))
-            spliceai_info = [results[0], scores[:4].max(), *scores]
-            rows.append({
-                **{'variant': str(variant)}, 
-                **dict(zip(columns, spliceai_info))})
-    df = pd.DataFrame(rows)
-        
-    for col in df.columns:
-        if col in dtype_columns_spliceai.keys():
-            df = df.astype({col: dtype_columns_spliceai[col]})
-            
-    return df
+_spliceai_vcf_scores = [
+    'acceptor_gain', 'acceptor_loss',
+    'donor_gain', 'donor_loss']
+_spliceai_vcf_positions = [
+    'acceptor_gain_position',
+    'acceptor_loss_positiin',
+    'donor_gain_position',
+    'donor_loss_position']
+
+
+def _parse_regions(regions):
+    """
+    Parses regions given as `chrom`, `chrom:start-end` or
+    (chrom, start, end) tuples to list of (chrom, start, end) tuples.
+    Positions are 1-based and inclusive. start and end are None if the
+    region is the whole chromosome.
+    """
+    if isinstance(regions, (str, tuple)):
+        regions = [regions]
+    parsed = list()
+    for region in regions:
+        if isinstance(region, str):
+            chrom, _, interval = region.partition(':')
+            if interval:
+                start, end = interval.replace(',', '').split('-')
+                region = (chrom, int(start), int(end))
+            else:
+                region = (chrom, None, None)
+        parsed.append(tuple(region))
+    return parsed
+
+
+def _filter_vcf_regions(df, regions):
+    mask = np.zeros(df.shape[0], dtype=bool)
+    pos = None
+    for chrom, start, end in regions:
+        in_region = (df['chrom'] == str(chrom)).values
+        if start is not None:
+            if pos is None:
+                pos = df['pos'].astype(int).values
+            in_region &= (pos >= start) & (pos <= end)
+        mask |= in_region
+    return df[mask]
+
+
+def parse_spliceai_info(df):
+    """
+    Parses SpliceAI annotations of VCF records with columns chrom, pos,
+    ref, alt and info. Returns one row per annotation.
+    """
+    annotation = df['info'].str.extract(
+        r'(?:^|;)SpliceAI=([^;]*)', expand=False)
+    df = df[annotation.notna().values]
+    annotation = annotation.dropna()
+    if df.shape[0] == 0:
+        return empty_spliceai()
+
+    # annotations of all records are parsed at once by the csv parser
+    num_annotations = annotation.str.count(',').values + 1
+    text = '\n'.join(annotation.tolist()).replace(',', '\n')
+    fields = pd.read_csv(
+        io.StringIO(text), sep='|', header=None,
+        names=['allele', 'gene_name', *_spliceai_vcf_scores,
+               *_spliceai_vcf_positions],
+        dtype={'allele': str, 'gene_name': str},
+        na_values={col: ['.'] for col in
+                   [*_spliceai_vcf_scores, *_spliceai_vcf_positions]},
+        keep_default_na=False, float_precision='round_trip')
+    df = df.iloc[np.repeat(np.arange(df.shape[0]), num_annotations)]
+
+    # the allele of the annotation is the ALT of multiallelic records
+    alt = df['alt'].values
+    multiallelic = df['alt'].str.contains(',', regex=False).values
+    alt = np.where(multiallelic, fields['allele'].values, alt)
+    variant = df['chrom'].values + ':' + df['pos'].values + ':' \
+        + df['ref'].values + '>' + alt
+
+    fields.insert(0, 'variant', variant)
+    fields.insert(3, 'delta_score',
+                  fields[_spliceai_vcf_scores].values.max(axis=1))
+    return fields.drop(columns='allele').astype(dtype_columns_spliceai)
+
+
+def read_spliceai_vcf_chunks(path, chunksize=1000000, regions=None, genes=None):
+    """
+    Reads SpliceAI predictions of a VCF file in chunks.
+
+    The VCF is read as text columns and the SpliceAI INFO field is parsed
+    with vectorized string operations. Records outside of `regions` are
+    dropped before their INFO field is parsed.
+
+    Args:
+      path: path of the VCF file (can be gzipped).
+      chunksize: number of VCF records read at once.
+      regions: region or list of regions (`chrom`, `chrom:start-end` or
+        (chrom, start, end) with 1-based inclusive positions) to read.
+      genes: gene names to read.
+
+    Returns: iterator of pd.DataFrame with one row per SpliceAI annotation.
+    """
+    if regions is not None:
+        regions = _parse_regions(regions)
+    if genes is not None:
+        genes = set(genes)
+
+    reader = pd.read_csv(
+        path, sep='\t', comment='#', header=None, usecols=[0, 1, 3, 4, 7],
+        names=['chrom', 'pos', 'ref', 'alt', 'info'], dtype=str,
+        chunksize=chunksize)
+
+    for df in reader:
+        if regions is not None:
+            df = _filter_vcf_regions(df, regions)
+        df = parse_spliceai_info(df)
+        if genes is not None:
+            df = df[df['gene_name'].isin(genes)].reset_index(drop=True)
+        yield df
+
+
+def empty_spliceai():
+    """
+    Empty pd.DataFrame with the columns of SpliceAI predictions.
+    """
+    return pd.DataFrame({
+        col: pd.Series(dtype=dtype)
+        for col, dtype in dtype_columns_spliceai.items()
+    })
+
+
+def spliceai_vcf_to_parquet(path, output_path, chunksize=1000000,
+                            regions=None, genes=None):
+    """
+    Writes SpliceAI predictions of a VCF file to parquet file
+    chunk by chunk (see `read_spliceai_vcf_chunks`).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    output_path = pathlib.Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    schema = pa.Schema.from_pandas(empty_spliceai(), preserve_index=False)
+
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for df in read_spliceai_vcf_chunks(
+                path, chunksize=chunksize, regions=regions, genes=genes):
+            writer.write_table(pa.Table.from_pandas(
+                df, schema=schema, preserve_index=False))
+    tmp_path.replace(output_path)
+    return output_path
+
+
+def read_spliceai_vcf(path, chunksize=1000000, regions=None, genes=None,
+                      cache=None):
+    """
+    Reads SpliceAI predictions of a VCF file.
+
+    Args:
+      path: path of the VCF file (can be gzipped).
+      chunksize, regions, genes: see `read_spliceai_vcf_chunks`.
+      cache: path of parquet file. If it does not exist or is older than
+        the VCF file, all predictions of the VCF are written to it.
+        Otherwise predictions are read from it instead of the VCF.
+        `regions` and `genes` are applied after reading the cache.
+    """
+    if cache is not None:
+        cache = pathlib.Path(cache)
+        if not cache.exists() \
+                or cache.stat().st_mtime < pathlib.Path(path).stat().st_mtime:
+            spliceai_vcf_to_parquet(path, cache, chunksize=chunksize)
+        return _read_spliceai_cache(cache, regions, genes)
+
+    dfs = list(read_spliceai_vcf_chunks(
+        path, chunksize=chunksize, regions=regions, genes=genes))
+    if len(dfs) == 0:
+        return empty_spliceai()
+    return pd.concat(dfs, ignore_index=True)
+
+
+def _read_spliceai_cache(path, regions=None, genes=None):
+    filters = [('gene_name', 'in', list(genes))] if genes is not None else None
+    df = pd.read_parquet(path, filters=filters).astype(dtype_columns_spliceai)
+
+    if regions is not None and df.shape[0] > 0:
+        variant = df['variant'].str.split(':', n=2, expand=True)
+        df_regions = _filter_vcf_regions(
+            pd.DataFrame({'chrom': variant[0], 'pos': variant[1]}),
+            _parse_regions(regions))
+        df = df.loc[df_regions.index]
+    return df.reset_index(drop=True)
+
+
+def read_chunks(path, chunksize, reader=read_csv):
+    """
+    Reads csv, tsv, SpliceAI vcf or parquet files (or directories of
+    parquet files) in chunks of `chunksize` rows. Other files are read
+    at once with `reader`.
+    """
+    if isinstance(path, pd.DataFrame):
+        for i in range(0, max(path.shape[0], 1), chunksize):
+            yield path.iloc[i:i + chunksize]
+        return
+
+    path = pathlib.Path(path)
+    if path.is_dir() or path.suffix.lower() == '.parquet':
+        import pyarrow.parquet as pq
+        files = sorted(path.glob('*.parquet')) if path.is_dir() else [path]
+        for file in files:
+            for batch in pq.ParquetFile(file).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+    elif path.suffix.lower() == '.csv' or str(path).endswith('.csv.gz'):
+        yield from pd.read_csv(path, chunksize=chunksize)
+    elif path.suffix.lower() == '.tsv' or str(path).endswith('.tsv.gz'):
+        yield from pd.read_csv(path, sep='\t', chunksize=chunksize)
+    elif path.suffix.lower() == '.vcf' or str(path).endswith('.vcf.gz'):
+        yield from read_spliceai_vcf_chunks(path, chunksize=chunksize)
+    else:
+        yield reader(path)
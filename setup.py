@@ -14,6 +14,9 @@ extras_requirements = {
     "predict": [
         'kipoiseq>=0.3.0',
         'mmsplice>=2.1.0'
+    ],
+    "index": [
+        'cyvcf2'
     ]
 }
 
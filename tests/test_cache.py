@@ -0,0 +1,117 @@
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import numpy as np
+import pandas as pd
+from absplice import PredictionCache
+from absplice.cache import prediction_key, prediction_keys
+from conftest import mmsplice_path
+
+
+def _predictions():
+    df = pd.read_csv(mmsplice_path)
+    return df[['variant', 'junction', 'event_type', 'Chromosome', 'Start',
+               'End', 'Strand', 'delta_logit_psi']] \
+        .drop_duplicates(['variant', 'junction', 'event_type']) \
+        .reset_index(drop=True)
+
+
+def test_prediction_key():
+    key = prediction_key('17:41201201:TTC>CA', '17:41201200-41205000:-', 'psi5')
+    assert key == prediction_key(
+        '17:41201201:TTC>CA', '17:41201200-41205000:-', 'psi5')
+    assert key != prediction_key(
+        '17:41201201:TTC>CA', '17:41201200-41205000:-', 'psi3')
+    assert 0 <= key < 2**64
+
+
+def test_prediction_keys():
+    df = _predictions()
+    keys = prediction_keys(df)
+    assert keys.dtype == np.uint64
+    assert keys[0] == prediction_key(*df.iloc[0][
+        ['variant', 'junction', 'event_type']])
+    assert len(np.unique(keys)) == df.shape[0]
+
+    df_cat = df.astype({'variant': 'category', 'event_type': 'category'})
+    np.testing.assert_array_equal(prediction_keys(df_cat), keys)
+
+    # keys are stable across processes
+    for seed in ['0', '1']:
+        out = subprocess.check_output([
+            sys.executable, '-c',
+            'from absplice.cache import prediction_key; print(prediction_key('
+            '"17:41201201:TTC>CA", "17:41201200-41205000:-", "psi5"))'
+        ], env=dict(os.environ, PYTHONHASHSEED=seed), text=True)
+        assert int(out) == prediction_key(
+            '17:41201201:TTC>CA', '17:41201200-41205000:-', 'psi5')
+
+
+def test_prediction_cache(tmp_path):
+    df = _predictions()
+    cache = PredictionCache(tmp_path / 'cache', flush_rows=5)
+    cache.add(df.iloc[:3])
+    assert len(cache) == 3
+    assert len(list(cache.path.glob('*.parquet'))) == 0
+
+    cache.add(df)
+    cache.flush()
+    assert len(cache) == df.shape[0]
+
+    # predictions are read from disk, e.g. in worker processes
+    cache = pickle.loads(pickle.dumps(cache))
+    assert len(cache) == df.shape[0]
+    keys = cache.row_keys(df)
+    assert cache.contains(keys).all()
+    assert int(keys[0]) in cache
+    assert prediction_key('1:1:A>G', '1:1-10:+', 'psi5') not in cache
+
+    # adding cached predictions does not write new parts
+    parts = sorted(cache.path.glob('*.parquet'))
+    cache.add(df)
+    cache.flush()
+    assert sorted(cache.path.glob('*.parquet')) == parts
+
+    df_query = cache.query(keys[[0, 2]])
+    pd.testing.assert_frame_equal(
+        df_query.sort_values(['variant', 'junction']).reset_index(drop=True),
+        df.iloc[[0, 2]].sort_values(['variant', 'junction'])
+        .reset_index(drop=True), check_dtype=False)
+
+
+def test_prediction_cache_threads(tmp_path):
+    n = 2000
+    df = pd.DataFrame({
+        'variant': ['1:%d:A>G' % i for i in range(n)],
+        'junction': '1:1-10:+',
+        'event_type': 'psi5',
+        'delta_logit_psi': 0.
+    })
+    cache = PredictionCache(tmp_path / 'cache', flush_rows=50)
+    keys = cache.row_keys(df)
+    added = [0]
+    done = threading.Event()
+    errors = list()
+
+    # keys are looked up while predictions are added and flushed by another
+    # thread (e.g. producer thread of `BatchPrefetcher` and main thread)
+    def _contains():
+        try:
+            while not done.is_set():
+                i = added[0]
+                assert cache.contains(keys[:i]).all()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=_contains)
+    thread.start()
+    for i in range(0, n, 10):
+        cache.add(df.iloc[i:i + 10])
+        added[0] = i + 10
+    done.set()
+    thread.join()
+
+    assert errors == list()
+    assert len(cache) == n
@@ -1,6 +1,9 @@
 import pytest
+import pandas as pd
 from absplice import CatInference
+from absplice.utils import delta_logit_PSI_to_delta_PSI, logit
 from splicemap import SpliceCountTable as CountTable
+from splicemap.splice_map import SpliceMap
 from conftest import ref_table5_kn_testis, ref_table3_kn_testis, \
     ref_table5_kn_lung, ref_table3_kn_lung, \
     ref_table5_kn_blood, ref_table3_kn_blood, \
@@ -176,6 +179,24 @@ def test_cat_dataloader_infer(cat_dl):
         'ref_psi_cat': 1.0}
 
 
+def test_cat_dataloader_index(cat_dl):
+    index = cat_dl[0].index5
+    assert set(index.junctions) == set.union(*cat_dl[0].common_junctions5)
+    assert sorted(index.samples) == sorted(cat_dl[0].samples)
+    assert index.psi.shape == (len(index.junctions), len(index.samples))
+    assert index.count.shape == index.psi.shape
+
+
+def test_cat_dataloader_index_memory_usage(cat_dl, cat_dl5):
+    usage = cat_dl[0].index_memory_usage()
+    assert sorted(set(usage.index.get_level_values('event_type'))) \
+        == ['psi3', 'psi5']
+    assert (usage > 0).all()
+
+    usage = cat_dl5.index_memory_usage()
+    assert set(usage.index.get_level_values('event_type')) == {'psi5'}
+
+
 def test_cat_dataloader_contains(cat_dl):
     assert cat_dl[0].contains('NA00001')
     assert not cat_dl[0].contains('NA00005')
@@ -299,17 +320,81 @@ def test_cat_dataloader_infer_splicemap_cat_with_splicemap_cat_not_in_splicemap(
         cat_dl_no_splicemap_cat.infer(junction_id, gene_id, tissue, sample, event_type)
 
 
-# def test_cat_dataloader_infer_all(cat_dl):
+def _infer_reference(cat, junction_id, gene_id, tissue, sample, event_type,
+                     clip_threshold=0.01):
+    # scalar `.loc` lookups independent of the lookup tables of CatInference
+    if event_type == 'psi5':
+        ct_cat, psi_cat_df = cat.ct_cat5, cat.ct_cat5.psi5
+        ref_psi_cat_df = cat.ref_psi5_cat.df
+        splicemap_target_df = cat.splicemap5_dict[tissue]
+    else:
+        ct_cat, psi_cat_df = cat.ct_cat3, cat.ct_cat3.psi3
+        ref_psi_cat_df = cat.ref_psi3_cat.df
+        splicemap_target_df = cat.splicemap3_dict[tissue]
+
+    ref_psi_target = splicemap_target_df.loc[(junction_id, gene_id)]['ref_psi']
+    psi_cat = psi_cat_df.loc[junction_id, sample]
+    ref_psi_cat = ref_psi_cat_df.loc[junction_id]['ref_psi']
+    delta_logit_psi_cat = logit(psi_cat, clip_threshold) - \
+        logit(ref_psi_cat, clip_threshold)
+    return {
+        'junction': junction_id,
+        'gene_id': gene_id,
+        'sample': sample,
+        'tissue': tissue,
+        'count_cat': ct_cat.df.loc[junction_id, sample],
+        'psi_cat': psi_cat,
+        'ref_psi_cat': ref_psi_cat,
+        'k_cat': ref_psi_cat_df.loc[junction_id]['k'],
+        'n_cat': ref_psi_cat_df.loc[junction_id]['n'],
+        'median_n_cat': ref_psi_cat_df.loc[junction_id]['median_n'],
+        'delta_logit_psi_cat': delta_logit_psi_cat,
+        'delta_psi_cat': delta_logit_PSI_to_delta_PSI(
+            delta_logit_psi_cat, ref_psi_target, clip_threshold=clip_threshold),
+        'tissue_cat': ct_cat.name
+    }
+
+
+def test_cat_dataloader_infer_all(cat_dl):
+    for cat in cat_dl:
+        df_common = pd.concat([cat.common5, cat.common3])
+        rows = [
+            (row.junctions, row.gene_id, row.tissue, sample, row.event_type)
+            for row in df_common.itertuples()
+            for sample in sorted(cat.samples)
+        ]
+        junctions, gene_ids, tissues, samples, event_types = zip(*rows)
+
+        df = cat.infer_all(junctions, gene_ids, tissues, samples, event_types)
+        df_expected = pd.DataFrame([_infer_reference(cat, *row) for row in rows])
+        pd.testing.assert_frame_equal(
+            df, df_expected[df.columns].astype(df.dtypes.to_dict()))
+
+    df = cat_dl[0].infer_all([], [], [], [], [])
+    assert df.shape[0] == 0
 
-#     df = cat_dl[0].infer_all('psi5')
+    with pytest.raises(ValueError):
+        cat_dl[0].infer_all(['17:41201211-41203079:-'], ['ENSG00000012048'],
+                            ['Testis'], ['NA00002'], ['psi7'])
 
-#     common_junctions = [i for sublist in cat_dl[0].common_junctions5 for i in sublist]
-#     assert len(set(common_junctions)) == len(set(df.index.get_level_values('junction')))
 
-#     tissues = cat_dl[0].tissues5
-#     assert len(set(tissues)) == len(set(df.index.get_level_values('tissue')))
+def test_cat_dataloader_infer_empty_splicemap_cat():
+    splicemap_cat5 = SpliceMap.read_csv(ref_table5_kn_blood)
+    splicemap_cat5.df = splicemap_cat5.df.head(0)
 
-#     samples = cat_dl[0].samples
-#     assert len(set(samples)) == len(set(df.index.get_level_values('sample')))
+    cat_dl_splicemap_cat = CatInference(
+        splicemap5=[ref_table5_kn_testis, ref_table5_kn_lung],
+        count_cat=count_cat_file_blood,
+        splicemap_cat5=splicemap_cat5,
+        name='blood',
+    )
+    cat_dl_no_splicemap_cat = CatInference(
+        splicemap5=[ref_table5_kn_testis, ref_table5_kn_lung],
+        count_cat=count_cat_file_blood,
+        name='blood',
+    )
+    assert cat_dl_splicemap_cat.splicemap5_cat.df.shape[0] == 0
 
-#     assert df.shape[0] <= len(set(common_junctions)) * len(set(tissues)) * len(set(samples))
\ No newline at end of file
+    args = ('17:41277787-41283224:+', 'ENSG00000198496', 'Testis', 'NA00002', 'psi5')
+    assert cat_dl_splicemap_cat.infer(*args) == \
+        cat_dl_no_splicemap_cat.infer(*args)
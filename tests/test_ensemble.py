@@ -1,3 +1,11 @@
+import pickle
+import numpy as np
+import pandas as pd
+from interpret.glassbox import ExplainableBoostingClassifier
+from absplice.ensemble import train_model_ebm, TrainingData, \
+    write_training_data
+
+
 # import random
 # import pytest
 # import pandas as pd
@@ -135,3 +143,91 @@
 #         *results.gene.index.names, *features_DNA_CAT,
 #         'fold', 'y_test', 'y_pred', 'y_pred_on_train_features'
 #     ])
+
+
+def _df_ensemble(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_arrays([
+        ['gene_%d' % i for i in range(n)],
+        ['sample_%d' % (i % 10) for i in range(n)],
+        ['Lung'] * n], names=['gene_name', 'sample', 'tissue'])
+    df = pd.DataFrame({
+        'delta_psi': rng.normal(size=n),
+        'delta_score': rng.uniform(size=n),
+    }, index=index)
+    df['outlier'] = (df['delta_psi'] + df['delta_score'] > 1).astype(int)
+    df.loc[df.index[::7], 'delta_psi'] = np.nan
+    return df
+
+
+def test_train_model_ebm_n_jobs():
+    df = _df_ensemble()
+    model = ExplainableBoostingClassifier(
+        outer_bags=1, inner_bags=0, max_rounds=100, n_jobs=1)
+    kwargs = dict(features=['delta_psi', 'delta_score'],
+                  features_train=['delta_psi', 'delta_score'],
+                  features_test=['delta_score', 'delta_psi'],
+                  chosen_model=model, nsplits=3, random_state=1)
+
+    results, models = train_model_ebm(df, **kwargs)
+    results_parallel, models_parallel = train_model_ebm(df, n_jobs=3, **kwargs)
+
+    pd.testing.assert_frame_equal(results, results_parallel)
+    assert results.shape[0] == df.shape[0]
+    assert results['y_pred'].notna().all()
+    assert [m.get_params()['random_state'] for m in models_parallel] == [1, 2, 3]
+    assert all(m.get_params()['max_rounds'] == 100 for m in models)
+    # chosen_model is not fitted itself
+    assert not hasattr(model, 'additive_terms_')
+
+
+def test_write_training_data(tmp_path):
+    df = _df_ensemble()
+    df[['delta_psi', 'delta_score']] = df[['delta_psi', 'delta_score']] \
+        .astype(np.float32).astype(np.float64)
+    features = ['delta_psi', 'delta_score']
+
+    shards = tmp_path / 'shards'
+    shards.mkdir()
+    df.iloc[:150].reset_index().to_parquet(shards / 'part-00000.parquet')
+    df.iloc[150:].reset_index().to_parquet(shards / 'part-00001.parquet')
+
+    data = write_training_data(
+        shards, tmp_path / 'training', features, chunksize=100)
+    assert isinstance(data.X, np.memmap)
+    assert data.X.dtype == np.float32
+    assert len(data) == df.shape[0]
+    np.testing.assert_array_equal(data.y, df['outlier'])
+    pd.testing.assert_frame_equal(
+        data.index.astype(str), df.index.to_frame(index=False))
+
+    # only the path is pickled
+    assert pickle.loads(pickle.dumps(data)).__dict__.keys() \
+        == data.__dict__.keys()
+    assert len(pickle.dumps(data)) < 1000
+
+    model = ExplainableBoostingClassifier(
+        outer_bags=1, inner_bags=0, max_rounds=100, n_jobs=1)
+    results, _ = train_model_ebm(
+        df, features, chosen_model=model, nsplits=3, random_state=1)
+    results_mmap, _ = train_model_ebm(
+        TrainingData.load(tmp_path / 'training'), features,
+        chosen_model=model, nsplits=3, random_state=1, n_jobs=2)
+
+    pd.testing.assert_frame_equal(
+        results, results_mmap, check_dtype=False, check_categorical=False)
+
+
+def test_train_model_ebm_save_results_parquet(tmp_path):
+    df = _df_ensemble()
+    model = ExplainableBoostingClassifier(
+        outer_bags=1, inner_bags=0, max_rounds=100, n_jobs=1)
+    results, _ = train_model_ebm(
+        df, ['delta_psi', 'delta_score'], chosen_model=model, nsplits=3,
+        save_dir=tmp_path, save_results=True, results_format='parquet')
+
+    df_saved = pd.read_parquet(tmp_path / 'results_all.parquet')
+    assert df_saved['fold'].isna().sum() == df['delta_psi'].isna().sum()
+    pd.testing.assert_frame_equal(
+        df_saved.drop(columns='fold'), results.drop(columns='fold'))
+    assert results.shape[0] == df.shape[0]
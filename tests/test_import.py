@@ -0,0 +1,48 @@
+import sys
+import json
+import subprocess
+import pytest
+
+
+def _import_absplice(statement='import absplice'):
+    code = (
+        'import sys, json, time\n'
+        'start = time.perf_counter()\n'
+        '%s\n'
+        'print(json.dumps({"time": time.perf_counter() - start, '
+        '"modules": list(sys.modules)}))' % statement)
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_import_absplice_is_lazy():
+    modules = set(_import_absplice()['modules'])
+    for module in ['mmsplice', 'tensorflow', 'keras', 'splicemap', 'kipoi',
+                   'kipoiseq', 'interpret', 'sklearn', 'pkg_resources',
+                   'absplice.model', 'absplice.cat_dataloader']:
+        assert module not in modules
+
+    modules = set(_import_absplice(
+        'from absplice import CatInference, SpliceOutlierDataloader')['modules'])
+    assert 'absplice.cat_dataloader' in modules
+    assert 'absplice.dataloader' in modules
+    assert 'absplice.model' not in modules
+
+
+def test_import_absplice_unknown_attribute():
+    import absplice
+    with pytest.raises(AttributeError):
+        absplice.SpliceOutlierResult
+
+
+def test_import_absplice_all():
+    import absplice
+    assert len(set(absplice.__all__)) == len(absplice.__all__)
+    # names of `from absplice import *`, lazy attributes are not imported
+    assert set(absplice.__all__).issubset(dir(absplice))
+
+
+def test_benchmark_import_absplice(benchmark):
+    result = benchmark.pedantic(_import_absplice, rounds=3, iterations=1)
+    assert result['time'] < 5
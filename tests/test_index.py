@@ -0,0 +1,117 @@
+import pytest
+import numpy as np
+import pandas as pd
+from absplice import SplicingOutlierResult
+from absplice.index import VariantTable, VariantIndex, SpliceAIVcfIndex, \
+    write_variant_index, read_vcf_variants, split_variants
+from absplice.utils import read_spliceai, read_spliceai_vcf
+from conftest import mmsplice_path, spliceai_path, spliceai_vcf_path2, \
+    var_samples_path, vcf_file
+
+
+def _sort(df):
+    return df.sort_values(list(df.columns[:4])).reset_index(drop=True)
+
+
+def test_split_variants():
+    chroms, positions = split_variants(['17:41201201:TTC>CA', 'chr1:5:A>G'])
+    assert chroms.tolist() == ['17', 'chr1']
+    assert positions.tolist() == [41201201, 5]
+
+
+def test_read_vcf_variants():
+    assert read_vcf_variants(vcf_file).tolist() == [
+        '17:41201201:TTC>CA', '17:41276032:T>A', '17:41279042:A>GA']
+
+
+@pytest.mark.parametrize('path, reader', [
+    (mmsplice_path, pd.read_csv),
+    (spliceai_path, read_spliceai),
+    (spliceai_vcf_path2, read_spliceai_vcf)
+])
+def test_variant_index_query(tmp_path, path, reader):
+    df = reader(path)
+    index = write_variant_index(path, tmp_path / 'index', row_group_size=1)
+    assert index.chromosomes == ['17']
+    index = VariantIndex(tmp_path / 'index')
+
+    variants = ['17:41276032:T>A', '17:41201201:TTC>CA', '1:41276032:T>A']
+    pd.testing.assert_frame_equal(
+        _sort(index.query(variants)),
+        _sort(df[df['variant'].isin(variants)]), check_dtype=False)
+
+    df_empty = index.query(['1:41276032:T>A'])
+    assert df_empty.shape[0] == 0
+    assert df_empty.columns.tolist() == df.columns.tolist()
+
+
+def test_variant_index_benchmark_query(tmp_path, benchmark):
+    rng = np.random.default_rng(0)
+    n = 200000
+    positions = rng.integers(1, 10**8, n)
+    df = pd.DataFrame({
+        'variant': ['%d:%d:A>G' % (c, p)
+                    for c, p in zip(rng.integers(1, 23, n), positions)],
+        'gene_name': 'BRCA1',
+        'delta_score': rng.random(n)
+    })
+    index = write_variant_index(df, tmp_path / 'index')
+    variants = rng.choice(df['variant'], 1000, replace=False)
+
+    df_query = benchmark(index.query, variants)
+    assert set(df_query['variant']) == set(variants)
+
+
+def test_variant_index_empty(tmp_path):
+    with pytest.raises(TypeError):
+        VariantTable()
+
+    index = write_variant_index(
+        pd.read_csv(mmsplice_path).head(0), tmp_path / 'index')
+    assert index.chromosomes == []
+    df = index.query(['17:41276032:T>A'])
+    assert df.shape[0] == 0
+    assert 'variant' in df.columns
+
+
+def test_spliceai_vcf_index_query():
+    # test.vcf.gz is tabix-indexed but has no SpliceAI annotations
+    index = SpliceAIVcfIndex(vcf_file)
+    df = index.query(['17:41276032:T>A'])
+    assert df.shape[0] == 0
+    assert df.columns.tolist() == read_spliceai_vcf(
+        spliceai_vcf_path2).columns.tolist()
+
+
+def test_spliceai_vcf_index_without_cyvcf2(monkeypatch):
+    import sys
+    monkeypatch.setitem(sys.modules, 'cyvcf2', None)
+    with pytest.raises(ImportError, match='cyvcf2'):
+        SpliceAIVcfIndex(vcf_file).query(['17:41276032:T>A'])
+
+
+def test_splicing_outlier_result_variant_index(tmp_path):
+    df_var_samples = pd.read_csv(var_samples_path)
+    df_var_samples = df_var_samples[df_var_samples['sample'] == 'NA00002']
+
+    sor = SplicingOutlierResult(
+        df_mmsplice=write_variant_index(mmsplice_path, tmp_path / 'mmsplice'),
+        df_spliceai=write_variant_index(spliceai_path, tmp_path / 'spliceai'),
+        df_var_samples=df_var_samples)
+    sor_full = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=df_var_samples)
+
+    pd.testing.assert_frame_equal(
+        _sort(sor.df_mmsplice), _sort(sor_full.df_mmsplice))
+    pd.testing.assert_frame_equal(
+        _sort(sor.df_spliceai), _sort(sor_full.df_spliceai))
+
+    sor = SplicingOutlierResult(
+        df_spliceai=VariantIndex(tmp_path / 'spliceai'),
+        variants=['17:41276032:T>A'])
+    assert set(sor.df_spliceai['variant']) == {'17:41276032:T>A'}
+
+    with pytest.raises(ValueError):
+        SplicingOutlierResult(df_spliceai=VariantIndex(tmp_path / 'spliceai'))
@@ -1,3 +1,5 @@
+import os
+import shutil
 import pytest
 import pandas as pd
 import numpy as np
@@ -5,8 +7,9 @@ from kipoiseq.extractors.vcf import MultiSampleVCF
 # from kipoiseq.extractors.vcf_query import to_sample_csv
 from absplice import SpliceOutlier, SpliceOutlierDataloader, CatInference, SplicingOutlierResult
 from absplice.ensemble import train_model_ebm
-from absplice.utils import inject_new_row
-from absplice.result import GENE_MAP, GENE_TPM
+from absplice.utils import inject_new_row, read_spliceai
+from absplice.result import GENE_MAP, GENE_TPM, ABSPLICE_DNA, ABSPLICE_RNA, \
+    ABSPLICE_DNA_SCORER, ABSPLICE_RNA_SCORER, load_model, preload_models, clear_model_cache
 from conftest import df_mmsplice_cat, multi_vcf_file, \
     mmsplice_path, spliceai_path, mmsplice_cat_path, var_samples_path, \
         fasta_file, ref_table5_kn_testis, ref_table5_kn_lung, ref_table3_kn_testis, ref_table3_kn_lung, spliceai_vcf_path2
@@ -245,6 +248,26 @@ def test_splicing_outlier_result_predict_absplice_dna():
     assert 'AbSplice_DNA' in sor._absplice_dna.columns
     
     
+def test_load_model(tmp_path):
+    clear_model_cache()
+    model_dna, model_rna = preload_models([ABSPLICE_DNA, ABSPLICE_RNA])
+    assert load_model(ABSPLICE_DNA) is model_dna
+    assert load_model(ABSPLICE_RNA) is model_rna
+    scorer_dna, scorer_rna = preload_models()
+    assert load_model(ABSPLICE_DNA_SCORER) is scorer_dna
+    assert load_model(ABSPLICE_RNA_SCORER) is scorer_rna
+
+    pickle_file = tmp_path / 'model.pkl'
+    shutil.copy(ABSPLICE_DNA, pickle_file)
+    model = load_model(pickle_file)
+    assert load_model(str(pickle_file)) is model
+
+    # model is loaded again if the file changes
+    mtime = os.path.getmtime(pickle_file)
+    os.utime(pickle_file, (mtime + 10, mtime + 10))
+    assert load_model(pickle_file) is not model
+
+
 def test_splicing_outlier_result_predict_absplice_rna():
     sor = SplicingOutlierResult(
         df_mmsplice=mmsplice_path, 
@@ -255,4 +278,332 @@ def test_splicing_outlier_result_predict_absplice_rna():
     sor.predict_absplice_rna()
     assert 'AbSplice_RNA' in sor._absplice_rna.columns
 
-    
\ No newline at end of file
+
+def test_splicing_outlier_result_absplice_dna_input_tissues():
+    df_mmsplice = pd.read_csv(mmsplice_path).iloc[[0, 0]]
+    df_mmsplice['variant'] = ['17:10:A>G', '17:10:A>G']
+    df_mmsplice['gene_id'] = ['G1', 'G2']
+    df_mmsplice['tissue'] = ['T1', 'T2']
+    df_mmsplice['delta_psi'] = [0.5, 0.3]
+    df_spliceai = pd.DataFrame({
+        'variant': ['17:10:A>G', '17:10:A>G', '17:10:A>G', '17:20:A>G'],
+        'gene_name': ['BRCA1', 'BRCA1', 'UNKNOWN', 'BRCA1'],
+        'delta_score': [0.2, 0.4, 0.9, 0.1]
+    })
+    gene_tpm = pd.DataFrame({
+        'gene_id': ['G1', 'G1', 'G2', 'G2'],
+        'tissue': ['T1', 'T2', 'T1', 'T2'],
+        'gene_tpm': [1., 2., 3., 4.]
+    })
+    sor = SplicingOutlierResult(
+        df_mmsplice=df_mmsplice,
+        df_spliceai=df_spliceai,
+        gene_map=pd.DataFrame({'gene_name': ['BRCA1'], 'gene_id': ['G1']}),
+        gene_tpm=gene_tpm)
+
+    df = sor.absplice_dna_input.reset_index()
+    df['gene_id'] = df['gene_id'].fillna('NA')
+    df = df.set_index(['variant', 'gene_id', 'tissue'])
+    assert df.shape[0] == 7
+    assert df.loc[('17:10:A>G', 'G1', 'T1'), 'delta_psi'] == 0.5
+    assert df.loc[('17:10:A>G', 'G1', 'T1'), 'delta_score'] == 0.4
+    assert np.isnan(df.loc[('17:10:A>G', 'G1', 'T2'), 'delta_psi'])
+    assert df.loc[('17:10:A>G', 'G1', 'T2'), 'delta_score'] == 0.4
+    # spliceai predictions of genes missing in gene_map are not joined
+    # to other genes
+    assert df.loc[('17:10:A>G', 'G2', 'T2'), 'delta_psi'] == 0.3
+    assert np.isnan(df.loc[('17:10:A>G', 'G2', 'T2'), 'delta_score'])
+    assert df.loc[('17:10:A>G', 'NA', 'T1'), 'delta_score'] == 0.9
+    assert df.loc[('17:10:A>G', 'NA', 'T2'), 'delta_score'] == 0.9
+    assert df.loc[('17:20:A>G', 'G1', 'T2'), 'delta_score'] == 0.1
+    assert df.loc[('17:20:A>G', 'G1', 'T2'), 'gene_tpm'] == 2.
+    assert np.isnan(df.loc[('17:10:A>G', 'NA', 'T1'), 'gene_tpm'])
+
+
+def test_splicing_outlier_result_join_tissue_independent():
+    sor = SplicingOutlierResult(
+        df_spliceai=pd.read_csv(spliceai_path),
+        gene_tpm=pd.DataFrame({
+            'gene_id': ['G1', 'G1', 'G2'],
+            'tissue': ['T1', 'T2', 'T1'],
+            'gene_tpm': [1., 2., 3.]
+        }),
+        tissues=['T1', 'T2'])
+    groupby = ['variant', 'gene_id', 'tissue']
+    df = pd.DataFrame({
+        'variant': ['v1', 'v1', 'v2'],
+        'gene_id': ['G1', 'G3', 'G2'],
+        'tissue': ['T1', 'T1', 'T2'],
+        'delta_psi': [0.1, 0.2, 0.3],
+        'gene_name': ['A', 'C', 'B'],
+    }).set_index(groupby)
+    df_tissue_independent = pd.DataFrame({
+        'variant': ['v1', 'v1', 'v2'],
+        'gene_id': ['G1', np.nan, 'G2'],
+        'delta_score': [0.4, 0.5, 0.6],
+        'gene_name': ['A', 'D', 'B'],
+    }).set_index(['variant', 'gene_id'])
+
+    df_broadcast = sor._broadcast_tissues(
+        df_tissue_independent, groupby, exclude=df.index)
+    # keys of `df` are excluded per tissue, G3 of `df` does not exclude
+    # the missing gene_id
+    assert sorted(df_broadcast.reset_index()[groupby].fillna('NA')
+                  .itertuples(index=False, name=None)) == [
+        ('v1', 'G1', 'T2'), ('v1', 'NA', 'T1'), ('v1', 'NA', 'T2'),
+        ('v2', 'G2', 'T1')]
+
+    df_joined = sor._join_tissue_independent(df, df_tissue_independent, groupby)
+    assert df_joined.index.is_unique
+    assert df_joined.columns.tolist() == [
+        'delta_psi', 'gene_name', 'delta_score', 'gene_name_spliceai',
+        'gene_tpm']
+    df_expected = pd.DataFrame({
+        'variant': ['v1', 'v1', 'v2', 'v2', 'v1', 'v1', 'v1'],
+        'gene_id': ['G1', 'G1', 'G2', 'G2', 'G3', np.nan, np.nan],
+        'tissue': ['T1', 'T2', 'T1', 'T2', 'T1', 'T1', 'T2'],
+        'delta_psi': [0.1, np.nan, np.nan, 0.3, 0.2, np.nan, np.nan],
+        'delta_score': [0.4, 0.4, 0.6, 0.6, np.nan, 0.5, 0.5],
+        'gene_name_spliceai': ['A', 'A', 'B', 'B', np.nan, 'D', 'D'],
+        'gene_tpm': [1., 2., 3., np.nan, np.nan, np.nan, np.nan],
+    }).astype({name: pd.StringDtype() for name in groupby})
+    pd.testing.assert_frame_equal(
+        df_joined.reset_index()[df_expected.columns], df_expected)
+
+
+def test_splicing_outlier_result_compact():
+    sor = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=var_samples_path)
+    sor_compact = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=var_samples_path,
+        compact=True)
+
+    for col in ['variant', 'gene_id', 'tissue', 'sample']:
+        assert sor_compact.df_mmsplice[col].dtype == 'category'
+    # categories are shared, so joins keep categoricals
+    for col in ['variant', 'gene_id', 'sample']:
+        assert sor_compact.df_mmsplice[col].dtype \
+            == sor_compact.df_spliceai[col].dtype
+    assert sor_compact.df_mmsplice['delta_psi'].dtype == 'float32'
+    assert sor_compact.df_mmsplice['k'].dtype == 'Int32'
+
+    df = sor.predict_absplice_dna()
+    df_compact = sor_compact.predict_absplice_dna()
+    # index levels keep the dtypes of the inputs
+    for col in ['variant', 'gene_id', 'tissue', 'sample']:
+        assert df.index.get_level_values(col).dtype == pd.StringDtype()
+        assert df_compact.index.get_level_values(col).dtype == 'category'
+        assert sor_compact.absplice_dna_input.index \
+            .get_level_values(col).dtype == 'category'
+
+    df, df_compact = df.reset_index(), df_compact.reset_index()
+    for col in ['variant', 'gene_id', 'tissue', 'sample']:
+        pd.testing.assert_series_equal(
+            df[col], df_compact[col].astype(df[col].dtype))
+    np.testing.assert_allclose(
+        df['AbSplice_DNA'], df_compact['AbSplice_DNA'], rtol=1e-5)
+
+    memory = sor.memory_usage()
+    memory_compact = sor_compact.memory_usage()
+    assert memory['df_mmsplice'] > memory_compact['df_mmsplice']
+
+
+def test_splicing_outlier_result_required_columns():
+    sor = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=var_samples_path)
+    sor_required = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=var_samples_path,
+        all_columns=False)
+
+    assert 'transcript_id' in sor.df_mmsplice.columns
+    assert 'transcript_id' not in sor_required.df_mmsplice.columns
+    assert 'acceptor_gain' not in sor_required.df_spliceai.columns
+    assert sor_required.df_mmsplice.dtypes.to_dict() == \
+        sor.df_mmsplice[sor_required.df_mmsplice.columns].dtypes.to_dict()
+
+    pd.testing.assert_frame_equal(
+        sor.predict_absplice_dna(), sor_required.predict_absplice_dna())
+
+
+def test_splicing_outlier_result_optional_columns(tmp_path):
+    # SpliceAI predictions already joined with samples
+    df_spliceai = read_spliceai(spliceai_path).merge(
+        pd.read_csv(var_samples_path), on='variant')
+    path = tmp_path / 'spliceai.csv'
+    df_spliceai.to_csv(path, index=False)
+
+    sor = SplicingOutlierResult(df_spliceai=path, all_columns=False)
+    assert 'acceptor_gain' not in sor.df_spliceai.columns
+    assert {'gene_id', 'sample'}.issubset(sor.df_spliceai.columns)
+    assert sor.df_spliceai.shape[0] == df_spliceai.shape[0]
+
+
+def test_splicing_outlier_result_sparse_samples():
+    sor = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=var_samples_path)
+    sor_sparse = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=var_samples_path,
+        sparse_samples=True)
+
+    assert 'sample' not in sor_sparse.df_mmsplice.columns
+    assert sor_sparse.df_mmsplice.shape[0] < sor.df_mmsplice.shape[0]
+
+    for prop in ['gene_mmsplice', 'variant_mmsplice', 'junction',
+                 'gene_spliceai', 'variant_spliceai']:
+        df = getattr(sor, prop)
+        pd.testing.assert_frame_equal(
+            df, getattr(sor_sparse, prop)[df.columns])
+
+    df_dna = sor.predict_absplice_dna()
+    df_dna_sparse = sor_sparse.predict_absplice_dna()
+    assert 'sample' not in df_dna_sparse.index.names
+    df = sor.gene_absplice_dna
+    pd.testing.assert_frame_equal(
+        df, sor_sparse.gene_absplice_dna[df.columns], check_index_type=False)
+
+    groupby = ['variant', 'gene_id', 'tissue', 'sample']
+    df = df_dna.reset_index().sort_values(groupby)
+    df_sparse = sor_sparse.expand_samples(df_dna_sparse).reset_index() \
+        .sort_values(groupby)
+    assert df.shape == df_sparse.shape
+    np.testing.assert_allclose(df['AbSplice_DNA'], df_sparse['AbSplice_DNA'])
+
+
+def test_splicing_outlier_result_does_not_modify_inputs():
+    df_mmsplice = pd.read_csv(mmsplice_path)
+    df_spliceai = read_spliceai(spliceai_path)
+    columns_mmsplice = df_mmsplice.columns.tolist()
+    columns_spliceai = df_spliceai.columns.tolist()
+
+    SplicingOutlierResult(df_mmsplice=df_mmsplice, df_spliceai=df_spliceai,
+                          gene_map=GENE_MAP)
+    assert df_mmsplice.columns.tolist() == columns_mmsplice
+    assert df_spliceai.columns.tolist() == columns_spliceai
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_splicing_outlier_result_update_samples(compact):
+    df_var_samples = pd.read_csv(var_samples_path)
+    df_mmsplice_cat = pd.read_csv(mmsplice_cat_path)
+    sor = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_mmsplice_cat=df_mmsplice_cat,
+        df_var_samples=df_var_samples,
+        compact=compact,
+        sparse_samples=True)
+    sor_update = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_mmsplice_cat=df_mmsplice_cat[df_mmsplice_cat['sample'] == 'NA00002'],
+        df_var_samples=df_var_samples[df_var_samples['sample'] == 'NA00002'],
+        compact=compact,
+        sparse_samples=True)
+
+    props = ['gene_mmsplice', 'variant_mmsplice', 'junction', 'gene_spliceai',
+             'gene_absplice_dna', 'variant_absplice_dna', 'gene_mmsplice_cat',
+             'variant_mmsplice_cat', 'gene_absplice_rna', 'variant_absplice_rna']
+    for _sor in [sor, sor_update]:
+        _sor.predict_absplice_dna()
+        _sor.predict_absplice_rna()
+        for prop in props:
+            getattr(_sor, prop)
+    assert set(sor_update.gene_absplice_rna.index.get_level_values('sample')) \
+        == {'NA00002'}
+    assert set(sor_update.gene_absplice_dna.index.get_level_values('sample')) \
+        == {'NA00002'}
+
+    sor_update.update_samples(
+        df_var_samples[df_var_samples['sample'] == 'NA00003'],
+        df_mmsplice=mmsplice_path, df_spliceai=spliceai_path,
+        df_mmsplice_cat=df_mmsplice_cat)
+
+    def _sort(df):
+        df = df.reset_index()
+        return df.sort_values(df.columns.tolist()).reset_index(drop=True)
+
+    for prop in props:
+        pd.testing.assert_frame_equal(
+            _sort(getattr(sor, prop)), _sort(getattr(sor_update, prop)),
+            check_categorical=False)
+    for attr in ['_absplice_dna', '_absplice_rna']:
+        pd.testing.assert_frame_equal(
+            _sort(getattr(sor, attr)), _sort(getattr(sor_update, attr)),
+            check_categorical=False)
+    assert set(sor_update.df_mmsplice['variant']) \
+        == set(sor.df_mmsplice['variant'])
+
+    with pytest.raises(ValueError):
+        sor_update.update_samples(df_var_samples)
+
+
+def test_splicing_outlier_result_update_samples_without_cat():
+    df_var_samples = pd.read_csv(var_samples_path)
+    sor = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_absplice_rna=SplicingOutlierResult(
+            df_mmsplice=mmsplice_path,
+            df_spliceai=spliceai_path,
+            df_mmsplice_cat=mmsplice_cat_path,
+            df_var_samples=var_samples_path).predict_absplice_rna(),
+        df_var_samples=df_var_samples[df_var_samples['sample'] == 'NA00002'],
+        sparse_samples=True)
+
+    # AbSplice-RNA can not be recomputed without CAT predictions
+    with pytest.raises(ValueError):
+        sor.update_samples(
+            df_var_samples[df_var_samples['sample'] == 'NA00003'],
+            df_mmsplice=mmsplice_path, df_spliceai=spliceai_path)
+
+
+@pytest.mark.parametrize('sparse_samples, compact', [
+    (False, False), (True, False), (True, True)])
+def test_splicing_outlier_result_filter_maf(tmp_path, sparse_samples, compact):
+    gene_map = pd.read_csv(GENE_MAP, sep='\t')
+    sor = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=var_samples_path,
+        gene_map=gene_map[gene_map['gene_name'].str.startswith('BRCA', na=False)],
+        tissues=['Testis', 'Lung'],
+        compact=compact,
+        sparse_samples=sparse_samples)
+
+    df_var_samples = pd.read_csv(var_samples_path)
+    num_samples = df_var_samples.groupby('variant')['sample'].nunique()
+    private = set(num_samples[num_samples <= 1].index)
+
+    sor_private = sor.filter_maf(max_num_sample=1)
+    assert set(sor_private.df_mmsplice['variant']) \
+        == private & set(sor.df_mmsplice['variant'])
+    assert sor_private.compact == compact
+    assert sor_private.sparse_samples == sparse_samples
+    assert sor_private.tissues == ['Testis', 'Lung']
+    assert (sor_private.var_samples is not None) == sparse_samples
+    pd.testing.assert_frame_equal(sor_private.gene_map, sor.gene_map)
+    pd.testing.assert_frame_equal(sor_private.gene_tpm, sor.gene_tpm)
+
+    common, rare = sorted(private)[0], sorted(num_samples.index)[-1]
+    population = pd.DataFrame({'variant': [common, rare], 'maf': [0.1, 0.0001]})
+    population.to_parquet(tmp_path / 'population.parquet', index=False)
+
+    for _population in [dict(zip(population['variant'], population['maf'])),
+                        population.set_index('variant')['maf'],
+                        tmp_path / 'population.parquet']:
+        df = sor.filter_maf(max_num_sample=1, population=_population).df_mmsplice
+        assert common not in set(df['variant'])
+        assert set(df['variant']) == set(sor_private.df_mmsplice['variant']) - {common}
+        assert df['maf'].isin([-1, 0.0001]).all()
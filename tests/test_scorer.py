@@ -0,0 +1,58 @@
+import pytest
+import numpy as np
+import pandas as pd
+from absplice.result import ABSPLICE_DNA, ABSPLICE_RNA, \
+    ABSPLICE_DNA_SCORER, ABSPLICE_RNA_SCORER, load_model
+from absplice.scorer import EBMScorer, export_ebm
+
+
+def _features(model, n=10000, seed=0):
+    rng = np.random.default_rng(seed)
+    scorer = EBMScorer.from_ebm(model)
+    df = pd.DataFrame({
+        name: rng.normal(scale=0.5, size=n)
+        for name in scorer.feature_names
+    })
+    df['delta_score'] = rng.random(n)
+    df['splice_site_is_expressed'] = rng.integers(0, 2, n)
+    # values on bin edges
+    n_edges = min(n, 100)
+    for i, cuts in scorer.binning.cuts.items():
+        df.iloc[:n_edges, i] = rng.choice(cuts, n_edges)
+    return df
+
+
+@pytest.mark.parametrize('pickle_file, npz_file', [
+    (ABSPLICE_DNA, ABSPLICE_DNA_SCORER),
+    (ABSPLICE_RNA, ABSPLICE_RNA_SCORER)
+])
+def test_ebm_scorer_predict_proba(pickle_file, npz_file):
+    model = load_model(pickle_file)
+    df = _features(model)
+
+    proba = model.predict_proba(df)
+    np.testing.assert_array_equal(
+        EBMScorer.from_ebm(model).predict_proba(df), proba)
+    np.testing.assert_array_equal(load_model(npz_file).predict_proba(df), proba)
+    np.testing.assert_array_equal(
+        load_model(npz_file).predict_proba(df.values), proba)
+
+
+def test_ebm_scorer_unknown_category():
+    model = load_model(ABSPLICE_DNA)
+    df = _features(model, n=10)
+    df['splice_site_is_expressed'] = 2
+    np.testing.assert_array_equal(
+        load_model(ABSPLICE_DNA_SCORER).predict_proba(df),
+        model.predict_proba(df))
+
+
+def test_export_ebm(tmp_path):
+    scorer = export_ebm(ABSPLICE_RNA, tmp_path / 'model.npz')
+    scorer_loaded = EBMScorer.load(tmp_path / 'model.npz')
+    assert scorer_loaded.feature_names == scorer.feature_names
+    assert scorer_loaded.term_features == scorer.term_features
+
+    df = _features(load_model(ABSPLICE_RNA), n=1000)
+    np.testing.assert_array_equal(
+        scorer_loaded.predict_proba(df), scorer.predict_proba(df))
@@ -1,7 +1,11 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 import pandas as pd
 import numpy as np
-from absplice import SpliceOutlier, SpliceOutlierDataloader, CatInference
+from absplice import SpliceOutlier, SpliceOutlierDataloader, CatInference, \
+    PredictionCache
 from absplice.ensemble import train_model_ebm
 from conftest import fasta_file, multi_vcf_file, \
     ref_table5_kn_testis, ref_table3_kn_testis,  \
@@ -30,6 +34,189 @@ def test_splicing_outlier_predict_save(outlier_model, outlier_dl, tmp_path, mmsp
     assert sorted(df.columns.tolist()) == mmsplice_splicemap_cols
 
 
+def test_splicing_outlier_predict_save_batch_size(outlier_model, outlier_dl, tmp_path, monkeypatch):
+    kwargs = list()
+    _predict_on_dataloader = outlier_model._predict_on_dataloader
+
+    def _predict(dataloader, **_kwargs):
+        kwargs.append(_kwargs)
+        return _predict_on_dataloader(dataloader, **_kwargs)
+
+    monkeypatch.setattr(outlier_model, '_predict_on_dataloader', _predict)
+    outlier_model.predict_save(
+        outlier_dl, tmp_path / 'test_mmsplice.csv', batch_size=2,
+        progress=False)
+    assert kwargs[0]['batch_size'] == 2
+    assert kwargs[0]['progress'] is False
+
+
+def test_splicing_outlier_predict_on_dataloader_prefetch(outlier_model, outlier_dl, mmsplice_splicemap_cols, caplog):
+    with caplog.at_level(logging.INFO, logger='absplice.model'):
+        results = outlier_model.predict_on_dataloader(
+            outlier_dl, batch_size=2, prefetch=2, num_workers=2)
+    assert sorted(results.df_mmsplice.columns.tolist()) == mmsplice_splicemap_cols
+    assert set(outlier_model.timings) == {
+        'predict', 'load', 'encode', 'wait', 'total'}
+    assert 'Batches: ' in caplog.text
+
+
+def test_splicing_outlier_predict_on_dataloader_n_jobs(outlier_model, outlier_dl, mmsplice_splicemap_cols):
+    results = outlier_model.predict_on_dataloader(outlier_dl, n_jobs=2)
+    assert sorted(results.df_mmsplice.columns.tolist()) == mmsplice_splicemap_cols
+
+    df = outlier_model.predict_on_dataloader(outlier_dl).df_mmsplice
+    assert results.df_mmsplice.shape == df.shape
+
+
+def test_splicing_outlier_predict_save_n_jobs(outlier_model, outlier_dl, tmp_path, mmsplice_splicemap_cols):
+    output_csv = tmp_path / 'test_mmsplice.csv'
+    outlier_model.predict_save(outlier_dl, output_csv, n_jobs=2)
+    df = pd.read_csv(output_csv)
+    assert sorted(df.columns.tolist()) == mmsplice_splicemap_cols
+    assert df.shape[0] > 0
+
+    output_parquet = tmp_path / 'test_mmsplice.parquet'
+    outlier_model.predict_save(outlier_dl, output_parquet, n_jobs=2)
+    assert len(list(output_parquet.glob('part-*.parquet'))) > 0
+    df_parquet = pd.read_parquet(output_parquet)
+    assert df_parquet.shape == df.shape
+
+
+def test_splicing_outlier_predict_save_n_jobs_prefetch(outlier_model, outlier_dl, tmp_path, monkeypatch):
+    import absplice.model
+    predict_partition = absplice.model._predict_partition
+    kwargs = list()
+
+    def _predict_partition(*args, **_kwargs):
+        kwargs.append(_kwargs)
+        return predict_partition(*args, **_kwargs)
+
+    # partitions are predicted in threads, so calls are recorded
+    monkeypatch.setattr(
+        absplice.model, 'ProcessPoolExecutor',
+        lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+    monkeypatch.setattr(absplice.model, '_predict_partition', _predict_partition)
+
+    output_csv = tmp_path / 'test_mmsplice.csv'
+    outlier_model.predict_save(
+        outlier_dl, output_csv, n_jobs=2, prefetch=2, num_workers=2)
+    assert len(kwargs) == len(outlier_dl.partition_by_chromosome())
+    assert all(k['prefetch'] == 2 and k['num_workers'] == 2 for k in kwargs)
+    assert pd.read_csv(output_csv).shape[0] > 0
+
+
+def test_splicing_outlier_predict_on_dataloader_prediction_cache(outlier_model, tmp_path, mmsplice_splicemap_cols):
+    cache = PredictionCache(tmp_path / 'cache')
+
+    def _dl():
+        return SpliceOutlierDataloader(
+            fasta_file, multi_vcf_file,
+            splicemap5=[ref_table5_kn_testis, ref_table5_kn_lung],
+            splicemap3=[ref_table3_kn_testis, ref_table3_kn_lung],
+            prediction_cache=cache)
+
+    def _sort(df):
+        return df.sort_values(['variant', 'junction', 'tissue']) \
+            .reset_index(drop=True)
+
+    dl = _dl()
+    df = outlier_model.predict_on_dataloader(dl).df_mmsplice
+    assert len(dl.cached_keys) == 0
+    assert len(cache) > 0
+
+    # all predictions are read from the cache
+    dl = _dl()
+    assert sum(1 for _ in dl.batch_iter()) == 0
+    dl = _dl()
+    df_cached = outlier_model.predict_on_dataloader(dl).df_mmsplice
+    assert len(dl.cached_keys) == len(cache)
+    assert sorted(df_cached.columns.tolist()) == mmsplice_splicemap_cols
+    pd.testing.assert_frame_equal(_sort(df), _sort(df_cached), check_dtype=False)
+
+
+def test_splicing_outlier_predict_on_dataloader_prediction_cache_prefetch(outlier_model, outlier_dl, tmp_path):
+    cache = PredictionCache(tmp_path / 'cache', flush_rows=2)
+
+    def _dl():
+        return SpliceOutlierDataloader(
+            fasta_file, multi_vcf_file,
+            splicemap5=[ref_table5_kn_testis, ref_table5_kn_lung],
+            splicemap3=[ref_table3_kn_testis, ref_table3_kn_lung],
+            prediction_cache=cache)
+
+    def _sort(df):
+        return df.sort_values(['variant', 'junction', 'tissue']) \
+            .reset_index(drop=True)
+
+    # keys are looked up by the producer thread while predictions are added
+    df = outlier_model.predict_on_dataloader(outlier_dl).df_mmsplice
+    df_prefetch = outlier_model.predict_on_dataloader(
+        _dl(), batch_size=2, prefetch=2, num_workers=2).df_mmsplice
+    pd.testing.assert_frame_equal(
+        _sort(df), _sort(df_prefetch), check_dtype=False)
+
+    dl = _dl()
+    df_cached = outlier_model.predict_on_dataloader(
+        dl, batch_size=2, prefetch=2, num_workers=2).df_mmsplice
+    assert len(dl.cached_keys) == len(cache)
+    pd.testing.assert_frame_equal(
+        _sort(df), _sort(df_cached), check_dtype=False)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_splicing_outlier_predict_save_resume(outlier_model, outlier_dl, tmp_path, n_jobs):
+    output_parquet = tmp_path / 'test_mmsplice.parquet'
+    outlier_model.predict_save(outlier_dl, output_parquet, n_jobs=n_jobs, resume=True)
+    df = pd.read_parquet(output_parquet)
+    assert df.shape[0] > 0
+
+    manifest_path = output_parquet / '_manifest.json'
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    assert list(manifest['completed']) == [
+        chromosome for chromosome, _, _ in outlier_dl.partition_by_chromosome()]
+
+    # job killed before the last partition was committed
+    chromosome, part = [(c, p) for c, p in manifest['completed'].items() if p][-1]
+    (output_parquet / part).unlink()
+    del manifest['completed'][chromosome]
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    outlier_model.predict_save(outlier_dl, output_parquet, n_jobs=n_jobs, resume=True)
+    df_resumed = pd.read_parquet(output_parquet)
+    assert df_resumed.shape == df.shape
+    assert (output_parquet / part).exists()
+
+    with pytest.raises(ValueError):
+        outlier_model.predict_save(
+            outlier_dl, tmp_path / 'test_mmsplice.csv', resume=True)
+
+
+def test_splicing_outlier_predict_save_dataloader_kwargs(outlier_model, tmp_path, monkeypatch):
+    import absplice.model
+    dataloaders = list()
+
+    class _SpliceOutlierDataloader(SpliceOutlierDataloader):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            dataloaders.append(self)
+
+    monkeypatch.setattr(
+        absplice.model, 'SpliceOutlierDataloader', _SpliceOutlierDataloader)
+
+    dl = SpliceOutlierDataloader(
+        fasta_file, multi_vcf_file,
+        splicemap5=[ref_table5_kn_testis, ref_table5_kn_lung],
+        splicemap3=[ref_table3_kn_testis, ref_table3_kn_lung],
+        cache_size=16)
+    outlier_model.predict_save(dl, tmp_path / 'test_mmsplice.parquet', resume=True)
+
+    # dataloaders of the partitions have the settings of `dl`
+    assert len(dataloaders) == len(dl.partition_by_chromosome())
+    assert all(d.seq_cache.maxsize == 16 for d in dataloaders)
+
+
 def test_multi_sample_predict(outlier_dl_multi, outlier_model):
     results = outlier_model.predict_on_dataloader(outlier_dl_multi)
     print(results.df_mmsplice.shape)
@@ -1,5 +1,11 @@
+import itertools
 import pytest
+import numpy as np
+import pandas as pd
+from splicemap import SpliceMap
 from absplice import SpliceOutlierDataloader
+from absplice.dataloader import BatchPrefetcher, EncodedSeqCache, encode_dna, \
+    write_splicemap_arrow, read_splicemap_arrow
 from conftest import fasta_file, vcf_file, multi_vcf_file, \
     ref_table5_kn_testis, ref_table3_kn_testis, ref_table5_kn_lung, ref_table3_kn_lung, \
      count_cat_file_lymphocytes
@@ -85,3 +91,180 @@ def test_splicing_outlier_dataloader_next(outlier_dl):
     assert junction['junction'] == '17:41267796-41276033:-'
     assert variant['annotation'] == '17:41276032:T>A'
     assert junction['event_type'] == 'psi3'
+
+
+def test_splicing_outlier_dataloader_partition_by_chromosome(outlier_dl, outlier_dl3):
+    partitions = outlier_dl.partition_by_chromosome()
+    assert [chrom for chrom, _, _ in partitions] == ['17']
+    _, splicemaps5, splicemaps3 = partitions[0]
+    assert len(splicemaps5) == 2
+    assert len(splicemaps3) == 2
+
+    _, splicemaps5, splicemaps3 = outlier_dl3.partition_by_chromosome()[0]
+    assert splicemaps5 is None
+    assert len(splicemaps3) == 1
+
+
+def test_batch_prefetcher(outlier_dl):
+    prefetcher = BatchPrefetcher(
+        outlier_dl, batch_size=2, queue_size=2, num_workers=2)
+    batches = list(prefetcher)
+
+    dl = SpliceOutlierDataloader(
+        fasta_file, vcf_file,
+        splicemap5=[ref_table5_kn_testis, ref_table5_kn_lung],
+        splicemap3=[ref_table3_kn_testis, ref_table3_kn_lung])
+    expected = list(dl.batch_iter(batch_size=2))
+
+    assert prefetcher.num_batches == len(expected)
+    for batch, batch_expected in zip(batches, expected):
+        assert batch['metadata']['junction']['junction'].tolist() \
+            == batch_expected['metadata']['junction']['junction'].tolist()
+        np.testing.assert_array_equal(
+            batch['inputs']['mut_seq']['acceptor'],
+            batch_expected['inputs']['mut_seq']['acceptor'])
+    assert set(prefetcher.timings) == {'load', 'encode', 'wait'}
+
+
+def _attach_junction_loc(rows, intron_annotations, event_type):
+    # per-row lookup of junction coordinates used before `_add_junction_coords`
+    for row in rows:
+        junction_id = row['metadata']['exon']['junction']
+        ref_row = intron_annotations.loc[junction_id]
+        row['metadata']['junction'] = dict()
+        row['metadata']['junction']['junction'] = ref_row.name
+        row['metadata']['junction']['event_type'] = event_type
+        row['metadata']['junction'].update(ref_row.to_dict())
+        yield row
+
+
+def _attach_junction_batch(dl, rows, event_type, batch_size=512):
+    rows = dl._iter_dl(rows, event_type)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        junctions = np.array([row['metadata']['junction']['junction']
+                              for row in batch])
+        yield dl._add_junction_coords(
+            {'metadata': {'junction': {'junction': junctions}}})
+
+
+@pytest.fixture(scope='module')
+def junction_rows():
+    dl = SpliceOutlierDataloader(
+        fasta_file, vcf_file,
+        splicemap5=[ref_table5_kn_testis, ref_table5_kn_lung])
+    rows = [
+        {'metadata': {'exon': {'junction': row['metadata']['exon']['junction']}}}
+        for row in dl.dl5
+    ]
+    return dl, rows * 1000
+
+
+@pytest.mark.benchmark(group='junction_metadata')
+def test_benchmark_junction_metadata_loc(benchmark, junction_rows):
+    dl, rows = junction_rows
+    benchmark(lambda: sum(1 for _ in _attach_junction_loc(
+        rows, dl.combined_splicemap5, 'psi5')))
+    benchmark.extra_info['rows_per_sec'] = len(rows) / benchmark.stats['mean']
+
+
+@pytest.mark.benchmark(group='junction_metadata')
+def test_benchmark_junction_metadata_batch(benchmark, junction_rows):
+    dl, rows = junction_rows
+    batches = list(_attach_junction_batch(dl, rows, 'psi5'))
+    junction = batches[0]['metadata']['junction']
+    row = next(_attach_junction_loc(rows[:1], dl.combined_splicemap5, 'psi5'))
+    assert list(junction.keys()) == list(row['metadata']['junction'].keys())
+    assert {k: v[0] for k, v in junction.items()} \
+        == row['metadata']['junction']
+
+    benchmark(lambda: sum(1 for _ in _attach_junction_batch(dl, rows, 'psi5')))
+    benchmark.extra_info['rows_per_sec'] = len(rows) / benchmark.stats['mean']
+
+
+def test_encode_dna():
+    from mmsplice.utils import encodeDNA
+    seqs = ['ACGT', 'NNAC*T', 'G', 'TTGCANNA']
+    np.testing.assert_array_equal(encode_dna(seqs), encodeDNA(seqs))
+    np.testing.assert_array_equal(
+        encode_dna(np.array(seqs)), encodeDNA(seqs))
+
+
+def test_encode_dna_invalid():
+    np.testing.assert_array_equal(
+        encode_dna(['AC', 'N*G']), [
+            [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 0, 0]],
+            [[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 1, 0]],
+        ])
+    assert encode_dna([]).shape == (0, 0, 4)
+    assert encode_dna(np.array([], dtype=str)).shape == (0, 0, 4)
+
+    for seqs in [['ACGT', 'acgt'], ['ACRT']]:
+        with pytest.raises(KeyError):
+            encode_dna(seqs)
+
+
+def test_encoded_seq_cache():
+    cache = EncodedSeqCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_splicing_outlier_dataloader_seq_cache():
+    kwargs = dict(
+        splicemap5=[ref_table5_kn_testis, ref_table5_kn_lung],
+        splicemap3=[ref_table3_kn_testis, ref_table3_kn_lung])
+    dl = SpliceOutlierDataloader(fasta_file, multi_vcf_file, **kwargs)
+    dl_no_cache = SpliceOutlierDataloader(
+        fasta_file, multi_vcf_file, cache_size=0, **kwargs)
+    assert dl_no_cache.seq_cache is None
+
+    for batch, batch_expected in zip(dl.batch_iter(batch_size=4),
+                                     dl_no_cache.batch_iter(batch_size=4)):
+        for k in ['seq', 'mut_seq']:
+            for module, x in batch['inputs'][k].items():
+                np.testing.assert_array_equal(
+                    x, batch_expected['inputs'][k][module])
+    assert dl.seq_cache.hits > 0
+
+
+def test_splicemap_arrow(tmp_path):
+    path = tmp_path / 'testis_psi5.arrow'
+    write_splicemap_arrow(ref_table5_kn_testis, path)
+
+    splicemap = SpliceMap.read_csv(ref_table5_kn_testis)
+    splicemap_arrow = read_splicemap_arrow(path)
+    assert splicemap_arrow.name == splicemap.name
+    pd.testing.assert_frame_equal(splicemap_arrow.df, splicemap.df)
+
+    df = read_splicemap_arrow(path, categorical=True).df
+    assert df['junctions'].dtype == 'category'
+
+
+def test_splicing_outlier_dataloader_arrow(tmp_path, outlier_dl):
+    splicemaps = dict()
+    for event_type, paths in [
+            ('psi5', [ref_table5_kn_testis, ref_table5_kn_lung]),
+            ('psi3', [ref_table3_kn_testis, ref_table3_kn_lung])]:
+        splicemaps[event_type] = list()
+        for i, path in enumerate(paths):
+            arrow_path = tmp_path / ('%s_%d.arrow' % (event_type, i))
+            write_splicemap_arrow(path, arrow_path)
+            splicemaps[event_type].append(str(arrow_path))
+
+    dl = SpliceOutlierDataloader(
+        fasta_file, vcf_file,
+        splicemap5=splicemaps['psi5'], splicemap3=splicemaps['psi3'])
+    pd.testing.assert_frame_equal(
+        dl.combined_splicemap5, outlier_dl.combined_splicemap5)
+    pd.testing.assert_frame_equal(
+        dl.combined_splicemap3, outlier_dl.combined_splicemap3)
+    assert [s.name for s in dl.splicemaps5] == ['Testis', 'Lung']
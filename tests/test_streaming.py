@@ -0,0 +1,90 @@
+import pytest
+import pandas as pd
+from absplice import SplicingOutlierResult, StreamingSplicingOutlierResult
+from conftest import mmsplice_path, spliceai_path, var_samples_path
+
+
+def _sorted(df, columns):
+    return df.sort_values(columns).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('partition_by', ['chromosome', 'gene_id'])
+def test_streaming_result_predict_absplice_dna(tmp_path, partition_by):
+    result = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        df_var_samples=var_samples_path)
+    df = result.predict_absplice_dna().reset_index()
+    df_gene = result.gene_absplice_dna.reset_index()
+
+    with StreamingSplicingOutlierResult(
+            df_mmsplice=mmsplice_path,
+            df_spliceai=spliceai_path,
+            df_var_samples=var_samples_path,
+            partition_by=partition_by,
+            n_partitions=4,
+            chunksize=2) as stream:
+        stream.predict_absplice_dna(
+            tmp_path / 'absplice_dna.parquet',
+            gene_output_path=tmp_path / 'gene_absplice_dna.parquet')
+
+    columns = ['variant', 'gene_id', 'tissue', 'sample']
+    pd.testing.assert_frame_equal(
+        _sorted(df, columns),
+        _sorted(pd.read_parquet(tmp_path / 'absplice_dna.parquet'), columns),
+        check_dtype=False)
+
+    columns = ['gene_id', 'tissue', 'sample']
+    pd.testing.assert_frame_equal(
+        _sorted(df_gene, columns),
+        _sorted(pd.read_parquet(tmp_path / 'gene_absplice_dna.parquet'), columns),
+        check_dtype=False)
+
+
+def test_streaming_result_var_samples_read_once(monkeypatch):
+    import absplice.streaming
+    read_chunks = absplice.streaming.read_chunks
+    paths = list()
+
+    def _read_chunks(path, *args, **kwargs):
+        paths.append(path)
+        return read_chunks(path, *args, **kwargs)
+
+    monkeypatch.setattr(absplice.streaming, 'read_chunks', _read_chunks)
+
+    with StreamingSplicingOutlierResult(
+            df_mmsplice=mmsplice_path,
+            df_spliceai=spliceai_path,
+            df_var_samples=var_samples_path,
+            partition_by='gene_id',
+            n_partitions=4,
+            chunksize=2) as stream:
+        results = list(stream.iter_results())
+        assert len(results) > 1
+        assert all('sample' in result.df_var_samples.columns
+                   for result in results)
+
+    assert paths.count(var_samples_path) == 1
+
+
+def test_streaming_result_absplice_dna_input(tmp_path):
+    df = SplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path).absplice_dna_input
+
+    stream = StreamingSplicingOutlierResult(
+        df_mmsplice=mmsplice_path,
+        df_spliceai=spliceai_path,
+        chunksize=2)
+    stream.write_absplice_dna_input(tmp_path / 'absplice_dna_input.parquet')
+    stream.close()
+
+    df_stream = pd.read_parquet(tmp_path / 'absplice_dna_input.parquet')
+    assert df_stream.shape[0] == df.shape[0]
+    assert set(df_stream.columns) == set(df.reset_index().columns)
+
+
+def test_streaming_result_partition_by():
+    with pytest.raises(ValueError):
+        StreamingSplicingOutlierResult(
+            df_mmsplice=mmsplice_path, partition_by='tissue')
@@ -1,5 +1,8 @@
+import pytest
+import numpy as np
 import pandas as pd
-from absplice.utils import get_abs_max_rows, filter_samples_with_RNA_seq, read_spliceai_vcf, dtype_columns_spliceai
+from absplice.utils import get_abs_max_rows, group_codes, group_abs_argmax, GroupKeyCache, filter_samples_with_RNA_seq, read_spliceai_vcf, read_spliceai_vcf_chunks, spliceai_vcf_to_parquet, dtype_columns_spliceai, read_csv, \
+    VariantSamples
 from absplice import SplicingOutlierResult
 from conftest import gene_map, gene_tpm, spliceai_path, mmsplice_path, spliceai_vcf_path, spliceai_vcf_path2
 
@@ -21,6 +24,101 @@ def test_get_max_rows():
     )
 
 
+def _get_abs_max_rows_idxmax(df, groupby, max_col, dropna=True):
+    # reference implementation with `groupby.idxmax`
+    df = df.reset_index()
+    _df = df.copy()
+    _df[max_col] = _df[max_col].abs()
+    max_scores = _df.groupby(groupby, dropna=dropna)[max_col].idxmax()
+    return df.iloc[max_scores.values].set_index(groupby)
+
+
+def test_get_max_rows_nan():
+    df = pd.DataFrame({
+        'junction': ['j2', 'j1', 'j1', 'j1', None, 'j3', 'j3'],
+        'sample': ['s1', 's1', 's1', 's1', 's1', 's2', 's2'],
+        'score': [1, np.nan, -20, 20, 30, np.nan, np.nan]
+    })
+    df_max = get_abs_max_rows(df, ['junction', 'sample'], 'score')
+    assert df_max.index.get_level_values('junction').tolist() == ['j1', 'j2', 'j3']
+    assert df_max['index'].tolist() == [2, 0, 5]
+
+    df_max = get_abs_max_rows(
+        df, ['junction', 'sample'], 'score', dropna=False)
+    assert df_max['index'].tolist() == [2, 0, 5, 4]
+
+    df = df[df['junction'] != 'j3']
+    for dropna in [True, False]:
+        pd.testing.assert_frame_equal(
+            get_abs_max_rows(df, ['junction', 'sample'], 'score', dropna),
+            _get_abs_max_rows_idxmax(df, ['junction', 'sample'], 'score', dropna))
+
+
+def test_group_abs_argmax():
+    df = pd.DataFrame({'gene': ['b', 'a', 'b', None, 'a']})
+    codes = group_codes(df, ['gene'])
+    assert codes.tolist() == [1, 0, 1, -1, 0]
+    assert group_abs_argmax(codes, [1, -2, -3, 10, 2]).tolist() == [1, 2]
+
+
+def test_group_key_cache():
+    rng = np.random.default_rng(0)
+    n = 1000
+    df = pd.DataFrame({
+        'variant': rng.integers(0, 50, n).astype(str),
+        'gene_id': rng.choice(['g1', 'g2', 'g3', None], n),
+        'tissue': rng.choice(['Testis', 'Lung'], n),
+        'score': np.round(rng.normal(size=n), 1)
+    }).set_index('tissue')
+
+    for dropna in [True, False]:
+        cache = GroupKeyCache(df)
+        for groupby in [['variant', 'gene_id', 'tissue'], ['gene_id', 'tissue'],
+                        ['tissue'], ['gene_id']]:
+            np.testing.assert_array_equal(
+                cache.group_codes(groupby, dropna),
+                group_codes(df, groupby, dropna))
+            np.testing.assert_array_equal(
+                cache.abs_max_positions(groupby, 'score', dropna),
+                group_abs_argmax(group_codes(df, groupby, dropna), df['score']))
+
+    # gene level maxima are derived from variant level maxima
+    cache = GroupKeyCache(df)
+    cache.abs_max_positions(['variant', 'gene_id', 'tissue'], 'score')
+    assert cache._finer_maxima(['gene_id', 'tissue'], 'score', True) is not None
+    assert cache._finer_maxima(['variant', 'tissue'], 'score', True) is None
+
+
+@pytest.fixture(scope='module')
+def df_max_benchmark():
+    n = 200000
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'junction': rng.integers(0, 20000, n).astype(str),
+        'tissue': rng.choice(['Testis', 'Lung', 'Liver'], n),
+        'delta_psi': rng.normal(size=n),
+        'ref_psi': rng.random(n)
+    }).set_index(['junction', 'tissue'])
+
+
+@pytest.mark.benchmark(group='get_abs_max_rows')
+def test_benchmark_get_abs_max_rows_idxmax(benchmark, df_max_benchmark):
+    benchmark.pedantic(
+        _get_abs_max_rows_idxmax, args=(
+            df_max_benchmark, ['junction', 'tissue'], 'delta_psi'),
+        rounds=1)
+
+
+@pytest.mark.benchmark(group='get_abs_max_rows')
+def test_benchmark_get_abs_max_rows(benchmark, df_max_benchmark):
+    df = benchmark.pedantic(
+        get_abs_max_rows, args=(
+            df_max_benchmark, ['junction', 'tissue'], 'delta_psi'),
+        rounds=1)
+    pd.testing.assert_frame_equal(df, _get_abs_max_rows_idxmax(
+        df_max_benchmark, ['junction', 'tissue'], 'delta_psi'))
+
+
 # def test_outlier_results_filter_samples_with_RNA_seq(outlier_results_multi, outlier_model):
 def test_outlier_results_filter_samples_with_RNA_seq(df_var_samples, outlier_model, gene_map, gene_tpm):
     samples_for_tissue = {
@@ -42,7 +140,11 @@ def test_outlier_results_filter_samples_with_RNA_seq(df_var_samples, outlier_mod
             # 'Lung': 'NA00002;NA00003', 
             'Testis': 'NA00002;NA00003'}
         
-    df_spliceai_tpm = results._add_tissue_info_to_spliceai()
+    # tissue independent spliceai predictions for each tissue of mmsplice
+    df_spliceai_tpm = pd.concat([
+        results.df_spliceai.assign(tissue=tissue)
+        for tissue in results.df_mmsplice['tissue'].unique()
+    ])
     assert df_spliceai_tpm[['tissue', 'sample']].groupby('tissue')['sample'].apply(lambda x: ';'.join(sorted(list(set(x))))).to_dict() == \
         {
             # 'Lung': 'NA00002;NA00003', 
@@ -79,4 +181,104 @@ def test_utils_read_spliceai_vcf():
     for col in df_compare.columns:
         if col in dtype_columns_spliceai.keys():
             df_compare = df_compare.astype({col: dtype_columns_spliceai[col]})
-    pd.testing.assert_frame_equal(df, df_compare)
\ No newline at end of file
+    pd.testing.assert_frame_equal(df, df_compare)
+
+
+def test_utils_read_spliceai_vcf_chunks():
+    df = read_spliceai_vcf(spliceai_vcf_path2)
+    dfs = list(read_spliceai_vcf_chunks(spliceai_vcf_path2, chunksize=2))
+    assert [df_chunk.shape[0] for df_chunk in dfs] == [2, 1]
+    pd.testing.assert_frame_equal(pd.concat(dfs, ignore_index=True), df)
+
+
+def test_utils_read_spliceai_vcf_filter():
+    df = read_spliceai_vcf(spliceai_vcf_path2, regions='17:41276032-41279042')
+    assert df['variant'].tolist() == ['17:41276032:T>A', '17:41279042:A>GA']
+
+    df = read_spliceai_vcf(spliceai_vcf_path2, regions=[('17', 1, 41201201)])
+    assert df['variant'].tolist() == ['17:41201201:TTC>CA']
+
+    df = read_spliceai_vcf(spliceai_vcf_path2, regions='17',
+                           genes=['EXOSC3', 'test'])
+    assert df['gene_name'].tolist() == ['EXOSC3', 'test']
+
+    df = read_spliceai_vcf(spliceai_vcf_path2, regions='1')
+    assert df.shape[0] == 0
+    assert df.dtypes.to_dict() == read_spliceai_vcf(
+        spliceai_vcf_path2).dtypes.to_dict()
+
+
+def test_utils_read_spliceai_vcf_cache(tmp_path):
+    cache = tmp_path / 'spliceai.parquet'
+    df = read_spliceai_vcf(spliceai_vcf_path2)
+
+    pd.testing.assert_frame_equal(
+        read_spliceai_vcf(spliceai_vcf_path2, cache=cache), df)
+    assert cache.exists()
+    pd.testing.assert_frame_equal(
+        read_spliceai_vcf(spliceai_vcf_path2, cache=cache), df)
+
+    df_filtered = read_spliceai_vcf(
+        spliceai_vcf_path2, cache=cache, regions='17:41276032-41279042',
+        genes=['OR4F5', 'EXOSC3'])
+    assert df_filtered['variant'].tolist() == ['17:41276032:T>A']
+
+    spliceai_vcf_to_parquet(spliceai_vcf_path2, tmp_path / 'test.parquet')
+    pd.testing.assert_frame_equal(
+        pd.read_parquet(tmp_path / 'test.parquet'), df)
+
+
+@pytest.mark.parametrize('suffix', ['csv', 'parquet'])
+def test_utils_read_csv_schema(tmp_path, suffix):
+    df = pd.read_csv(mmsplice_path)
+    path = tmp_path / ('mmsplice.%s' % suffix)
+    if suffix == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+    dtype = {'variant': pd.StringDtype(), 'k': 'Int64',
+             'delta_psi': 'float32', 'missing': 'float64'}
+    df_read = read_csv(path, columns=['variant', 'k', 'delta_psi', 'missing'],
+                       dtype=dtype)
+    assert df_read.columns.tolist() == ['variant', 'delta_psi', 'k']
+    assert df_read.dtypes.to_dict() == {
+        'variant': pd.StringDtype(), 'delta_psi': np.float32, 'k': 'Int64'}
+    pd.testing.assert_frame_equal(
+        df_read, df[['variant', 'delta_psi', 'k']].astype(df_read.dtypes))
+
+
+def test_utils_read_csv_parquet_pushdown(tmp_path):
+    df = pd.read_csv(mmsplice_path)
+    path = tmp_path / 'mmsplice.parquet'
+    df.to_parquet(path, index=False)
+
+    df_read = read_csv(path, columns=['variant', 'Start'],
+                       dtype={'Start': 'float64', 'variant': pd.StringDtype()})
+    assert df_read.dtypes.to_dict() == {
+        'variant': pd.StringDtype(), 'Start': np.float64}
+
+    with pytest.raises(TypeError):
+        read_csv(path, sep='\t')
+
+
+def test_variant_samples():
+    df = pd.DataFrame({
+        'variant': ['17:2:A>G', '17:1:A>G', '17:2:A>G', '17:3:A>G', '17:1:A>G'],
+        'sample': ['s2', 's1', 's1', 's3', 's1'],
+    })
+    var_samples = VariantSamples.from_df(df)
+
+    assert var_samples.variants.tolist() == ['17:1:A>G', '17:2:A>G', '17:3:A>G']
+    assert var_samples.indptr.tolist() == [0, 1, 3, 4]
+    assert len(var_samples) == 4
+    assert var_samples.counts(['17:2:A>G', '17:4:A>G']).tolist() == [2, 0]
+
+    positions, samples = var_samples.expand(['17:2:A>G', '17:4:A>G', '17:1:A>G'])
+    assert positions.tolist() == [0, 0, 2]
+    assert var_samples.samples.take(samples).tolist() == ['s1', 's2', 's1']
+
+    pd.testing.assert_frame_equal(
+        var_samples.to_df(),
+        df.drop_duplicates().sort_values(['variant', 'sample'])
+        .reset_index(drop=True))